@@ -4,6 +4,7 @@ import glob
 import ntpath
 import util.FUS_Helper as FUS_Helper
 import util.MotorXYZ as MotorXYZ
+import util.Motor_Service as Motor_Service
 
 import views.LoadSeqView as LoadSeqView
 import views.HomeView as HomeView
@@ -46,7 +47,8 @@ if __name__ == "__main__":
     # Generate the Views
     home_view = HomeView.HomeView(engine,mainWindow,all_msgs,gen,stackView)
     load_seq_view = LoadSeqView.LoadSeqView(engine, mainWindow, all_msgs,gen,motor)
-    motor_view = MotorView.MotorView(engine,mainWindow,all_msgs,motor)
+    motor_service = Motor_Service.MotorService(all_msgs,motor)
+    motor_view = MotorView.MotorView(engine,mainWindow,all_msgs,motor_service,gen)
 
     home_view.load_views(load_seq_view,motor_view)
 
@@ -55,15 +57,19 @@ if __name__ == "__main__":
 
     
 
-    #Timer Loop to allow for ctrl-c abortion
+    #Timer Loop to allow for ctrl-c abortion, and to show the generator messages and results
     timer = QTimer()
-    timer.timeout.connect(lambda: None)
+    timer.timeout.connect(gen.poll)
+    timer.timeout.connect(motor_service.poll)
     timer.start(100)
 
     #Cleanup for quitting
     def app_quit():
         if gen.connected:
             gen.close()
+        gen.shutdown(5.0)
+        motor_service.cancel()
+        motor_service.shutdown(5.0)
         if motor.connected:
             motor.close_com()
 
@@ -87,6 +87,15 @@ Item{
                 icon.source: "Img/Home.png"
             }
 
+            Button {
+                id: stopMotor
+                text: qsTr("Stop")
+                objectName: "stopMotorButton"
+                Layout.preferredWidth: 150
+                icon.source: "Img/Stop.png"
+                icon.color: "#00000000"
+            }
+
             GridLayout {
                 id: indicatorGrid
                 width: 100
@@ -0,0 +1,387 @@
+"""Micro-benchmarks for the host side of the PGA serial protocol (sdk/pga.py).
+
+Run from the repository root:
+
+    python -m benchmarks.bench_pga            # all benchmarks
+    python -m benchmarks.bench_pga framing    # only the selected ones
+"""
+import os
+import struct
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import sdk.pga as pga
+
+# 460800 baud, 8N1 -> 10 bits on the wire per byte
+LINE_RATE_BYTES = 460800 // 10
+# an FTDI adapter hands data to the host every 16 ms (default latency timer)
+USB_CHUNK_BYTES = int(LINE_RATE_BYTES * 0.016)
+
+
+class MemoryPort(object):
+    """Stands in for a serial.Serial, serving pre-recorded bytes in driver-sized chunks."""
+
+    def __init__(self, data, chunk=USB_CHUNK_BYTES):
+        self.data = data
+        self.chunk = chunk
+        self.pos = 0
+
+    @property
+    def in_waiting(self):
+        return min(self.chunk, len(self.data) - self.pos)
+
+    def read(self, n=1):
+        out = self.data[self.pos:self.pos + n]
+        self.pos += len(out)
+        return out
+
+    def rewind(self):
+        self.pos = 0
+
+
+def make_generator(port, protover=2):
+    gen = pga.Generator(loglevel=pga.LogLevel.NOTHING)
+    gen._port = port
+    gen._reader = pga._FrameReader(port)
+    gen._protocolVersion = protover
+    return gen
+
+
+def device_frame(cmd, data):
+    """Encodes a packet the way the generator does (no command counter on async packets)."""
+    hdata = cmd + "".join("%02X" % c for c in data)
+    crc = pga._computeCRC(hdata)
+    return (hdata + "%02X%02X\r\n" % (crc & 0xFF, crc >> 8)).encode()
+
+
+def pulse_frames(count):
+    """Builds `count` asynchronous pulse result frames (40 bytes each)."""
+    frames = []
+    for i in range(count):
+        payload = struct.pack("<IHHIHH", i // 20, i % 20, 1, 100000, 1200 + i % 50, 80)
+        frames.append(device_frame(pga.Generator._CMD_PULSE_MEASURE_ASYNC, payload))
+    return b"".join(frames)
+
+
+def legacy_readline(port):
+    """The byte-at-a-time reader that used to be Generator._readline."""
+    data = b''
+    while True:
+        c = port.read(1)
+        data += c
+        if c == b'\n':
+            return data
+
+
+def legacy_encode(cmd, cc, data):
+    """The per-byte "%02X" encoder that used to be Generator._encode."""
+    hdata = cmd
+    for c in struct.pack("<I", cc) + data:
+        hdata += "%02X" % c
+    crc = pga._computeCRC(hdata)
+    hdata += "%02X" % (crc & 0xFF)
+    hdata += "%02X" % (crc >> 8)
+    hdata += "\x0D\x0A"
+    return hdata.encode()
+
+
+def legacy_decode(data):
+    """The per-character decoder that used to be Generator._decode (checks omitted)."""
+    cmd = data[0:2]
+    ddata = ""
+    i = 2
+    end = len(data) - 2
+    while i < end:
+        ddata += chr(int(data[i:i + 2], 16))
+        i += 2
+    crc = struct.unpack("<H", ddata[-2:].encode('charmap'))[0]
+    pga._computeCRC(data[:end - 4])
+    return (cmd.decode(), ddata.encode('charmap')[:-2], crc)
+
+
+def legacy_crc(data):
+    """The per-character CRC loop that used to be pga._computeCRC."""
+    crc = 0xFFFF
+    for char in data:
+        if type(char) is str:
+            c = ord(char)
+        else:
+            c = char
+        tmp = ((crc >> 8) ^ c) & 0xFF
+        crc = (crc << 8) ^ pga._CCITT16_FALSE_TABLE[tmp]
+    return crc & 0xFFFF
+
+
+def timed(fn, count):
+    start = time.perf_counter()
+    fn(count)
+    return count / (time.perf_counter() - start)
+
+
+def report(name, rate, unit, reference=None):
+    line = "  %-28s %12.0f %s" % (name, rate, unit)
+    if reference:
+        line += "  (x%.1f)" % (rate / reference)
+    print(line)
+
+
+def bench_framing(count=20000):
+    data = pulse_frames(count)
+    frame_len = len(data) // count
+    line_rate = LINE_RATE_BYTES / float(frame_len)
+    print("framing: %d frames of %d bytes, line rate = %.0f frames/s" % (count, frame_len, line_rate))
+
+    port = MemoryPort(data)
+    gen = make_generator(port)
+
+    def split_legacy(n):
+        port.rewind()
+        for _ in range(n):
+            legacy_readline(port)
+
+    def split_buffered(n):
+        port.rewind()
+        gen._reader.clear()
+        for _ in range(n):
+            gen._readline()
+
+    def receive_legacy(n):
+        port.rewind()
+        for _ in range(n):
+            gen._decode(legacy_readline(port))
+
+    def receive_buffered(n):
+        port.rewind()
+        gen._reader.clear()
+        for _ in range(n):
+            gen.readAsyncPulse()
+
+    report("line rate", line_rate, "frames/s")
+    before = timed(split_legacy, count)
+    report("split, byte-at-a-time", before, "frames/s", line_rate)
+    report("split, buffered", timed(split_buffered, count), "frames/s", line_rate)
+    before = timed(receive_legacy, count)
+    report("receive, byte-at-a-time", before, "frames/s", line_rate)
+    report("receive, buffered", timed(receive_buffered, count), "frames/s", line_rate)
+
+
+def bench_codec(count=20000):
+    gen = make_generator(None)
+    frame = pulse_frames(1)
+    # a full sequence upload, the largest packet sent by the host
+    sequence = struct.pack("<I", 20) + struct.pack("<IIII", 512, 650000, 100000, 900000) * 20
+    print("codec: pulse result frame (%d bytes), sequence packet (%d bytes)" % (
+        len(frame), len(gen._encode(gen._CMD_SEQUENCE_SEND, sequence))))
+
+    def decode_legacy(n):
+        for _ in range(n):
+            pga.PulseResult(2, legacy_decode(frame)[1])
+
+    def decode_bulk(n):
+        for _ in range(n):
+            pga.PulseResult(2, gen._decode(frame)[1])
+
+    def encode_legacy(n):
+        for i in range(n):
+            legacy_encode(gen._CMD_SEQUENCE_SEND, i, sequence)
+
+    def encode_bulk(n):
+        for _ in range(n):
+            gen._encode(gen._CMD_SEQUENCE_SEND, sequence)
+
+    before = timed(decode_legacy, count)
+    report("decode pm, per character", before, "frames/s")
+    report("decode pm, bulk", timed(decode_bulk, count), "frames/s", before)
+    before = timed(encode_legacy, count // 10)
+    report("encode ws, per byte", before, "packets/s")
+    report("encode ws, bulk", timed(encode_bulk, count // 10), "packets/s", before)
+
+
+def bench_crc(count=100000):
+    data = pulse_frames(count)
+    frames = [data[i:i + 40] for i in range(0, len(data), 40)]
+    bodies = [f[:34] for f in frames]
+    assert pga._computeCRC(b"123456789") == legacy_crc(b"123456789") == 0x29B1
+    print("crc: %d pulse result frames" % count)
+
+    def single_legacy(n):
+        for b in bodies[:n]:
+            legacy_crc(b)
+
+    def single_fast(n):
+        for b in bodies[:n]:
+            pga._computeCRC(b)
+
+    def validate_loop(n):
+        for f in frames[:n]:
+            pga._computeCRC(f[:34]) == int(f[36:38] + f[34:36], 16)
+
+    def validate_batch(n):
+        pga.validateFrames(frames[:n])
+
+    before = timed(single_legacy, count // 10)
+    report("crc, per character", before, "frames/s")
+    report("crc, crc_hqx", timed(single_fast, count), "frames/s", before)
+    if pga.numpy is None:
+        print("  (NumPy not available, batch validation skipped)")
+        return
+    before = timed(validate_loop, count)
+    report("validate, one by one", before, "frames/s")
+    report("validate, batch", timed(validate_batch, count), "frames/s", before)
+
+
+def bench_batch(count=100000):
+    if pga.numpy is None:
+        print("batch: NumPy not available, skipped")
+        return
+    data = pulse_frames(count)
+    frames = [data[i:i + 40] for i in range(0, len(data), 40)]
+    gen = make_generator(None)
+    payloads = [gen._decode(f)[1] for f in frames]
+    gen.loadConfig(os.path.join(os.path.dirname(pga.__file__), "generator.json"))
+    print("batch: %d pulse results, decoded and converted to forward/reverse power" % count)
+
+    def per_object(n):
+        results = [pga.PulseResult(2, p) for p in payloads[:n]]
+        return [(gen.convertPower(r.fwdPowerADC), gen.convertPower(r.revPowerADC, False)) for r in results]
+
+    def batch_payloads(n):
+        batch = pga.PulseResultBatch.fromPayloads(2, payloads[:n])
+        return batch, batch.forwardPower(gen), batch.reversePower(gen)
+
+    def batch_frames(n):
+        batch = pga.PulseResultBatch.fromFrames(2, frames[:n])
+        return batch, batch.forwardPower(gen), batch.reversePower(gen)
+
+    def peak_memory(fn):
+        tracemalloc.start()
+        kept = fn(count)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        del kept
+        return peak / 1e6
+
+    before = timed(per_object, count)
+    report("PulseResult objects", before, "pulses/s")
+    report("batch, from payloads", timed(batch_payloads, count), "pulses/s", before)
+    report("batch, from raw frames", timed(batch_frames, count), "pulses/s", before)
+    print("  peak memory: objects %.1f MB, batch %.1f MB" % (peak_memory(per_object), peak_memory(batch_payloads)))
+
+
+def bench_sim(count=50000):
+    from sdk.pga_sim import Simulator
+    line_rate = LINE_RATE_BYTES / 40.0
+    print("sim: %d pulse results streamed by the simulator, as fast as possible" % count)
+    report("line rate", line_rate, "frames/s")
+    transports = ["in-process"] + (["pty"] if os.name == "posix" else [])
+    for transport in transports:
+        for threaded in (False, True):
+            sim = Simulator(pulseRate=0)
+            gen = pga.Generator(loglevel=pga.LogLevel.NOTHING, threaded=threaded)
+            if transport == "pty":
+                gen.connect(sim.openPty(), warm=True)
+            else:
+                sim.attach(gen)
+                gen.connect(gen._lastPort)
+            gen.sendSequence([pga.Pulse(1000, 9000, 512, 650000)])
+
+            def stream(n):
+                gen.executeSequence(n, 0, pga.ExecFlag.ASYNC_PULSE_RESULT)
+                if threaded and pga.numpy is not None:
+                    gen.readAsyncPulses(n, timeout=5)
+                else:
+                    for _ in range(n):
+                        gen.readAsyncPulse(5)
+
+            name = "%s, %s" % (transport, "threaded" if threaded else "sync")
+            report(name, timed(stream, count), "frames/s", line_rate)
+            gen.disconnect()
+            sim.close()
+
+
+def bench_abort(count=200):
+    import threading
+    from sdk.pga_sim import Simulator
+    print("abort: %d aborts of a sequence streaming results, called from another thread" % count)
+    for threaded in (False, True):
+        sim = Simulator(pulseRate=2000)
+        gen = pga.Generator(loglevel=pga.LogLevel.NOTHING, threaded=threaded)
+        sim.attach(gen)
+        gen.connect(gen._lastPort)
+        gen.sendSequence([pga.Pulse(1000, 9000, 512, 650000)])
+        latencies = []
+        for _ in range(count):
+            gen.executeSequence(1000000, 0, pga.ExecFlag.ASYNC_PULSE_RESULT)
+
+            def consume():
+                try:
+                    while True:
+                        gen.readAsyncPulse(5)
+                except pga.PGAError:
+                    pass
+
+            reader = threading.Thread(target=consume)
+            reader.start()
+            time.sleep(0.002)
+            latencies.append(gen.abort())
+            reader.join()
+        gen.disconnect()
+        sim.close()
+        latencies.sort()
+        name = "threaded" if threaded else "sync"
+        print("  %-28s median %.3f ms, p99 %.3f ms, worst %.3f ms" % (
+            name, 1e3 * latencies[len(latencies) // 2], 1e3 * latencies[int(len(latencies) * 0.99)], 1e3 * latencies[-1]))
+
+
+def bench_replay(count=50000):
+    from sdk.serial_capture import CapturePort, ReplayPort
+    data = pulse_frames(count)
+    path = os.path.join(tempfile.mkdtemp(), "pulses.cap")
+    # record the frames as a real session would: in driver-sized chunks
+    capture = CapturePort(MemoryPort(data), path)
+    while capture.in_waiting:
+        capture.read(capture.in_waiting)
+    capture.stopCapture()
+    print("replay: %d pulse result frames from a capture file (%d bytes)" % (count, os.path.getsize(path)))
+
+    port = ReplayPort(path)
+    gen = make_generator(port)
+
+    def replay(n):
+        port.rewind()
+        gen._reader.clear()
+        for _ in range(n):
+            gen.readAsyncPulse()
+
+    def replay_memory(n):
+        memory.rewind()
+        gen_memory._reader.clear()
+        for _ in range(n):
+            gen_memory.readAsyncPulse()
+
+    memory = MemoryPort(data)
+    gen_memory = make_generator(memory)
+    before = timed(replay_memory, count)
+    report("in-memory port", before, "frames/s")
+    report("memory-mapped replay", timed(replay, count), "frames/s", before)
+    port.release()
+    os.remove(path)
+
+
+BENCHMARKS = {
+    "abort": bench_abort,
+    "batch": bench_batch,
+    "codec": bench_codec,
+    "crc": bench_crc,
+    "framing": bench_framing,
+    "replay": bench_replay,
+    "sim": bench_sim,
+}
+
+
+if __name__ == "__main__":
+    names = sys.argv[1:] or sorted(BENCHMARKS)
+    for name in names:
+        BENCHMARKS[name]()
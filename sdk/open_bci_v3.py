@@ -66,19 +66,30 @@ class OpenBCIBoard(object):
     port: The port to connect to.
     baud: The baud of the serial connection.
     daisy: Enable or disable daisy module and 16 chans readings
+    capture: Path of a file recording all the serial traffic (see sdk.serial_capture).
+    serial_port: An already open serial-like object to use instead of port,
+      e.g. a sdk.serial_capture.ReplayPort to parse a recorded session.
   """
 
   def __init__(self, port=None, baud=115200, filter_data=True,
-    scaled_output=True, daisy=False, log=True, timeout=30):
+    scaled_output=True, daisy=False, log=True, timeout=30, capture=None, serial_port=None):
     self.log = log # print_incoming_text needs log
     self.streaming = False
     self.baudrate = baud
     self.timeout = timeout
-    if not port:
+    if serial_port is not None:
+      port = serial_port.port
+    elif not port:
       port = self.find_port()
     self.port = port
     print("Connecting to V3 at port %s" %(port))
-    self.ser = serial.Serial(port= port, baudrate = baud, timeout=timeout)
+    if serial_port is not None:
+      self.ser = serial_port
+    else:
+      self.ser = serial.Serial(port= port, baudrate = baud, timeout=timeout)
+    if capture:
+      from sdk.serial_capture import CapturePort
+      self.ser = CapturePort(self.ser, capture)
 
     print("Serial established...")
 
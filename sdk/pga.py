@@ -1,6 +1,6 @@
 ﻿# -*- coding: utf-8 -*-
 
-# This module is compatible with both Python 2.x and 3.x.
+# This module requires Python 3.3+ (time.perf_counter, threading and queue).
 
 """
 .. xxx module:: pga
@@ -12,12 +12,26 @@
 import os
 import time
 import struct
+import binascii
 import json
+import array
+import threading
+import collections
 import serial
 import serial.tools.list_ports
 import serial.tools.list_ports
 from serial.serialutil import SerialException
 
+try:
+	import queue
+except ImportError:
+	import Queue as queue  # Python 2.x
+
+try:
+	import numpy
+except ImportError:
+	numpy = None  # required by the batch helpers, speeds up the conversion tables
+
 
 version = (1, 1, 0)
 """Module version as a tuple of integers (major, minor, bugfix)."""
@@ -52,6 +66,26 @@ class Pulse(object):
 		self.frequency = freq
 
 
+# Binary layouts of the packets payloads, per protocol version
+_PULSE_RESULT_V1 = struct.Struct("<IIIHH")
+_PULSE_RESULT_V2 = struct.Struct("<IHHIHH")
+_EXEC_STATUS_V1 = struct.Struct("<IIIIIII")
+_EXEC_STATUS_V2 = struct.Struct("<IIHHIIII")
+_ERROR_PAYLOAD = struct.Struct("<III")
+_DEBUG_HEADER = struct.Struct("<QIH")
+_CRC_FIELD = struct.Struct("<H")
+
+
+def packSequence (sequence):
+	"""
+	Packs a list of :class:`Pulse` as expected by the sequence upload command.
+	The result can be given to :meth:`Generator.sendSequence` instead of the list,
+	e.g. to prepare the next sequence while the current one executes.
+	"""
+	return struct.pack ("<I", len(sequence)) + b"".join(
+		struct.pack ("<IIII", pulse.amplitude, pulse.frequency, pulse.duration, pulse.delay) for pulse in sequence)
+
+
 class PulseResult(object):
 	"""
 	A simple structure holding pulse measures. Its attributes are:
@@ -65,8 +99,9 @@ class PulseResult(object):
 	"""
 
 	def __init__ (self, protover, data):
+		# data can be any buffer (bytes, memoryview), it is unpacked in place
 		if protover < 2:
-			d = struct.unpack ("<IIIHH", data)
+			d = _PULSE_RESULT_V1.unpack_from (data)
 			self.execIndex   = d[0]
 			self.execID      = 0
 			self.pulseIndex  = d[1]
@@ -74,7 +109,7 @@ class PulseResult(object):
 			self.fwdPowerADC = d[3]
 			self.revPowerADC = d[4]
 		else:
-			d = struct.unpack ("<IHHIHH", data)
+			d = _PULSE_RESULT_V2.unpack_from (data)
 			self.execIndex   = d[0]
 			self.execID      = d[2]
 			self.pulseIndex  = d[1]
@@ -113,14 +148,14 @@ class ExecutionStatus(object):
 
 	def __init__ (self, protover, data):
 		if protover < 2:
-			d = struct.unpack ("<IIIIIII", data)
+			d = _EXEC_STATUS_V1.unpack_from (data)
 			self.execID     = None
 			self.status     = d[3]
 			self.temperatureADC = d[4]
 			self.currentADC = d[5]
 			self.voltageADC = d[6]
 		else:
-			d = struct.unpack ("<IIHHIIII", data)
+			d = _EXEC_STATUS_V2.unpack_from (data)
 			self.execID     = d[3]
 			self.status     = d[4]
 			self.temperatureADC = d[5]
@@ -192,6 +227,136 @@ class Output(object):
 	"""
 
 
+# Layout of a PulseResultBatch row, common to all protocol versions
+_PULSE_BATCH_FIELDS = [
+	("execIndex", "<u4"),
+	("execID", "<u2"),
+	("pulseIndex", "<u4"),
+	("duration", "<u4"),
+	("fwdPowerADC", "<u2"),
+	("revPowerADC", "<u2")]
+# Wire layouts of the pm payloads, as numpy dtypes (names listed in wire order)
+_PULSE_WIRE_FIELDS = {
+	1: [("execIndex", "<u4"), ("pulseIndex", "<u4"), ("duration", "<u4"), ("fwdPowerADC", "<u2"), ("revPowerADC", "<u2")],
+	2: [("execIndex", "<u4"), ("pulseIndex", "<u2"), ("execID", "<u2"), ("duration", "<u4"), ("fwdPowerADC", "<u2"), ("revPowerADC", "<u2")]
+}
+
+
+class PulseResultBatch(object):
+	"""
+	Many pulse measures stored in a single numpy structured array (one row per pulse).
+	The columns are the attributes of :class:`PulseResult`: execIndex, execID, pulseIndex,
+	duration, fwdPowerADC and revPowerADC. Results received outside of an execution keep
+	their raw execIndex (0xFFFFFFFF), see :attr:`inExecution`.
+	Requires NumPy.
+
+	Columns are accessed by name: ``batch["fwdPowerADC"]`` is a numpy array. An integer index
+	returns one :class:`PulseResult`, a slice returns a new batch.
+	"""
+
+	NO_EXEC = 0xFFFFFFFF
+
+	def __init__ (self, data=None):
+		"""
+		:param data: a numpy array with the batch dtype, None for an empty batch.
+		"""
+		_requireNumpy()
+		if data is None:
+			data = numpy.zeros(0, dtype=PulseResultBatch.dtype())
+		self.data = data
+
+	@staticmethod
+	def dtype ():
+		"""Returns the numpy dtype of a batch row."""
+		_requireNumpy()
+		return numpy.dtype(_PULSE_BATCH_FIELDS)
+
+	@classmethod
+	def fromPayloads (cls, protover, payloads):
+		"""
+		Decodes many pm payloads (as given to :class:`PulseResult`) at once.
+
+		:param int protover: the protocol version of the generator.
+		:param payloads: a sequence of bytes-like objects, or a single buffer of concatenated payloads.
+		:return: a new PulseResultBatch.
+		"""
+		_requireNumpy()
+		if not isinstance(payloads, (bytes, bytearray, memoryview)):
+			payloads = b"".join(payloads)
+		wire = numpy.dtype(_PULSE_WIRE_FIELDS[1 if protover < 2 else 2])
+		raw = numpy.frombuffer(payloads, dtype=wire)
+		data = numpy.zeros(len(raw), dtype=cls.dtype())
+		for name in wire.names:
+			data[name] = raw[name]
+		return cls(data)
+
+	@classmethod
+	def fromFrames (cls, protover, frames):
+		"""
+		Decodes many raw pm frames (as read on the serial port, e.g. from a capture) at once.
+		Frames with a wrong CRC, and frames of other commands, are skipped.
+
+		:param int protover: the protocol version of the generator.
+		:param frames: a sequence of bytes-like frames, including their end markers.
+		:return: a new PulseResultBatch.
+		"""
+		_requireNumpy()
+		hexLength = 2 * _PULSE_RESULT_V2.size
+		frames = [bytes(f) for f in frames if bytes(f[:2]) == b"pm"]
+		valid = validateFrames(frames)
+		bodies = [f[2:2+hexLength] for f, ok in zip(frames, valid) if ok]
+		return cls.fromPayloads(protover, binascii.unhexlify(b"".join(bodies)))
+
+	def __len__ (self):
+		return len(self.data)
+
+	def __getitem__ (self, key):
+		if isinstance(key, str):
+			return self.data[key]
+		if isinstance(key, slice) or not numpy.isscalar(key):
+			return PulseResultBatch(self.data[key])
+		row = self.data[key]
+		# same decoding as a received pm payload (no exec -> None fields)
+		return PulseResult(2, _PULSE_RESULT_V2.pack(int(row["execIndex"]), int(row["pulseIndex"]), int(row["execID"]),
+			int(row["duration"]), int(row["fwdPowerADC"]), int(row["revPowerADC"])))
+
+	def formatRow (self, index):
+		"""Returns one result formatted like :meth:`PulseResult.__str__`."""
+		return str(self[index])
+
+	def __str__ (self):
+		return "PulseResultBatch: %d pulses" % len(self.data)
+
+	@property
+	def inExecution (self):
+		"""Boolean mask, True for results measured during a sequence execution."""
+		return self.data["execIndex"] != self.NO_EXEC
+
+	def concatenate (self, other):
+		"""Returns a new batch holding the results of this batch followed by those of other."""
+		return PulseResultBatch(numpy.concatenate((self.data, other.data)))
+
+	def forwardPower (self, generator, output=Output.EXTERNAL):
+		"""
+		Converts the whole fwdPowerADC column, see :meth:`Generator.convertPower`.
+
+		:param Generator generator: a generator with its config file loaded.
+		:param Output output: Output.EXTERNAL (default) or .INTERNAL
+		:return: a numpy array of float64.
+		"""
+		return generator.convertPower(self.data["fwdPowerADC"], True, output)
+
+	def reversePower (self, generator, output=Output.EXTERNAL):
+		"""
+		Converts the whole revPowerADC column, see :meth:`Generator.convertPower`.
+
+		:param Generator generator: a generator with its config file loaded.
+		:param Output output: Output.EXTERNAL (default) or .INTERNAL
+		:return: a numpy array of float64.
+		"""
+		return generator.convertPower(self.data["revPowerADC"], False, output)
+
+
 class _Parameter(object):
 	def __init__(self, pid, editable, cacheable, init, optional, value):
 		self.id = pid
@@ -364,13 +529,24 @@ class ExecFlag(object):
 # Error messages
 
 class PGAError(Exception):
-	"""Custom exception type for PGA errors."""
+	"""
+	Custom exception type for PGA errors.
+	Its code attribute is the error (or event) code sent by the generator, None for errors detected by the host.
+	"""
 
-	def __init__(self, msg):
+	def __init__(self, msg, code = None):
 		Exception.__init__(self, msg)
+		self.code = code
 #
 
 
+ERROR_ABORTED = 1
+"""
+Code of the :class:`PGAError` raised in the threads waiting for pulse results
+when :meth:`Generator.abort` is called (generator codes start at 100).
+"""
+
+
 # Base error messages.
 # Warning: some expect an argument, some do not!
 _ERROR_MESSAGE = {
@@ -468,6 +644,39 @@ def firmwareVersionToString (fwversion):
 #
 
 
+_ADC_RANGE = 1 << 16
+_CONVERSIONS = (
+	"temperature", "current", "voltage",
+	"internalForwardPower", "externalForwardPower",
+	"internalReversePower", "externalReversePower")
+
+# values is an array.array (fast scalar lookups), array a numpy view on it (None without numpy)
+_ConversionTable = collections.namedtuple ("_ConversionTable", ("poly", "values", "array"))
+
+
+def _compileConversions(conversions):
+	"""
+	Evaluates each conversion polynomial for every 16-bit ADC value.
+
+	:param dict conversions: the "conversions" section of the config file.
+	:return: a dict, conversion name -> _ConversionTable.
+	"""
+	tables = {}
+	for name in _CONVERSIONS:
+		if name not in conversions:
+			continue
+		poly = conversions[name]
+		values = array.array("d")
+		if numpy is not None:
+			computed = _computePolyVal(poly, numpy.arange(_ADC_RANGE, dtype=numpy.float64))
+			values.frombytes(numpy.broadcast_to(computed, (_ADC_RANGE,)).astype(numpy.float64).tobytes())
+			tables[name] = _ConversionTable(poly, values, numpy.frombuffer(values, dtype=numpy.float64))
+		else:
+			values.extend(_computePolyVal(poly, v) for v in range(_ADC_RANGE))
+			tables[name] = _ConversionTable(poly, values, None)
+	return tables
+
+
 def _computePolyVal(poly, value):
 	"""
 	Evaluates a polynomial at a specific value.
@@ -513,6 +722,280 @@ class LogLevel(object):
 #
 
 
+class _FrameBuffer(object):
+	"""
+	Accumulates raw bytes received from the generator and splits them into
+	complete frames. A frame is everything up to (and including) the next LF byte.
+	Bytes are stored in a single reusable bytearray, consumed frames are only
+	discarded from time to time, to avoid moving data around on each frame.
+	"""
+
+	_COMPACT_SIZE = 4096
+
+	def __init__ (self):
+		self._buf = bytearray()
+		self._start = 0  # first byte of the next frame
+		self._scan = 0   # bytes before this index are known not to contain any LF
+
+	def __len__ (self):
+		return len(self._buf) - self._start
+
+	def feed (self, data):
+		"""Appends received bytes to the buffer."""
+		self._buf += data
+
+	def nextFrame (self):
+		"""
+		Extracts the next complete frame.
+
+		:return: the frame as bytes (with its end markers), or None if no complete frame is available.
+		"""
+		end = self._buf.find(b"\n", max(self._start, self._scan))
+		if end < 0:
+			self._scan = len(self._buf)
+			return None
+		frame = bytes(self._buf[self._start:end+1])
+		self._start = end + 1
+		self._scan = self._start
+		if self._start == len(self._buf):
+			del self._buf[:]
+			self._start = self._scan = 0
+		elif self._start >= self._COMPACT_SIZE:
+			del self._buf[:self._start]
+			self._scan -= self._start
+			self._start = 0
+		return frame
+
+	def clear (self):
+		"""Drops all buffered bytes, including any incomplete frame."""
+		del self._buf[:]
+		self._start = self._scan = 0
+
+
+class _FrameReader(object):
+	"""
+	Reads frames from a serial port, using bulk reads of all the bytes
+	already waiting in the driver instead of one read per character.
+	"""
+
+	def __init__ (self, port):
+		self._port = port
+		self._frames = _FrameBuffer()
+		self.bytesIn = 0   # link statistics, see Generator.stats()
+		self.framesIn = 0
+
+	def readFrame (self, timeout = None):
+		"""
+		Returns the next complete frame received on the port.
+
+		:param float timeout: maximum time to wait in seconds, None to wait forever.
+		:return: the frame as bytes, or None on timeout.
+		"""
+		deadline = None if timeout is None else time.time() + timeout
+		while True:
+			frame = self._frames.nextFrame()
+			if frame is not None:
+				self.framesIn += 1
+				return frame
+			# when nothing is waiting, a 1-byte read blocks (up to the port timeout)
+			# until the next byte arrives, then everything else is fetched at once
+			n = self._port.in_waiting
+			chunk = self._port.read(n if n > 0 else 1)
+			if chunk:
+				self.bytesIn += len(chunk)
+				self._frames.feed(chunk)
+			elif deadline is not None and time.time() >= deadline:
+				return None
+
+	def clear (self):
+		"""Forgets any buffered (partial) frame, e.g. after the port input was flushed."""
+		self._frames.clear()
+
+
+class LinkStats(object):
+	"""
+	Protocol counters of a :class:`Generator`, updated continuously (see :meth:`Generator.stats`).
+	Command latencies are kept in histograms with power of 2 buckets (in microseconds),
+	so recording one costs a few operations only.
+	"""
+
+	BUCKETS = 26  # up to 2^25 us = 33 s
+
+	def __init__ (self):
+		self.reset()
+
+	def reset (self):
+		"""Sets all the counters to 0."""
+		self.started = time.time()
+		self.bytesOut = 0
+		self.framesOut = 0
+		self.crcErrors = 0        # frames received with a wrong CRC
+		self.badFrames = 0        # frames received too short, or with non hexa characters
+		self.unexpectedDrops = 0  # answers not matching the expected command, or no pending command
+		self.ignoredAsync = 0     # asynchronous packets received while ignored
+		self.queueDrops = 0       # asynchronous packets dropped because their queue was full
+		self.queueHighWater = {}  # queue -> maximum number of items seen
+		self.latency = {}         # command -> [histogram, count, errors, sum, max]
+
+	def recordLatency (self, cmd, seconds):
+		"""Adds the round-trip time of one command to its histogram."""
+		entry = self.latency.get(cmd)
+		if entry is None:
+			entry = self.latency[cmd] = [[0] * self.BUCKETS, 0, 0, 0.0, 0.0]
+		entry[0][min(int(seconds * 1e6).bit_length(), self.BUCKETS - 1)] += 1
+		entry[1] += 1
+		entry[3] += seconds
+		if seconds > entry[4]:
+			entry[4] = seconds
+
+	def recordError (self, cmd):
+		"""Counts one command answered by an error (or not answered)."""
+		entry = self.latency.get(cmd)
+		if entry is None:
+			entry = self.latency[cmd] = [[0] * self.BUCKETS, 0, 0, 0.0, 0.0]
+		entry[2] += 1
+
+	def latencySummary (self):
+		"""
+		Summarizes the latency histograms.
+
+		:return: a dict indexed by command, each value is a dict with the number of answers ("count"),
+			of errors ("errors"), the "mean" and "max" latencies, the approximate "p50" and "p99"
+			(upper bound of their bucket), all in seconds, and the non empty buckets ("histogram",
+			upper bound in microseconds -> count).
+		"""
+		summary = {}
+		for cmd, (hist, count, errors, total, worst) in self.latency.items():
+			summary[cmd] = {
+				"count": count,
+				"errors": errors,
+				"mean": total / count if count else 0.0,
+				"max": worst,
+				"p50": self._percentile(hist, count, 0.50),
+				"p99": self._percentile(hist, count, 0.99),
+				"histogram": dict((1 << i, n) for i, n in enumerate(hist) if n)
+			}
+		return summary
+
+	@staticmethod
+	def _percentile (hist, count, fraction):
+		if count == 0:
+			return 0.0
+		target = fraction * count
+		acc = 0
+		for i, n in enumerate(hist):
+			acc += n
+			if acc >= target:
+				return (1 << i) * 1e-6
+		return (1 << (len(hist) - 1)) * 1e-6
+
+
+def formatStats (stats, previous = None):
+	"""
+	Formats a :meth:`Generator.stats` snapshot on one line, e.g. for logs.
+
+	:param dict stats: the snapshot to format.
+	:param dict previous: an older snapshot, rates are computed since then if given (since the reset otherwise).
+	:return: a string.
+	"""
+	elapsed = stats["elapsed"] - (previous["elapsed"] if previous else 0)
+	elapsed = max(elapsed, 1e-9)
+	def rate (key):
+		return (stats[key] - (previous[key] if previous else 0)) / elapsed
+	msg = "Link: in %.0f B/s %.0f frames/s, out %.0f B/s %.0f frames/s, crc=%d bad=%d unexpected=%d ignored=%d dropped=%d, queues=%s" % (
+		rate("bytesIn"), rate("framesIn"), rate("bytesOut"), rate("framesOut"),
+		stats["crcErrors"], stats["badFrames"], stats["unexpectedDrops"], stats["ignoredAsync"], stats["queueDrops"],
+		"/".join(str(stats["queueDepth"][name]) for name in ("pulse", "event", "debug")))
+	for cmd, lat in sorted(stats["latency"].items()):
+		msg += "; %s: n=%d err=%d mean=%.2fms p99<%.2fms max=%.2fms" % (
+			cmd, lat["count"], lat["errors"], lat["mean"] * 1e3, lat["p99"] * 1e3, lat["max"] * 1e3)
+	return msg
+
+
+class _StatsDumper(threading.Thread):
+	"""Background thread calling a function with a :meth:`Generator.stats` snapshot at a fixed interval."""
+
+	def __init__ (self, generator, interval, callback):
+		threading.Thread.__init__(self, name="pga-stats")
+		self.daemon = True
+		self._gen = generator
+		self._interval = interval
+		self._callback = callback
+		self._stopEvent = threading.Event()
+
+	def run (self):
+		previous = None
+		while not self._stopEvent.wait(self._interval):
+			stats = self._gen.stats()
+			if self._callback is not None:
+				self._callback(stats)
+			else:
+				self._gen._log(LogLevel.INFO, formatStats(stats, previous))
+			previous = stats
+
+	def stop (self):
+		self._stopEvent.set()
+		if threading.current_thread() is not self:
+			self.join()
+
+
+class _PendingReply(object):
+	"""A synchronous command waiting for its answer, see :meth:`Generator._transact`."""
+
+	def __init__ (self, cmd):
+		self.cmd = cmd
+		self.cc = None        # command counter, once sent
+		self.data = None
+		self.error = None
+		self.code = None      # generator error code, if answered by an error
+		self.done = threading.Event()
+		self.sent = None      # time.perf_counter() when sent, and when answered
+		self.received = None
+
+	def resolve (self, data = None, error = None, code = None):
+		self.data = data
+		self.error = error
+		self.code = code
+		self.received = time.perf_counter()
+		self.done.set()
+
+
+class _AsyncEvent(object):
+	"""Marker put in the pulse queue when an event interrupts the stream of results."""
+
+	def __init__ (self, msg, code = None):
+		self.msg = msg
+		self.code = code
+
+
+class _ReaderThread(threading.Thread):
+	"""
+	Owns the reading side of the serial port: reads every incoming frame and
+	hands it to :meth:`Generator._dispatch`, until stopped.
+	"""
+
+	def __init__ (self, generator):
+		threading.Thread.__init__(self, name="PGA reader")
+		self.daemon = True
+		self._generator = generator
+		self._stopEvent = threading.Event()
+
+	def stop (self):
+		self._stopEvent.set()
+		if self is not threading.current_thread():
+			self.join()
+
+	def run (self):
+		gen = self._generator
+		try:
+			while not self._stopEvent.is_set():
+				frame = gen._reader.readFrame(timeout=0)
+				if frame is not None:
+					gen._dispatch(frame)
+		except Exception as ex:
+			gen._readerFailed("Reader thread stopped: " + str(ex))
+
+
 class Generator(object):
 	"""The main class that respresents the hardware generator."""
 
@@ -531,18 +1014,52 @@ class Generator(object):
 	_CMD_EVENT_ASYNC = "sy"
 	_CMD_DEBUG = "dg"
 
+	_RESET_PULSE = 0.5  # time the reset pin is held, in seconds
+	_RESET_TIME = 5.5   # time for the board to restart, in seconds
+
 
-	def __init__ (self, loglevel = LogLevel.EVENT):
+	def __init__ (self, loglevel = LogLevel.EVENT, threaded = False, queueSize = 10000, answerTimeout = 5.0):
 		"""
 		Constructor. Creates an instance.
 
 		:param loglevel: the default :class:`LogLevel` to set.
+		:param bool threaded: if True, a background thread reads the port once connected.
+			Answers are routed to the waiting commands by their command counter,
+			so commands can be sent (from any thread) while pulse results are streamed.
+			Asynchronous packets go to separate bounded queues, see :meth:`readAsyncPulse`,
+			:meth:`readEvent` and :meth:`readDebugMessage`.
+		:param int queueSize: maximum number of packets kept in each asynchronous queue
+			(only used if threaded). The oldest ones are dropped when full.
+		:param float answerTimeout: maximum time to wait for the answer of a command in seconds,
+			None to wait forever. A command whose answer is lost (e.g. bad CRC) then raises a :class:`PGAError`.
 		"""
 		self._port = serial.Serial(timeout=0.1)
+		self._answerTimeout = answerTimeout
+		self._reader = _FrameReader(self._port)
+		self._threaded = threaded
+		self._readerThread = None
+		self._sendLock = threading.Lock()
+		self._sendGate = threading.Event()  # cleared while an abort goes ahead of the other commands
+		self._sendGate.set()
+		self._pending = {}     # command counter -> _PendingReply, in threaded mode
+		self._abort = None     # _PendingReply of the abort in progress, in non-threaded mode
+		self._abortStale = None  # command counter of an abort not acknowledged in time, in non-threaded mode
+		self._readLock = threading.RLock()  # held by the thread reading the port, in non-threaded mode
+		self._pulseQueue = queue.Queue(queueSize)
+		self._eventQueue = queue.Queue(queueSize)
+		self._debugQueue = queue.Queue(queueSize)
+		self._paramCache = {}  # values of cacheable parameters read on this connection
+		self._sequence = None  # packed sequence installed on this connection, None if unknown
+		self._cacheHits = 0
+		self._cacheMisses = 0
+		self._lastPort = None  # last port successfully connected to, tried first by autoConnect
+		self._stats = LinkStats()
+		self._statsDumper = None
 		self._logLevel = loglevel
 		self._cmdCounter = 1   # to generate unique command indices
 		self._execCounter = 1  # to generate unique execution IDs
 		self._config = None    # None if not loaded, a dict otherwise
+		self._conversionTables = {}  # conversion name -> lookup table indexed by ADC value
 		self._initDone = False
 
 		# used as a marker to protect some commands, to make sure they are executed
@@ -578,10 +1095,10 @@ class Generator(object):
 			return
 		print (msg)
 
-	def _throw (self, msg):
-		"""Raises a :class:`PGAError` exception with the given message, and logs the same message before."""
+	def _throw (self, msg, code = None):
+		"""Raises a :class:`PGAError` exception with the given message (and generator error code), and logs the same message before."""
 		self._log(LogLevel.ERROR, msg)
-		raise PGAError(msg)
+		raise PGAError(msg, code)
 
 
 	def loadConfig (self, fname):
@@ -592,9 +1109,10 @@ class Generator(object):
 		"""
 		with open (fname, "r") as f:
 			self._config = json.load (f)
+		self._conversionTables = _compileConversions (self._config.get("conversions", {}))
 
 
-	def connect (self, port = None):
+	def connect (self, port = None, warm = False, reset = True):
 		"""
 		Initializes the serial port settings, and tries to open it.
 
@@ -602,8 +1120,74 @@ class Generator(object):
 			On Linux, usually something like "/dev/ttySx" or "/dev/ttyUSBx".
 			On Windows, "COMx" or "\\.\COMx", you can call "CHANGE PORT /QUERY" in a DOS console, to see the list of available ports.
 			Can also be simply 0 for the first one.
+		:param bool warm: if True, first checks whether the board already runs and answers
+			(by reading its firmware version). If it does, any execution is stopped
+			and the board is not reset, which saves the ~6 s of :meth:`resetBoard`.
+		:param bool reset: only used if warm is True, False to fail instead of resetting
+			the board when it does not answer.
 		:raise: PGAError on error
 		"""
+		self._openPort (port)
+
+		self.clearParameterCache()
+		self._sequence = None
+		self._initDone = False
+		self._cmdCounter = 1
+		self._execCounter = 1
+		self._ignoreAsync = 0
+		self._abortStale = None
+		fwversion = None
+		if warm:
+			self._port.flushInput()
+			self._reader.clear()
+			fwversion = self._probe()
+			if fwversion is None:
+				if not reset:
+					self._port.close()
+					self._throw("Generator is not answering on %s." % self._port.port)
+				self._log(LogLevel.VERBOSE, "Generator is not answering, it will be reset.")
+		if fwversion is None:
+			self.resetBoard()
+		if self._threaded:
+			self._startReader()
+		if fwversion is None:
+			fwversion = self.readParameter (Param.FIRMWARE_VERSION)
+		else:
+			self._paramCache[Param.FIRMWARE_VERSION] = fwversion
+		# Set the protocol version from the firmware version (first byte only)
+		# since we need it to build and parse the right packet format
+		self._protocolVersion = fwversion >> 24
+		if warm:
+			# same state as after a reset: nothing running
+			self._ignoreAsync += 1
+			self.stopSequence()
+			self._ignoreAsync -= 1
+
+		if self._config:
+			# Send parameters values to the board, all at once
+			names, values = self._configParameters()
+			errors = self.writeParameters(values)
+			if errors:
+				self._throw("; ".join("Failed to init parameter %s: %s" % (names[param], msg) for param, msg in errors.items()))
+			self._initDone = True
+		self._lastPort = self._port.port
+		return True
+
+
+	def _configParameters (self):
+		"""
+		Returns the parameters to set from the config file.
+
+		:return: a tuple (names, values), two dicts indexed by :class:`Param`,
+			with the PARAM_* names used in the file, and the values to write.
+		"""
+		params = self._config["parameters"]
+		names = dict((getattr(Param, p[6:]), p) for p in params.keys() if p.startswith("PARAM_"))
+		return (names, dict((param, params[name]) for param, name in names.items()))
+
+
+	def _openPort (self, port):
+		"""Applies the serial port settings (from the config file if port is None), and opens it."""
 		if self._config is None and port is None:
 			self._throw ("Connect() requires a serial port if no configuration has been loaded first.")
 		if port is None:
@@ -623,33 +1207,37 @@ class Generator(object):
 		except SerialException as ex:
 			self._throw("Can not open serial port: "+str(ex))
 
-		self.resetBoard()
-		self._initDone = False
-		self._cmdCounter = 1
-		self._execCounter = 1
-		self._ignoreAsync = 0
-		# Set the protocol version from the firmware version (first byte only)
-		# since we need it to build and parse the right packet format
-		self._protocolVersion = self.readParameter (Param.FIRMWARE_VERSION) >> 24
 
-		if self._config:
-			# Send parameters values to the board
-			params = self._config["parameters"]
-			for p in list(params.keys()):
-				try:
-					if not p.startswith("PARAM_"): continue
-					self.writeParameter(getattr(Param, p[6:]), params[p])
-				except PGAError as ex:
-					self._throw("Failed to init parameter %s: " % p + str(ex))
-			self._initDone = True
-		return True
+	def _probe (self, timeout = 0.5):
+		"""
+		Checks whether a running board answers on the (open) port, by reading its firmware version.
+		Asynchronous packets from a previous session are ignored.
+
+		:param float timeout: maximum time to wait for the answer, in seconds.
+		:return: the firmware version, or None if the board did not answer in time.
+		"""
+		cc = self._sendLocked (self._CMD_PARAM_GET, struct.pack ("<I", Param.DEFAULTS[Param.FIRMWARE_VERSION].id))
+		deadline = time.time() + timeout
+		while True:
+			frame = self._reader.readFrame(max(0, deadline - time.time()))
+			if frame is None:
+				return None
+			try:
+				cmd, data, _ = self._decode (frame)
+			except PGAError:
+				continue
+			if cmd == self._CMD_PARAM_GET and len(data) >= 8 and struct.unpack_from ("<I", data)[0] == cc:
+				return struct.unpack_from ("<II", data)[1]
 
 
-	def autoConnect(self):
+	def autoConnect(self, warm = False):
 		"""
 		Try to automatically find a suitable serial port to connect to,
 		among the list of available ports on the system.
+		The last port successfully connected to is tried first.
 
+		:param bool warm: if True, all ports are first probed for an already running board
+			(see :meth:`connect`), before falling back to resetting them one by one.
 		:return: True on success, False on error.
 		"""
 		allPorts = serial.tools.list_ports.comports()
@@ -665,16 +1253,29 @@ class Generator(object):
 			if p.description.startswith("FTDIBUS") or p.description.startswith("USB"):
 				usbPorts.append(p)
 		usbPorts.sort(key=lambda x: x[0][3:])
-		# try to connect to every port, in that order, until one works
+		portNames = []
 		for p in usbPorts:
+			portName = p.device
+			if os.name == "nt":
+				portName = "\\\\.\\"+portName
+			portNames.append(portName)
+		# also when not listed as a USB port (e.g. a pseudo-terminal, or a simulated port)
+		if self._lastPort is not None:
+			if self._lastPort in portNames:
+				portNames.remove(self._lastPort)
+			portNames.insert(0, self._lastPort)
+
+		# try to connect to every port, in that order, until one works
+		attempts = [(name, True, False) for name in portNames] if warm else []
+		attempts += [(name, False, True) for name in portNames]
+		for portName, probeOnly, reset in attempts:
 			try:
-				portName = p.device
-				if os.name == "nt":
-					portName = "\\\\.\\"+portName
-				self.connect(portName)
+				self.connect(portName, warm=probeOnly, reset=reset)
 				return True
 			except PGAError:
-				pass
+				self._stopReader()
+				if self._port.isOpen():
+					self._port.close()
 		return False
 
 
@@ -686,26 +1287,37 @@ class Generator(object):
 				self.stopSequence()
 				self.enableAmplifier (False)
 				self._ignoreAsync -= 1
+			self._stopReader()
 			self._port.close()
 		self._ignoreAsync = 0
+		self._sequence = None
 
 
-	def readParameter (self, param):
+	def readParameter (self, param, useCache = True):
 		"""
 		Reads the value of a generator parameter.
+		Cacheable parameters (see :attr:`Param.DEFAULTS`) are only read once per connection,
+		then served from memory until written, or until the board is reset.
 
 		:param param: one of :class:`Param`.
+		:param bool useCache: False to always read the value from the generator.
 		:return: the value of the specified parameter on success.
 		:raises: :class:`PGAError` on bad parameter.
 		"""
 		if param < Param.FIRST or param > Param.LAST:
 			self._throw("Parameter index out of range (%d)" % param)
 
-		packet = self._encode (self._CMD_PARAM_GET, struct.pack ("<I", Param.DEFAULTS[param].id))
-		self._send (packet)
+		cacheable = Param.DEFAULTS[param].cacheable
+		if cacheable:
+			if useCache and param in self._paramCache:
+				self._cacheHits += 1
+				return self._paramCache[param]
+			self._cacheMisses += 1
 
-		answer = self._receive (self._CMD_PARAM_GET)
+		answer = self._transact (self._CMD_PARAM_GET, struct.pack ("<I", Param.DEFAULTS[param].id))
 		value = struct.unpack ("<II", answer)[1]  # ignore cc
+		if cacheable:
+			self._paramCache[param] = value
 		return value
 
 
@@ -723,29 +1335,234 @@ class Generator(object):
 			self._throw("This parameter is not editable.")
 		value = int(value)  # raise on unexpected type
 
-		packet = self._encode (self._CMD_PARAM_SET, struct.pack ("<II", Param.DEFAULTS[param].id, value))
-		self._send (packet)
-		self._receive (self._CMD_PARAM_SET)
+		self._paramCache.pop(param, None)
+		self._transact (self._CMD_PARAM_SET, struct.pack ("<II", Param.DEFAULTS[param].id, value))
+
+
+	def readParameters (self, params, depth = 8, useCache = True):
+		"""
+		Reads the values of several generator parameters at once.
+		Requests are pipelined: up to depth of them are sent before waiting for the answers,
+		which are matched back by command counter.
+		Cached values are used as in :meth:`readParameter`.
+
+		:param params: a list of :class:`Param`.
+		:param int depth: maximum number of requests in flight.
+		:param bool useCache: False to always read the values from the generator.
+		:return: a tuple (values, errors), two dicts indexed by parameter,
+			with the values read, and the error messages for the parameters that failed.
+		"""
+		values = {}
+		errors = {}
+		requests = []
+		for param in params:
+			if param < Param.FIRST or param > Param.LAST:
+				errors[param] = "Parameter index out of range (%d)" % param
+			elif not Param.DEFAULTS[param].cacheable:
+				requests.append(param)
+			elif useCache and param in self._paramCache:
+				self._cacheHits += 1
+				values[param] = self._paramCache[param]
+			else:
+				self._cacheMisses += 1
+				requests.append(param)
+		answers = self._transactMany (self._CMD_PARAM_GET,
+			[struct.pack ("<I", Param.DEFAULTS[param].id) for param in requests], depth)
+		for param, (answer, error) in zip(requests, answers):
+			if error is None:
+				values[param] = struct.unpack ("<II", answer)[1]  # ignore cc
+				if Param.DEFAULTS[param].cacheable:
+					self._paramCache[param] = values[param]
+			else:
+				errors[param] = error
+		return (values, errors)
+
+
+	def writeParameters (self, values, depth = 8):
+		"""
+		Changes the values of several generator parameters at once.
+		Requests are pipelined: up to depth of them are sent before waiting for the answers,
+		which are matched back by command counter.
+
+		:param dict values: new values to set (integers), indexed by :class:`Param`.
+		:param int depth: maximum number of requests in flight.
+		:return: a dict of error messages indexed by parameter, empty if all values were set.
+		"""
+		errors = {}
+		requests = []
+		for param, value in values.items():
+			if param < Param.FIRST or param > Param.LAST:
+				errors[param] = "Parameter index out of range (%d)" % param
+			elif not Param.DEFAULTS[param].editable:
+				errors[param] = "This parameter is not editable."
+			else:
+				requests.append((param, int(value)))  # raise on unexpected type
+				self._paramCache.pop(param, None)
+		answers = self._transactMany (self._CMD_PARAM_SET,
+			[struct.pack ("<II", Param.DEFAULTS[param].id, value) for param, value in requests], depth)
+		for (param, _), (_, error) in zip(requests, answers):
+			if error is not None:
+				errors[param] = error
+		return errors
+
+
+	def clearParameterCache (self):
+		"""Forgets all cached parameter values, they will be read again from the generator."""
+		self._paramCache.clear()
+
+
+	def parameterCacheStats (self):
+		"""
+		Returns the parameter cache counters.
+
+		:return: a dict with the number of cache "hits" and "misses" (cacheable parameters only),
+			and the number of values currently cached ("size").
+		"""
+		return {"hits": self._cacheHits, "misses": self._cacheMisses, "size": len(self._paramCache)}
+
+
+	def startCapture (self, path):
+		"""
+		Starts recording all the serial traffic (bytes read and written, with timestamps)
+		into a capture file, see :mod:`sdk.serial_capture`. Can be called before or after connecting.
+
+		:param str path: the capture file, created if needed, appended to otherwise.
+		"""
+		try:
+			from sdk.serial_capture import CapturePort
+		except ImportError:
+			from serial_capture import CapturePort
+		self.stopCapture()
+		self._setPort (CapturePort(self._port, path))
+
+
+	def stopCapture (self):
+		"""Stops the recording started by :meth:`startCapture` (if any), the connection is kept."""
+		wrapped = getattr(self._port, "wrapped", None)
+		if wrapped is not None:
+			self._port.stopCapture()
+			self._setPort (wrapped)
+
+
+	def _setPort (self, port):
+		"""
+		Replaces the serial port object (e.g. by a capture, replay or simulated port).
+		Bytes already received but not yet parsed are kept.
+		"""
+		self._port = port
+		self._reader._port = port
+
+
+	def stats (self):
+		"""
+		Returns a snapshot of the link statistics, recorded since the creation or :meth:`resetStats`.
+
+		:return: a dict with:
+
+			- "elapsed": seconds since the reset,
+			- "bytesIn", "framesIn", "bytesOut", "framesOut": traffic counters,
+			- "framesInPerSecond", "bytesInPerSecond": average rates since the reset,
+			- "crcErrors": frames received with a wrong CRC,
+			- "badFrames": frames received too short or with non hexa characters,
+			- "unexpectedDrops": answers dropped (unexpected command, or no command waiting for it),
+			- "ignoredAsync": asynchronous packets ignored (e.g. while stopping),
+			- "queueDrops": asynchronous packets dropped because their queue was full (threaded mode),
+			- "queueDepth", "queueHighWater": current and maximum number of items in the
+			  "pulse", "event" and "debug" queues (threaded mode),
+			- "latency": command round-trip times, see :meth:`LinkStats.latencySummary`.
+		"""
+		st = self._stats
+		elapsed = max(time.time() - st.started, 1e-9)
+		queues = (("pulse", self._pulseQueue), ("event", self._eventQueue), ("debug", self._debugQueue))
+		return {
+			"elapsed": elapsed,
+			"bytesIn": self._reader.bytesIn,
+			"framesIn": self._reader.framesIn,
+			"bytesOut": st.bytesOut,
+			"framesOut": st.framesOut,
+			"framesInPerSecond": self._reader.framesIn / elapsed,
+			"bytesInPerSecond": self._reader.bytesIn / elapsed,
+			"crcErrors": st.crcErrors,
+			"badFrames": st.badFrames,
+			"unexpectedDrops": st.unexpectedDrops,
+			"ignoredAsync": st.ignoredAsync,
+			"queueDrops": st.queueDrops,
+			"queueDepth": dict((name, q.qsize()) for name, q in queues),
+			"queueHighWater": dict((name, st.queueHighWater.get(q, 0)) for name, q in queues),
+			"latency": st.latencySummary()
+		}
+
+
+	def resetStats (self):
+		"""Sets all the link statistics back to 0."""
+		self._stats.reset()
+		self._reader.bytesIn = 0
+		self._reader.framesIn = 0
+
+
+	def startStatsDump (self, interval = 10.0, callback = None):
+		"""
+		Periodically reports the link statistics, from a background thread.
+
+		:param float interval: time between two reports, in seconds.
+		:param callback: function called with each :meth:`stats` snapshot,
+			None to log them at the INFO level instead (rates computed over the interval).
+		"""
+		self.stopStatsDump()
+		self._statsDumper = _StatsDumper(self, interval, callback)
+		self._statsDumper.start()
+
+
+	def stopStatsDump (self):
+		"""Stops the periodic report started by :meth:`startStatsDump` (if any)."""
+		if self._statsDumper is not None:
+			self._statsDumper.stop()
+			self._statsDumper = None
 
 
 	def clearSequence (self):
-		packet = self._encode (self._CMD_SEQUENCE_SEND, struct.pack ("<I", 0))
-		self._send (packet)
-		self._receive (self._CMD_SEQUENCE_SEND)
+		self.sendSequence (packSequence ([]))
 
 
 	def sendSequence (self, sequence):
 		"""
 		Sends a sequence definition (install it into the generator's buffer).
 
-		:param sequence: a list of :class:`Pulse` objects.
+		:param sequence: a list of :class:`Pulse` objects, or the same already packed by :func:`packSequence`.
+		"""
+		if not isinstance(sequence, bytes):
+			sequence = packSequence (sequence)
+		self._sequence = None  # unknown until acknowledged
+		self._transact (self._CMD_SEQUENCE_SEND, sequence)
+		self._sequence = sequence
+
+
+	def updateSequence (self, sequence):
+		"""
+		Same as :meth:`sendSequence`, but skips the upload if the generator already holds
+		the same sequence: the last one acknowledged on this connection, since the last reset.
+
+		:param sequence: a list of :class:`Pulse` objects, or the same already packed by :func:`packSequence`.
+		:return: True if the sequence was uploaded, False if it was already installed.
 		"""
-		params = struct.pack ("<I", len(sequence))
-		for pulse in sequence:
-			params += struct.pack ("<IIII", pulse.amplitude, pulse.frequency, pulse.duration, pulse.delay)
-		packet = self._encode (self._CMD_SEQUENCE_SEND, params)
-		self._send (packet)
-		self._receive (self._CMD_SEQUENCE_SEND)
+		if not isinstance(sequence, bytes):
+			sequence = packSequence (sequence)
+		if sequence == self._sequence:
+			return False
+		self.sendSequence (sequence)
+		return True
+
+
+	def sequenceFingerprint (self):
+		"""
+		Returns a fingerprint of the sequence installed by this connection,
+		e.g. to log which sequence was executed.
+
+		:return: the CRC-32 of the packed sequence, None if unknown (nothing sent since the connection or the last reset).
+		"""
+		if self._sequence is None:
+			return None
+		return binascii.crc32 (self._sequence)
 
 
 	def executeSequence (self, execs = 1, delay = 0, flags = 0):
@@ -756,38 +1573,146 @@ class Generator(object):
 		:param int delay: the delay between executions in microseconds
 		:param int flags: OR-combination of :class:`ExecFlags`.
 		"""
+		if self._readerThread is not None:
+			self._clearQueue (self._pulseQueue)  # results (or abort marker) of a previous execution
+		self._transact (self._CMD_SEQUENCE_EXECUTE, self._executeData (execs, delay, flags))
+
+
+	def _executeData (self, execs, delay, flags):
+		"""Packs the arguments of an execution command, for the current protocol version."""
 		if self._protocolVersion < 2:
 			v1mask = 0x003F
 			if (flags & v1mask) != flags:
 				self._throw("Some flags are not allowed in this version of the protocol. Please check ExecFlag documentation.")
-			packet = self._encode (self._CMD_SEQUENCE_EXECUTE, struct.pack ("<III", execs, delay, flags))
-		else:
-			packet = self._encode (self._CMD_SEQUENCE_EXECUTE, struct.pack ("<IIIH", execs, delay, flags, self._nextExecutionCounter()))
-		self._send (packet)
-		self._receive (self._CMD_SEQUENCE_EXECUTE)
+			return struct.pack ("<III", execs, delay, flags)
+		return struct.pack ("<IIIH", execs, delay, flags, self._nextExecutionCounter())
 
 
 	def stopSequence (self):
 		"""
 		Stops the execution of the current sequence (if any).
 		"""
-		packet = self._encode (self._CMD_SEQUENCE_STOP)
-		self._send (packet)
 		self._ignoreAsync += 1
-		self._receive (self._CMD_SEQUENCE_STOP)
+		self._transact (self._CMD_SEQUENCE_STOP)
 		self._ignoreAsync -= 1
 
 
+	def abort (self, timeout = 1.0):
+		"""
+		Stops the current execution as fast as possible. Can be called from any thread,
+		while another one waits for pulse results or for the answer of a command.
+
+		The stop command is written before any other command waiting to be sent.
+		In threaded mode, the threads waiting for pulse results get a :class:`PGAError`
+		with code :data:`ERROR_ABORTED` right away. In non-threaded mode, a thread waiting for
+		pulse results gets it as soon as the stop is acknowledged, a thread waiting for the
+		answer of a command still gets its answer.
+		The time from this call to the acknowledgement is recorded in :meth:`stats`, as "abort".
+
+		:param float timeout: maximum time to wait for the acknowledgement in seconds.
+		:return: the abort latency in seconds, None if the stop was not acknowledged in time.
+		:raises: :class:`PGAError` if the generator refuses to stop.
+		"""
+		started = time.perf_counter()
+		pending = _PendingReply(self._CMD_SEQUENCE_STOP)
+		pending.owner = threading.get_ident()
+		self._sendGate.clear()
+		try:
+			with self._sendLock:
+				cc = self._nextCommandCounter()
+				if self._readerThread is not None:
+					self._pending[cc] = pending
+				else:
+					pending.cc = cc
+					self._abort = pending
+				pending.sent = time.perf_counter()
+				self._send (self._encode (self._CMD_SEQUENCE_STOP, b"", cc))
+		finally:
+			self._sendGate.set()
+
+		try:
+			if self._readerThread is not None:
+				self._clearQueue (self._pulseQueue)
+				self._enqueue (self._pulseQueue, _AsyncEvent("Execution aborted.", ERROR_ABORTED))
+				pending.done.wait(timeout)
+			else:
+				# the thread reading the port (if any) resolves the abort when it reads the answer,
+				# otherwise (or once it is done) read it here
+				deadline = started + timeout
+				if self._readLock.acquire (timeout=max(0, deadline - time.perf_counter())):
+					self._ignoreAsync += 1
+					try:
+						while not pending.done.is_set() and time.perf_counter() < deadline:
+							try:
+								self._receivePacket ((self._CMD_SEQUENCE_STOP, self._CMD_ERROR), deadline - time.perf_counter())
+							except PGAError:
+								pass
+					finally:
+						self._ignoreAsync -= 1
+						self._readLock.release()
+		finally:
+			self._abort = None
+			if not pending.done.is_set() and self._readerThread is None:
+				# its answer may still come: swallow it instead of handing it to a reading thread
+				self._abortStale = pending.cc
+
+		if not pending.done.is_set():
+			self._stats.recordError ("abort")
+			self._log(LogLevel.ERROR, "Abort not acknowledged within %.3f s." % timeout)
+			return None
+		if pending.error is not None:
+			self._stats.recordError ("abort")
+			self._throw (pending.error, pending.code)
+		latency = pending.received - started
+		self._stats.recordLatency ("abort", latency)
+		return latency
+
+
+	def _abortAnswer (self, rcv):
+		"""
+		In non-threaded mode, checks whether a received packet answers the abort in progress.
+		If it does, the abort is resolved.
+
+		:param rcv: tuple (cmd, data, CRC) as returned by _decode().
+		:return: True if the packet answers the abort.
+		"""
+		pending = self._abort
+		if pending is None or rcv[0] not in (self._CMD_SEQUENCE_STOP, self._CMD_ERROR) or len(rcv[1]) < 4:
+			return False
+		if struct.unpack_from ("<I", rcv[1])[0] != pending.cc:
+			return False
+		if rcv[0] == self._CMD_ERROR:
+			pending.resolve(error=self._errorMessage(rcv), code=_ERROR_PAYLOAD.unpack_from (rcv[1])[1])
+		else:
+			pending.resolve(rcv[1])
+		return True
+
+
+	def _staleAbortAnswer (self, rcv):
+		"""
+		In non-threaded mode, checks whether a received packet is the late answer of an abort
+		not acknowledged in time, which is then dropped.
+
+		:param rcv: tuple (cmd, data, CRC) as returned by _decode().
+		:return: True if the packet must be ignored.
+		"""
+		if rcv[0] not in (self._CMD_SEQUENCE_STOP, self._CMD_ERROR) or len(rcv[1]) < 4:
+			return False
+		if struct.unpack_from ("<I", rcv[1])[0] != self._abortStale:
+			return False
+		self._abortStale = None
+		self._stats.ignoredAsync += 1
+		self._log(LogLevel.VERBOSE, "Ignoring late '%s' answer of an abort." % rcv[0])
+		return True
+
+
 	def readExecutionStatus (self):
 		"""
 		Returns information about the currently executed sequence (or the last one).
 
 		:return: an :class:`ExecutionStatus` object.
 		"""
-		packet = self._encode (self._CMD_EXEC_STATUS_READ)
-		self._send (packet)
-
-		answer = self._receive (self._CMD_EXEC_STATUS_READ)
+		answer = self._transact (self._CMD_EXEC_STATUS_READ)
 		return ExecutionStatus (self._protocolVersion, answer)
 
 
@@ -797,23 +1722,84 @@ class Generator(object):
 
 		:return: a :class:`PulseResult` object.
 		"""
-		packet = self._encode (self._CMD_PULSE_MEASURE_READ)
-		self._send (packet)
-
-		answer = self._receive (self._CMD_PULSE_MEASURE_READ)
+		answer = self._transact (self._CMD_PULSE_MEASURE_READ)
 		return PulseResult(self._protocolVersion, answer[4:])  # ignore the cmd counter
 
 
-	def readAsyncPulse (self):
+	def readAsyncPulse (self, timeout = None):
 		"""
 		Reads the next asynchronous pulse result, sent by the executeSequence command.
 
+		:param float timeout: maximum time to wait in seconds, None to wait forever.
 		:return: a :class:`PulseResult` object.
+		:raises: :class:`PGAError` on timeout, or if an event was received before the next result.
 		"""
-		answer = self._receive (self._CMD_PULSE_MEASURE_ASYNC)
+		if self._readerThread is None:
+			answer = self._receive (self._CMD_PULSE_MEASURE_ASYNC, timeout)
+		else:
+			answer = self._readQueue (self._pulseQueue, timeout, "pulse result")
+			if isinstance(answer, _AsyncEvent):
+				self._throw (answer.msg, answer.code)
 		return PulseResult(self._protocolVersion, answer)
 
 
+	def readAsyncPulses (self, count=None, timeout = None):
+		"""
+		Reads many asynchronous pulse results at once, decoded in bulk.
+		Requires NumPy.
+
+		:param int count: number of results to read. In threaded mode, None reads the results
+		                  already received without waiting (possibly none).
+		:param float timeout: maximum time to wait for each result in seconds, None to wait forever.
+		:return: a :class:`PulseResultBatch` object.
+		:raises: :class:`PGAError` on timeout, or if an event was received before the last result.
+		"""
+		_requireNumpy()
+		payloads = []
+		if self._readerThread is None:
+			if count is None:
+				self._throw ("A count is required when not in threaded mode.")
+			for i in range(count):
+				payloads.append (self._receive (self._CMD_PULSE_MEASURE_ASYNC, timeout))
+		else:
+			while count is None or len(payloads) < count:
+				if count is None:
+					try:
+						answer = self._pulseQueue.get_nowait()
+					except queue.Empty:
+						break
+				else:
+					answer = self._readQueue (self._pulseQueue, timeout, "pulse result")
+				if isinstance(answer, _AsyncEvent):
+					self._throw (answer.msg, answer.code)
+				payloads.append (answer)
+		return PulseResultBatch.fromPayloads (self._protocolVersion, payloads)
+
+
+	def readEvent (self, timeout = None):
+		"""
+		Reads the next event (system event or asynchronous error) sent by the generator.
+		Only available in threaded mode, events raise a :class:`PGAError` otherwise.
+
+		:param float timeout: maximum time to wait in seconds, None to wait forever.
+		:return: a tuple (command, code, value, message), command being "sy" or "ko".
+		:raises: :class:`PGAError` on timeout.
+		"""
+		return self._readQueue (self._eventQueue, timeout, "event")
+
+
+	def readDebugMessage (self, timeout = None):
+		"""
+		Reads the next debug message sent by the generator firmware.
+		Only available in threaded mode, these messages are only logged otherwise.
+
+		:param float timeout: maximum time to wait in seconds, None to wait forever.
+		:return: the message, as a string.
+		:raises: :class:`PGAError` on timeout.
+		"""
+		return self._readQueue (self._debugQueue, timeout, "debug message")
+
+
 	def enableAmplifier (self, state):
 		"""
 		Enables or disables the amplifier power supply.
@@ -824,9 +1810,7 @@ class Generator(object):
 			state = 1
 		else:
 			state = 0
-		packet = self._encode (self._CMD_AMPLI_POWER_ENABLE, struct.pack ("<I", state))
-		self._send (packet)
-		self._receive (self._CMD_AMPLI_POWER_ENABLE)
+		self._transact (self._CMD_AMPLI_POWER_ENABLE, struct.pack ("<I", state))
 
 
 	def isAmplifierEnabled (self):
@@ -835,9 +1819,7 @@ class Generator(object):
 
 		:return bool: True if the amplifier is active, False otherwise (executions will fail).
 		"""
-		packet = self._encode (self._CMD_AMPLI_POWER_ENABLE)
-		self._send (packet)
-		answer = self._receive (self._CMD_AMPLI_POWER_ENABLE)
+		answer = self._transact (self._CMD_AMPLI_POWER_ENABLE)
 		val = struct.unpack ("<II", answer)[1]  # ignore cmd counter
 		return val == 1
 
@@ -850,18 +1832,14 @@ class Generator(object):
 		"""
 		if output != Output.INTERNAL and output != Output.EXTERNAL:
 			self._throw ("Invalid output value.")
-		packet = self._encode (self._CMD_AMPLI_OUTPUT, struct.pack ("<I", output))
-		self._send (packet)
-		self._receive (self._CMD_AMPLI_OUTPUT)
+		self._transact (self._CMD_AMPLI_OUTPUT, struct.pack ("<I", output))
 
 
 	def output (self):
 		"""Tells which output is currently used to emit ultrasounds.
 
 		:return: :attr:`Output.INTERNAL` or :attr:`Output.EXTERNAL`."""
-		packet = self._encode (self._CMD_AMPLI_OUTPUT)
-		self._send (packet)
-		answer = self._receive (self._CMD_AMPLI_OUTPUT)
+		answer = self._transact (self._CMD_AMPLI_OUTPUT)
 		return struct.unpack ("<II", answer)[1]  # ignore cmd counter
 
 
@@ -873,11 +1851,7 @@ class Generator(object):
 		:return: the converted value in Celsius.
 		:raises: if the required polynomial is missing from the config file.
 		"""
-		try:
-			poly = self._config["conversions"]["temperature"]
-		except:
-			raise PGAError("Missing polynomial from config file, or not loaded.")
-		return _computePolyVal(poly, adcValue)
+		return self._convert ("temperature", adcValue)
 
 
 	def convertCurrent(self, adcValue):
@@ -888,11 +1862,7 @@ class Generator(object):
 		:return: the converted value in Ampere.
 		:raises: if the required polynomial is missing from the config file.
 		"""
-		try:
-			poly = self._config["conversions"]["current"]
-		except:
-			raise PGAError("Missing polynomial from config file, or not loaded.")
-		return _computePolyVal(poly, adcValue)
+		return self._convert ("current", adcValue)
 
 
 	def convertVoltage(self, adcValue):
@@ -903,11 +1873,7 @@ class Generator(object):
 		:return: the converted value in Volt.
 		:raises: if the required polynomial is missing from the config file.
 		"""
-		try:
-			poly = self._config["conversions"]["voltage"]
-		except:
-			raise PGAError("Missing polynomial from config file, or not loaded.")
-		return _computePolyVal(poly, adcValue)
+		return self._convert ("voltage", adcValue)
 
 
 	def convertPower(self, adcValue, forward=True, output=Output.EXTERNAL):
@@ -920,14 +1886,32 @@ class Generator(object):
 		:return: the converted value in Volt.
 		:raises: if the required polynomial is missing from the config file.
 		"""
-		polyname = "external" if output == Output.EXTERNAL else "external"
+		polyname = "external" if output == Output.EXTERNAL else "internal"
 		polyname += "Forward" if forward else "Reverse"
 		polyname += "Power"
-		try:
-			poly = self._config["conversions"][polyname]
-		except:
+		return self._convert (polyname, adcValue)
+
+
+	def _convert (self, name, adcValue):
+		"""
+		Converts a raw ADC value, or a numpy array of them, with the named lookup table.
+		Values outside of the 16-bit range fall back to the polynomial.
+		"""
+		table = self._conversionTables.get (name)
+		if table is None:
 			raise PGAError("Missing polynomial from config file, or not loaded.")
-		return _computePolyVal(poly, adcValue)
+		if numpy is not None and isinstance (adcValue, numpy.ndarray):
+			if adcValue.dtype == numpy.uint16:
+				return table.array[adcValue]
+			if adcValue.dtype.kind in "iu" and (adcValue.size == 0 or (adcValue.min() >= 0 and adcValue.max() < _ADC_RANGE)):
+				return table.array[adcValue]
+			return _computePolyVal (table.poly, adcValue)
+		if 0 <= adcValue < _ADC_RANGE:
+			try:
+				return table.values[adcValue]
+			except (TypeError, IndexError):  # not an integer
+				pass
+		return _computePolyVal (table.poly, adcValue)
 
 	#------------------------------------------------------------------------
 	# end of user commands
@@ -947,11 +1931,18 @@ class Generator(object):
 	def resetBoard (self):
 		"""Forces a hardware reset of the board.
 		Will block for about 6 seconds until it has properly restarted."""
-		resetTime = 5.5
-		self._log(LogLevel.VERBOSE, "Generator board init, please wait %g s..." % (resetTime+0.5))
-		self.enableBoard (False, 0.5)
+		resetTime = self._RESET_TIME
+		self._log(LogLevel.VERBOSE, "Generator board init, please wait %g s..." % (resetTime+self._RESET_PULSE))
+		self.enableBoard (False, self._RESET_PULSE)
+		restart = self._readerThread is not None
+		self._stopReader()
 		self.enableBoard (True, resetTime)
 		self._port.flushInput()
+		self._reader.clear()
+		self.clearParameterCache()
+		self._sequence = None
+		if restart:
+			self._startReader()
 
 
 	def _nextCommandCounter (self):
@@ -966,65 +1957,239 @@ class Generator(object):
 		return ec
 
 
-	def _encode (self, cmd, data=b""):
+	def _encode (self, cmd, data=b"", cc=None):
 		"""
 		Prepares a command packet.
 		Adds (and increments) the command counter, converts the data content in ASCII hexa,
 		then computes and appends the CRC, and finally the end markers.
 
 		:param str cmd: 2-letters string, one of _CMD_*
-		:param str data: packed data string
+		:param bytes data: packed data string
+		:param int cc: command counter to use, None to take the next one.
+		:return: the packet, as bytes ready to be written.
 		"""
-		hdata = cmd
-		for c in struct.pack("<I", self._nextCommandCounter())+data:
-			hdata += "%02X" % c
+		if cc is None:
+			cc = self._nextCommandCounter()
+		hdata = cmd.encode() + binascii.hexlify(struct.pack("<I", cc)+data).upper()
 		crc = _computeCRC(hdata)
-		hdata += "%02X" % (crc & 0xFF)
-		hdata += "%02X" % (crc >> 8)
-		hdata += "\x0D\x0A" # "\r\n"
-		return hdata
+		return hdata + binascii.hexlify(_CRC_FIELD.pack(crc)).upper() + b"\r\n"
 
 
 	def _send (self, data):
 		self._log(LogLevel.PACKET, "SEND: "+repr(data))
-		n = self._port.write (data.encode())
+		n = self._port.write (data)
+		self._stats.bytesOut += len(data)
+		self._stats.framesOut += 1
 		self._log(LogLevel.VERBOSE, "%d bytes written" % n)
 
 
+	def _transact (self, cmd, data=b""):
+		"""
+		Sends one command and waits for its answer.
+		Without reader thread, the answer is simply the next packet received (see :meth:`_receive`).
+		Otherwise the answer is routed back by the reader thread using the command counter.
+
+		:param str cmd: 2-letters string, one of _CMD_*
+		:param bytes data: packed data string
+		:return: the data received (without command and CRC)
+		:raises: :class:`PGAError` on errors.
+		"""
+		if self._readerThread is None:
+			# the port is read by this thread until the answer comes (an abort waits for it)
+			with self._readLock:
+				start = time.perf_counter()
+				self._sendLocked (cmd, data)
+				try:
+					answer = self._receive (cmd, self._answerTimeout)
+				except PGAError:
+					self._stats.recordError (cmd)
+					raise
+			self._stats.recordLatency (cmd, time.perf_counter() - start)
+			return answer
+
+		pending = self._sendPending (cmd, data)
+		try:
+			self._waitPending (pending)
+		except PGAError:
+			self._stats.recordError (cmd)
+			raise
+		if pending.error is not None:
+			self._stats.recordError (cmd)
+			self._throw (pending.error, pending.code)
+		self._stats.recordLatency (cmd, pending.received - pending.sent)
+		return pending.data
+
+
+	def _transactMany (self, cmd, datas, depth):
+		"""
+		Sends several commands of the same type back-to-back, with up to depth of them
+		waiting for their answer, then matches the answers using the command counter.
+		Errors are returned instead of being raised, so one failure does not stop the others.
+
+		:param str cmd: 2-letters string, one of _CMD_*
+		:param datas: a list of packed data strings, one per command.
+		:param int depth: maximum number of commands in flight.
+		:return: a list of tuples (data, error), in the same order as datas,
+			error is None on success, data is None on error.
+		"""
+		results = [None] * len(datas)
+		depth = max(1, depth)
+
+		if self._readerThread is not None:
+			inflight = collections.deque()
+			for i, data in enumerate(datas):
+				if len(inflight) >= depth:
+					j, pending = inflight.popleft()
+					results[j] = self._pendingResult (pending)
+				inflight.append((i, self._sendPending (cmd, data)))
+			for j, pending in inflight:
+				results[j] = self._pendingResult (pending)
+			return results
+
+		# the port is read by this thread until the last answer comes (an abort waits for it)
+		with self._readLock:
+			inflight = {}  # cc -> (index in datas, time sent)
+			sent = 0
+			while sent < len(datas) or inflight:
+				while sent < len(datas) and len(inflight) < depth:
+					start = time.perf_counter()
+					inflight[self._sendLocked (cmd, datas[sent])] = (sent, start)
+					sent += 1
+				rcmd, data = self._receivePacket ((cmd, self._CMD_ERROR), self._answerTimeout)
+				cc = struct.unpack_from ("<I", data)[0]
+				if cc not in inflight:
+					self._stats.unexpectedDrops += 1
+					self._log(LogLevel.VERBOSE, "Ignoring '%s' answer without pending command (cc=%d)." % (rcmd, cc))
+					continue
+				i, start = inflight.pop(cc)
+				if rcmd == self._CMD_ERROR:
+					self._stats.recordError (cmd)
+					results[i] = (None, self._errorMessage((rcmd, data)))
+				else:
+					self._stats.recordLatency (cmd, time.perf_counter() - start)
+					results[i] = (data, None)
+		return results
+
+
+	def _pendingResult (self, pending):
+		"""Waits for the answer of a _PendingReply, returns its (data, error) tuple, and records its latency."""
+		try:
+			self._waitPending (pending)
+		except PGAError as ex:
+			self._stats.recordError (pending.cmd)
+			return (None, str(ex))
+		if pending.error is None:
+			self._stats.recordLatency (pending.cmd, pending.received - pending.sent)
+		else:
+			self._stats.recordError (pending.cmd)
+		return (pending.data, pending.error)
+
+
+	def _waitPending (self, pending):
+		"""
+		Waits for the answer of a command sent by :meth:`_sendPending`, at most answerTimeout.
+
+		:raises: :class:`PGAError` on timeout, the command is not waited for anymore.
+		"""
+		if pending.done.wait (self._answerTimeout):
+			return
+		with self._sendLock:
+			self._pending.pop (pending.cc, None)
+		if not pending.done.is_set():  # not answered in the meantime
+			self._throw ("Timeout while waiting for '%s'." % pending.cmd)
+
+
+	def _sendPending (self, cmd, data):
+		"""
+		Sends a command in threaded mode, after registering it as waiting for its answer.
+
+		:return: the :class:`_PendingReply` that will receive the answer.
+		"""
+		pending = _PendingReply(cmd)
+		self._sendLocked (cmd, data, pending)
+		return pending
+
+
+	def _sendLocked (self, cmd, data = b"", pending = None):
+		"""
+		Sends a command, from any thread: the command counter is taken and the packet written
+		under _sendLock, after any abort in progress (which goes ahead of the other commands).
+
+		:param pending: the :class:`_PendingReply` to register for the answer (threaded mode), or None.
+		:return: the command counter used.
+		"""
+		while True:
+			self._sendGate.wait()
+			with self._sendLock:
+				if not self._sendGate.is_set():
+					continue  # an abort was requested while waiting for the lock: it goes first
+				cc = self._nextCommandCounter()
+				if pending is not None:
+					pending.cc = cc
+					self._pending[cc] = pending
+				try:
+					if pending is not None:
+						pending.sent = time.perf_counter()
+					self._send (self._encode (cmd, data, cc))
+				except:
+					if pending is not None:
+						del self._pending[cc]
+					raise
+				return cc
+
+
 	def _decode (self, data):
 		"""
 		Decodes the received string and returns a tuple (command, data, crc), where:
 
 		- command is a 2-letters command
-		- data is encoded data ready to be unpacked
+		- data is a memoryview on the decoded payload, ready to be unpacked
 		- crc is a 16 bits integer CRC
 
 		:raises: on bad CRC or not-convertible character (not ASCII hexa).
 		"""
 		if len(data) < 8:
+			self._stats.badFrames += 1
 			self._throw ("Message too short (%d)" % len(data))
 
-		cmd = data[0:2]
-
-		ddata = ""
-		i = 2
+		view = memoryview(data)
 		end = len(data) - 2  # ignore 0x0D 0x0A at the end
-		if data[-3:] == "\r\r\n":
+		if data[-3:] == b"\r\r\n":
 			end -= 1
-		# convert all up to the end (even the CRC)
-		while i < end:
-			try:
-				ddata += chr (int (data[i:i+2], 16))
-			except:
-				self._throw("Can not convert character %d." % i)
-			i += 2
-		
-		crc = struct.unpack ("<H", ddata[-2:].encode('charmap'))[0]
-		computedCRC = _computeCRC(data[:end-4])
+		# convert all up to the end (even the CRC) in one go
+		try:
+			raw = binascii.unhexlify(view[2:end])
+		except (binascii.Error, TypeError, ValueError):
+			self._stats.badFrames += 1
+			self._throw("Can not convert character %d." % _badHexIndex(data, 2, end))
+
+		crc = _CRC_FIELD.unpack_from (raw, len(raw)-2)[0]
+		computedCRC = _computeCRC(view[:end-4])
 
 		if crc != computedCRC:
+			self._stats.crcErrors += 1
 			self._throw("Bad CRC (received: %d, computed: %d)" % (crc, computedCRC))
-		return (cmd.decode(), ddata.encode('charmap')[:-2], crc)
+		return (bytes(view[0:2]).decode(), memoryview(raw)[:-2], crc)
+
+
+	def _shortPacket (self, cmd, data):
+		"""
+		Checks whether a received payload is shorter than the fixed part of its command
+		(errors, events and debug messages). Such a packet is counted in unexpectedDrops.
+
+		:return: True if the packet must be dropped.
+		"""
+		if cmd in (self._CMD_ERROR, self._CMD_EVENT_ASYNC):
+			size = _ERROR_PAYLOAD.size
+		elif cmd == self._CMD_DEBUG:
+			size = _DEBUG_HEADER.size
+		else:
+			return False
+		if len(data) >= size:
+			return False
+		self._stats.unexpectedDrops += 1
+		self._log(LogLevel.VERBOSE, "Ignoring short '%s' packet (%d bytes)." % (cmd, len(data)))
+		return True
 
 
 	def _errorMessage(self, rcv):
@@ -1037,13 +2202,13 @@ class Generator(object):
 		# [4] error code
 		# [4] error value
 		if rcv[0] == self._CMD_ERROR:
-			_, errcode, errvalue = struct.unpack ("<III", rcv[1][0:12]) # ignores cmd counter
+			_, errcode, errvalue = _ERROR_PAYLOAD.unpack_from (rcv[1]) # ignores cmd counter
 			msg = "Error: "
 		elif rcv[0] == self._CMD_EVENT_ASYNC:
 			# [4] event code
 			# [4] index
 			# [4] value
-			errcode, _, errvalue = struct.unpack ("<III", rcv[1]) # ignores index
+			errcode, _, errvalue = _ERROR_PAYLOAD.unpack_from (rcv[1]) # ignores index
 			msg = "Event: "
 		else:
 			msg = "??? "
@@ -1062,7 +2227,7 @@ class Generator(object):
 			self._CMD_EVENT_ASYNC,
 			self._CMD_DEBUG)
 
-	def _receive (self, cmd):
+	def _receive (self, cmd, timeout = None):
 		"""
 		Receives one message from the serial port, decodes it and performs some checks.
 		If the received packet matches cmd, it is always return, no matter its type (even errors).
@@ -1071,57 +2236,213 @@ class Generator(object):
 		It will (log and) ignore events and asynchronous answers if ignoreAsync is True.
 
 		:param cmd: the expected command to receive
+		:param float timeout: maximum time to wait for each packet in seconds, None to wait forever.
 		:return: the data received (without command and CRC)
 		:raises: :class:`PGAError` on errors.
 		"""
+		return self._receivePacket ((cmd,), timeout)[1]
+
+
+	def _receivePacket (self, cmds, timeout = None):
+		"""
+		Same as :meth:`_receive`, but accepts any of several commands.
+
+		:param cmds: a tuple of the expected commands.
+		:param float timeout: maximum time to wait for each packet in seconds, None to wait forever.
+		:return: a tuple (command, data), data being received without command and CRC.
+		:raises: :class:`PGAError` on errors.
+		"""
+		with self._readLock:
+			return self._receivePacketLoop (cmds, timeout)
+
+
+	def _receivePacketLoop (self, cmds, timeout):
 		while True:
-			incoming = self._readline()
+			incoming = self._reader.readFrame(timeout)
+			if incoming is None:
+				self._throw ("Timeout while waiting for '%s'." % "/".join(cmds))
 			self._log(LogLevel.PACKET, "RECV: "+repr(incoming))
 			
 			rcv = self._decode (incoming)  # contains (cmd, data, CRC)
 			self._log(LogLevel.PACKET, " CMD: %s CRC: 0x%04X DATA: %d bytes" % (rcv[0], rcv[2], len(rcv[1])))
+			if self._shortPacket (rcv[0], rcv[1]):
+				continue
+			abort = self._abort
+			if abort is not None and self._abortAnswer (rcv):
+				if abort.owner == threading.get_ident():
+					return rcv[:2]
+				if self._CMD_PULSE_MEASURE_ASYNC in cmds:
+					self._throw ("Execution aborted.", ERROR_ABORTED)
+				continue  # keep waiting for the answer of the command
+			if self._abortStale is not None and self._staleAbortAnswer (rcv):
+				continue
 			if rcv[0] == self._CMD_ERROR:
 				msg = self._errorMessage(rcv)
-				if rcv[0] == cmd:
+				if rcv[0] in cmds:
 					self._log(LogLevel.ERROR, msg)
-					return rcv[1]
-				self._throw (msg)
+					return rcv[:2]
+				self._throw (msg, _ERROR_PAYLOAD.unpack_from (rcv[1])[1])
 			elif rcv[0] == self._CMD_EVENT_ASYNC:
 				msg = self._errorMessage(rcv)
-				if rcv[0] == cmd:
+				if rcv[0] in cmds:
 					self._log(LogLevel.EVENT, msg)
-					return rcv[1]
-				self._throw (msg)
+					return rcv[:2]
+				self._throw (msg, _ERROR_PAYLOAD.unpack_from (rcv[1])[0])
 			elif rcv[0] == self._CMD_DEBUG:
 				# Debug messages from the generator firmware
 				# [8] timestamp
 				# [4] mask
 				# [2] n = message length (incl. \0)
 				# [n] debug message
-				msg = "Generator: tstamp=%d, mask=%d, len=%d, msg=" % struct.unpack ("<QIH", rcv[1][:14]) + rcv[1][14:].decode('charmap')
+				msg = "Generator: tstamp=%d, mask=%d, len=%d, msg=" % _DEBUG_HEADER.unpack_from (rcv[1]) + bytes(rcv[1][14:]).decode('charmap')
 				self._log(LogLevel.INFO, msg)
-				if rcv[0] == cmd:
-					return rcv[1]
+				if rcv[0] in cmds:
+					return rcv[:2]
 				continue
 			elif self._isAsync(rcv[0]) and self._ignoreAsync:
+				self._stats.ignoredAsync += 1
 				self._log(LogLevel.VERBOSE, "Ignoring '%s' async packet." % (rcv[0]))
 				continue
-			if rcv[0] != cmd:
-				self._throw ("Unexpected command received (%s, expected: %s)" % (rcv[0], cmd))
-			return rcv[1]
+			if rcv[0] not in cmds:
+				self._stats.unexpectedDrops += 1
+				self._throw ("Unexpected command received (%s, expected: %s)" % (rcv[0], "/".join(cmds)))
+			return rcv[:2]
+
+
+	def _dispatch (self, frame):
+		"""
+		Routes one received frame, in threaded mode (called by the reader thread):
+
+		- answers to synchronous commands (and errors) go to the waiting command, using the command counter,
+		- pulse results go to the pulse queue,
+		- events and debug messages go to their own queues.
+		"""
+		self._log(LogLevel.PACKET, "RECV: "+repr(frame))
+		try:
+			cmd, data, _ = self._decode (frame)
+		except PGAError:
+			return  # already logged, nobody to report it to
+		if self._shortPacket (cmd, data):
+			return
+
+		if cmd == self._CMD_PULSE_MEASURE_ASYNC:
+			self._enqueue (self._pulseQueue, data)
+		elif cmd == self._CMD_EVENT_ASYNC:
+			msg = self._errorMessage((cmd, data))
+			self._log(LogLevel.EVENT, msg)
+			errcode, _, errvalue = _ERROR_PAYLOAD.unpack_from (data)
+			self._enqueue (self._eventQueue, (cmd, errcode, errvalue, msg))
+			self._enqueue (self._pulseQueue, _AsyncEvent(msg, errcode))
+		elif cmd == self._CMD_DEBUG:
+			msg = "Generator: tstamp=%d, mask=%d, len=%d, msg=" % _DEBUG_HEADER.unpack_from (data) + bytes(data[14:]).decode('charmap')
+			self._log(LogLevel.INFO, msg)
+			self._enqueue (self._debugQueue, msg)
+		elif cmd == self._CMD_EXEC_STATUS_ASYNC or len(data) < 4:
+			self._stats.ignoredAsync += 1
+			self._log(LogLevel.VERBOSE, "Ignoring '%s' async packet." % cmd)
+		else:
+			cc = struct.unpack_from ("<I", data)[0]
+			with self._sendLock:
+				pending = self._pending.pop(cc, None)
+			if cmd == self._CMD_ERROR:
+				msg = self._errorMessage((cmd, data))
+				if pending is not None:
+					pending.resolve(error=msg, code=_ERROR_PAYLOAD.unpack_from (data)[1])
+				else:
+					self._log(LogLevel.ERROR, msg)
+					errcode, errvalue = struct.unpack_from ("<II", data, 4)
+					self._enqueue (self._eventQueue, (cmd, errcode, errvalue, msg))
+			elif pending is None:
+				self._stats.unexpectedDrops += 1
+				self._log(LogLevel.VERBOSE, "Ignoring '%s' answer without pending command (cc=%d)." % (cmd, cc))
+			elif pending.cmd != cmd:
+				self._stats.unexpectedDrops += 1
+				pending.resolve(error="Unexpected command received (%s, expected: %s)" % (cmd, pending.cmd))
+			else:
+				pending.resolve(data)
+
+
+	def _enqueue (self, q, item):
+		"""Puts an item in a bounded queue, dropping the oldest one if full."""
+		while True:
+			try:
+				q.put_nowait(item)
+				depth = q.qsize()
+				if depth > self._stats.queueHighWater.get(q, 0):
+					self._stats.queueHighWater[q] = depth
+				return
+			except queue.Full:
+				try:
+					q.get_nowait()
+					self._stats.queueDrops += 1
+					self._log(LogLevel.VERBOSE, "Asynchronous queue full, oldest packet dropped.")
+				except queue.Empty:
+					pass
+
+
+	def _clearQueue (self, q):
+		"""Drops all the items of an asynchronous queue."""
+		while True:
+			try:
+				q.get_nowait()
+			except queue.Empty:
+				return
+
+
+	def _readQueue (self, q, timeout, what):
+		try:
+			return q.get(timeout=timeout)
+		except queue.Empty:
+			self._throw ("Timeout while waiting for a %s." % what)
+
+
+	def _startReader (self):
+		"""Starts the reader thread (the port must be open)."""
+		if self._readerThread is None:
+			self._readerThread = _ReaderThread(self)
+			self._readerThread.start()
+
+
+	def _stopReader (self):
+		"""Stops the reader thread (if any), commands still waiting for an answer fail."""
+		if self._readerThread is not None:
+			self._readerThread.stop()
+			self._readerThread = None
+			self._failPending ("Reader thread stopped.")
+
+
+	def _readerFailed (self, msg):
+		"""Called by the reader thread when it can not read the port anymore."""
+		self._log(LogLevel.ERROR, msg)
+		self._readerThread = None
+		self._failPending (msg)
+
+
+	def _failPending (self, msg):
+		with self._sendLock:
+			pending = list(self._pending.values())
+			self._pending.clear()
+		for p in pending:
+			p.resolve(error=msg)
 
 
 	def _readline (self):
 		"""
 		Was added to debug some problem, but now kept since the serial.readline()
 		replaces \n by \r\n -> so we get \r\r\n at the end.
+		Frames are split from bulk reads by :class:`_FrameReader`.
 		"""
-		data = b''
-		while True:
-			c = self._port.read(1)
-			data += c
-			if c == b'\n':
-				return data
+		return self._reader.readFrame()
+
+def _badHexIndex (data, start, end):
+	"""Returns the index of the first character of data[start:end] that breaks the hexa conversion."""
+	for i in range(start, end, 2):
+		try:
+			int (data[i:i+2], 16)
+		except ValueError:
+			return i
+	return end - 1  # odd number of characters
+#
 
 #--------------------------------------------------------------------
 # CRC
@@ -1164,17 +2485,106 @@ _CCITT16_FALSE_TABLE = (
 def _computeCRC (data):
 	"""
 	Computes a 16 bits CCITT CRC on the given data.
-	(Little Endian implementation based on a table, Poly=0x1021, Check=0x29B1).
-	print "CRC test:", pga._computeCRC("123456789"), 0x29B1
+	(Poly=0x1021, Init=0xFFFF, Check=0x29B1, same results as _CCITT16_FALSE_TABLE).
+	binascii.crc_hqx implements this exact CRC in C, when started from 0xFFFF.
+	print "CRC test:", pga._computeCRC(b"123456789"), 0x29B1
+
+	:param data: bytes, bytearray or memoryview (a str is encoded first).
+	"""
+	if not isinstance(data, (bytes, bytearray, memoryview)):
+		data = data.encode('latin-1')
+	return binascii.crc_hqx(data, 0xFFFF)
+#
+
+
+def _requireNumpy ():
+	if numpy is None:
+		raise PGAError("NumPy is required for batch processing.")
+
+
+def _computeCRCMatrix (matrix, lengths = None):
 	"""
-	crc = 0xFFFF
+	Table-driven CRC of every row of a 2D uint8 array, processing one byte
+	column for all the rows at a time.
 
-	for char in data:
-		if type(char) is str:
-			c = ord(char)
+	:param matrix: numpy array (rows, width) of uint8.
+	:param lengths: optional array of row lengths (bytes beyond are ignored), all rows are full if None.
+	:return: a numpy array of uint16, one CRC per row.
+	"""
+	table = numpy.array(_CCITT16_FALSE_TABLE, dtype=numpy.uint16)
+	crc = numpy.full(matrix.shape[0], 0xFFFF, dtype=numpy.uint16)
+	for j in range(matrix.shape[1]):
+		nxt = table[(crc >> 8) ^ matrix[:, j]] ^ (crc << 8)
+		if lengths is None:
+			crc = nxt
 		else:
-			c = char
-		tmp = ((crc >> 8) ^ c) & 0xFF
-		crc = (crc << 8) ^ _CCITT16_FALSE_TABLE[tmp]
-	return crc & 0xFFFF
+			crc = numpy.where(lengths > j, nxt, crc)
+	return crc
+
+
+def _computeCRCBatch (buffers):
+	"""
+	Computes the CRC of many buffers at once (table-driven, with _CCITT16_FALSE_TABLE).
+	Requires NumPy.
+
+	:param buffers: a sequence of bytes-like objects.
+	:return: a numpy array of uint16, one CRC per buffer.
+	"""
+	_requireNumpy()
+	lengths = numpy.array([len(b) for b in buffers], dtype=numpy.intp)
+	if len(buffers) == 0:
+		return numpy.zeros(0, dtype=numpy.uint16)
+	width = int(lengths.max())
+	if lengths.min() == width:
+		matrix = numpy.frombuffer(b"".join(buffers), dtype=numpy.uint8).reshape(-1, width)
+		return _computeCRCMatrix(matrix)
+	matrix = numpy.zeros((len(buffers), width), dtype=numpy.uint8)
+	for i, b in enumerate(buffers):
+		matrix[i, :len(b)] = numpy.frombuffer(b, dtype=numpy.uint8)
+	return _computeCRCMatrix(matrix, lengths)
+
+
+def _hexNibbles ():
+	"""Returns a 256 entries table converting an ASCII character into its hexa value (0xFF if not hexa)."""
+	nibbles = numpy.full(256, 0xFF, dtype=numpy.uint16)
+	for i, c in enumerate(b"0123456789ABCDEF"):
+		nibbles[c] = i
+	for i, c in enumerate(b"abcdef"):
+		nibbles[c] = 10 + i
+	return nibbles
+
+
+def validateFrames (frames):
+	"""
+	Checks the CRC of many received frames at once (e.g. from a replayed capture).
+	Each frame is a raw packet as received on the serial port, including its end markers.
+	Frames of the same size are checked together, as rows of a single array.
+	Requires NumPy.
+
+	:param frames: a sequence of bytes-like frames.
+	:return: a numpy array of booleans, True for each frame whose CRC is correct.
+	"""
+	_requireNumpy()
+	valid = numpy.zeros(len(frames), dtype=bool)
+	groups = {}
+	for i, f in enumerate(frames):
+		groups.setdefault(len(f), []).append(i)
+	nibbles = _hexNibbles()
+	for length, rows in groups.items():
+		if length < 8:  # too short, same as Generator._decode
+			continue
+		rows = numpy.array(rows)
+		matrix = numpy.frombuffer(b"".join([frames[i] for i in rows]), dtype=numpy.uint8).reshape(-1, length)
+		# serial.readline() may have turned the final \n into \r\n
+		extraCR = matrix[:, length-3] == 0x0D
+		for mask, end in ((~extraCR, length - 2), (extraCR, length - 3)):
+			if not mask.any():
+				continue
+			sub = matrix[mask]
+			computed = _computeCRCMatrix(sub[:, :end-4])
+			digits = nibbles[sub[:, end-4:end]]
+			# CRC is sent little endian: low byte first
+			received = (digits[:, 0] << 4) | digits[:, 1] | (digits[:, 2] << 12) | (digits[:, 3] << 8)
+			valid[rows[mask]] = (digits != 0xFF).all(axis=1) & (received == computed)
+	return valid
 #
@@ -0,0 +1,520 @@
+# -*- coding: utf-8 -*-
+
+# This module requires Python 3.7+ (asyncio).
+
+"""
+.. xxx module:: pga_async
+   :platform: Windows, Linux
+   :synopsis: asyncio front-end to control the BBBOp/Cube Generator board (PGA)
+
+Mirrors :class:`sdk.pga.Generator` with awaitable methods, so the generator can be driven
+from the same event loop as other devices. It relies on the same packet encoding/decoding,
+only the serial port is read without blocking: answers resolve the future of the command
+waiting for them (matched by command counter), and pulse results are streamed through
+:meth:`AsyncGenerator.pulseResults`::
+
+	gen = AsyncGenerator()
+	gen.loadConfig("sdk/generator.json")
+	await gen.connect(port)
+	await gen.sendSequence(pulses)
+	await gen.executeSequence(execs, 0, ExecFlag.ASYNC_PULSE_RESULT)
+	async for result in gen.pulseResults():
+		...
+"""
+import asyncio
+import os
+import struct
+
+import sdk.pga as pga
+from sdk.pga import Param, PGAError, LogLevel, PulseResult, ExecutionStatus, Output
+
+
+class AsyncGenerator(object):
+	"""asyncio version of :class:`sdk.pga.Generator`."""
+
+	def __init__ (self, loglevel = LogLevel.EVENT, queueSize = 10000, answerTimeout = 5.0):
+		"""
+		Constructor. Creates an instance.
+
+		:param loglevel: the default :class:`LogLevel` to set.
+		:param int queueSize: maximum number of packets kept in each asynchronous queue.
+			The oldest ones are dropped when full.
+		:param float answerTimeout: maximum time to wait for the answer of a command in seconds,
+			None to wait forever. A command whose answer is lost (e.g. bad CRC) then raises a :class:`PGAError`.
+		"""
+		# used for its settings, port, packet encoding/decoding and unit conversions
+		self._gen = pga.Generator(loglevel, answerTimeout = answerTimeout)
+		self._port = self._gen._port
+		self._frames = pga._FrameBuffer()
+		self._loop = None
+		self._pollTask = None
+		self._pending = {}  # command counter -> (command, future)
+		self._queueSize = queueSize
+		self._pulseQueue = None  # asyncio queues, created in connect() (within the running loop)
+		self._eventQueue = None
+		self._initDone = False
+
+
+	def logLevel (self):
+		"""Returns the current log level."""
+		return self._gen.logLevel()
+
+	def setLogLevel (self, level):
+		"""Changes the current log level, see :meth:`sdk.pga.Generator.setLogLevel`."""
+		self._gen.setLogLevel(level)
+
+	def loadConfig (self, fname):
+		"""Loads generator settings from a JSON config file, see :meth:`sdk.pga.Generator.loadConfig`."""
+		self._gen.loadConfig(fname)
+
+	def generator (self):
+		"""Returns the underlying :class:`sdk.pga.Generator`, e.g. for its convert* methods."""
+		return self._gen
+
+
+	async def connect (self, port = None, warm = False):
+		"""
+		Opens the serial port and initializes the generator, see :meth:`sdk.pga.Generator.connect`.
+		The reset delay and all the exchanges are awaited, they never block the event loop.
+
+		:param port: the name of the port to use, None to use the one from the config file.
+		:param bool warm: if True, the board is only reset if it does not answer.
+		:raise: PGAError on error, the port is closed again
+		"""
+		gen = self._gen
+		gen._openPort (port)
+		self._loop = asyncio.get_running_loop()
+		self._pulseQueue = asyncio.Queue(self._queueSize)
+		self._eventQueue = asyncio.Queue(self._queueSize)
+		gen.clearParameterCache()
+		gen._sequence = None
+		gen._cmdCounter = 1
+		gen._execCounter = 1
+		self._initDone = False
+		try:
+			self._startReader()
+			await self._init (warm)
+		except BaseException:
+			# also on cancellation: do not leave the reader registered on an open port
+			self._stopReader()
+			self._port.close()
+			raise
+		gen._lastPort = self._port.port
+		return True
+
+
+	async def _init (self, warm):
+		"""Probes or resets the board, then writes the config parameters (port opened by connect)."""
+		gen = self._gen
+		fwversion = None
+		if warm:
+			self._port.flushInput()
+			self._frames.clear()
+			fwversion = await self._probe()
+			if fwversion is None:
+				gen._log(LogLevel.VERBOSE, "Generator is not answering, it will be reset.")
+			else:
+				gen._paramCache[Param.FIRMWARE_VERSION] = fwversion
+		if fwversion is None:
+			await self.resetBoard()
+			fwversion = await self.readParameter (Param.FIRMWARE_VERSION)
+		gen._protocolVersion = fwversion >> 24
+		if warm:
+			await self.stopSequence()
+
+		if gen._config:
+			names, values = gen._configParameters()
+			params = list(values.keys())
+			results = await self._gather([lambda p=p: self.writeParameter(p, values[p]) for p in params])
+			errors = ["Failed to init parameter %s: %s" % (names[p], r) for p, r in zip(params, results) if r is not None]
+			if errors:
+				gen._throw("; ".join(errors))
+			self._initDone = True
+
+
+	async def disconnect (self):
+		"""Stops any execution, disables the amplifier and closes the port."""
+		if self._port.isOpen():
+			if self._initDone:
+				try:
+					await self.stopSequence()
+					await self.enableAmplifier (False)
+				except PGAError:
+					pass
+			self._stopReader()
+			self._port.close()
+		self._initDone = False
+
+
+	async def resetBoard (self):
+		"""Forces a hardware reset of the board, awaiting (about 6 s) until it has restarted."""
+		gen = self._gen
+		gen._log(LogLevel.VERBOSE, "Generator board init, please wait %g s..." % (gen._RESET_TIME + gen._RESET_PULSE))
+		gen.enableBoard (False)
+		await asyncio.sleep (gen._RESET_PULSE)
+		gen.enableBoard (True)
+		await asyncio.sleep (gen._RESET_TIME)
+		self._port.flushInput()
+		self._frames.clear()
+		gen.clearParameterCache()
+		gen._sequence = None
+
+
+	async def readParameter (self, param, useCache = True, timeout = None):
+		"""
+		Reads the value of a generator parameter, see :meth:`sdk.pga.Generator.readParameter`.
+
+		:param float timeout: maximum time to wait for the answer in seconds, answerTimeout if None.
+		"""
+		gen = self._gen
+		if param < Param.FIRST or param > Param.LAST:
+			gen._throw("Parameter index out of range (%d)" % param)
+		cacheable = Param.DEFAULTS[param].cacheable
+		if cacheable:
+			if useCache and param in gen._paramCache:
+				gen._cacheHits += 1
+				return gen._paramCache[param]
+			gen._cacheMisses += 1
+		answer = await self._transact (gen._CMD_PARAM_GET, struct.pack ("<I", Param.DEFAULTS[param].id), timeout)
+		value = struct.unpack ("<II", answer)[1]  # ignore cc
+		if cacheable:
+			gen._paramCache[param] = value
+		return value
+
+
+	async def readParameters (self, params, depth = 8):
+		"""
+		Reads several parameters concurrently.
+
+		:param int depth: maximum number of requests in flight, as for :meth:`sdk.pga.Generator.readParameters`.
+		:return: a tuple (values, errors), see :meth:`sdk.pga.Generator.readParameters`.
+		"""
+		params = list(params)
+		results = await self._gather([lambda p=p: self.readParameter(p) for p in params], depth)
+		values = dict((p, r) for p, r in zip(params, results) if not isinstance(r, Exception))
+		errors = dict((p, str(r)) for p, r in zip(params, results) if isinstance(r, Exception))
+		return (values, errors)
+
+
+	async def writeParameter (self, param, value):
+		"""Changes the value of a generator parameter, see :meth:`sdk.pga.Generator.writeParameter`."""
+		gen = self._gen
+		if param < Param.FIRST or param > Param.LAST:
+			gen._throw("Parameter index out of range (%d)" % param)
+		if not Param.DEFAULTS[param].editable:
+			gen._throw("This parameter is not editable.")
+		value = int(value)  # raise on unexpected type
+		gen._paramCache.pop(param, None)
+		await self._transact (gen._CMD_PARAM_SET, struct.pack ("<II", Param.DEFAULTS[param].id, value))
+
+
+	async def clearSequence (self):
+		await self.sendSequence ([])
+
+
+	async def sendSequence (self, sequence):
+		"""
+		Sends a sequence definition (install it into the generator's buffer).
+
+		:param sequence: a list of :class:`sdk.pga.Pulse` objects, or the same already packed by :func:`sdk.pga.packSequence`.
+		"""
+		if not isinstance(sequence, bytes):
+			sequence = pga.packSequence (sequence)
+		self._gen._sequence = None  # unknown until acknowledged
+		await self._transact (self._gen._CMD_SEQUENCE_SEND, sequence)
+		self._gen._sequence = sequence
+
+
+	async def updateSequence (self, sequence):
+		"""Uploads a sequence only if it changed, see :meth:`sdk.pga.Generator.updateSequence`."""
+		if not isinstance(sequence, bytes):
+			sequence = pga.packSequence (sequence)
+		if sequence == self._gen._sequence:
+			return False
+		await self.sendSequence (sequence)
+		return True
+
+
+	def sequenceFingerprint (self):
+		"""See :meth:`sdk.pga.Generator.sequenceFingerprint`."""
+		return self._gen.sequenceFingerprint()
+
+
+	async def executeSequence (self, execs = 1, delay = 0, flags = 0):
+		"""Starts one or more executions of the current sequence, see :meth:`sdk.pga.Generator.executeSequence`."""
+		await self._transact (self._gen._CMD_SEQUENCE_EXECUTE, self._gen._executeData (execs, delay, flags))
+
+
+	async def stopSequence (self):
+		"""Stops the execution of the current sequence (if any)."""
+		await self._transact (self._gen._CMD_SEQUENCE_STOP)
+
+
+	async def readExecutionStatus (self):
+		"""
+		Returns information about the currently executed sequence (or the last one).
+
+		:return: an :class:`sdk.pga.ExecutionStatus` object.
+		"""
+		answer = await self._transact (self._gen._CMD_EXEC_STATUS_READ)
+		return ExecutionStatus (self._gen._protocolVersion, answer)
+
+
+	async def readPulseMeasure (self):
+		"""
+		Returns information about the last measured pulse.
+
+		:return: a :class:`sdk.pga.PulseResult` object.
+		"""
+		answer = await self._transact (self._gen._CMD_PULSE_MEASURE_READ)
+		return PulseResult (self._gen._protocolVersion, answer[4:])  # ignore the cmd counter
+
+
+	async def readAsyncPulse (self, timeout = None):
+		"""
+		Waits for the next asynchronous pulse result, sent by the executeSequence command.
+
+		:param float timeout: maximum time to wait in seconds, None to wait forever.
+		:return: a :class:`sdk.pga.PulseResult` object.
+		:raises: :class:`PGAError` on timeout, or if an event was received before the next result.
+		"""
+		try:
+			answer = await asyncio.wait_for (self._pulseQueue.get(), timeout)
+		except asyncio.TimeoutError:
+			self._gen._throw ("Timeout while waiting for a pulse result.")
+		if isinstance(answer, pga._AsyncEvent):
+			self._gen._throw (answer.msg)
+		return PulseResult (self._gen._protocolVersion, answer)
+
+
+	async def pulseResults (self, count = None, timeout = None):
+		"""
+		Asynchronous iterator over the pulse results, as they arrive::
+
+			async for result in gen.pulseResults(nbPulses):
+				...
+
+		:param int count: number of results to wait for, None for no limit.
+		:param float timeout: maximum time to wait for each result in seconds, None to wait forever.
+		:raises: :class:`PGAError` on timeout, or when an event interrupts the execution.
+		"""
+		n = 0
+		while count is None or n < count:
+			yield await self.readAsyncPulse (timeout)
+			n += 1
+
+
+	async def readEvent (self, timeout = None):
+		"""
+		Waits for the next event (system event or asynchronous error).
+
+		:return: a tuple (command, code, value, message), see :meth:`sdk.pga.Generator.readEvent`.
+		"""
+		try:
+			return await asyncio.wait_for (self._eventQueue.get(), timeout)
+		except asyncio.TimeoutError:
+			self._gen._throw ("Timeout while waiting for an event.")
+
+
+	async def enableAmplifier (self, state):
+		"""
+		Enables or disables the amplifier power supply.
+
+		:param bool state: True to enable, False to disable.
+		"""
+		await self._transact (self._gen._CMD_AMPLI_POWER_ENABLE, struct.pack ("<I", 1 if state else 0))
+
+
+	async def isAmplifierEnabled (self):
+		"""Tells if the amplifier power supply is enabled or not."""
+		answer = await self._transact (self._gen._CMD_AMPLI_POWER_ENABLE)
+		return struct.unpack ("<II", answer)[1] == 1  # ignore cmd counter
+
+
+	async def selectOutput (self, output):
+		"""
+		Selects which generator output to use.
+
+		:param int output: :attr:`Output.INTERNAL` or :attr:`Output.EXTERNAL`.
+		"""
+		if output != Output.INTERNAL and output != Output.EXTERNAL:
+			self._gen._throw ("Invalid output value.")
+		await self._transact (self._gen._CMD_AMPLI_OUTPUT, struct.pack ("<I", output))
+
+
+	async def output (self):
+		"""Tells which output is currently used to emit ultrasounds."""
+		answer = await self._transact (self._gen._CMD_AMPLI_OUTPUT)
+		return struct.unpack ("<II", answer)[1]  # ignore cmd counter
+
+	#------------------------------------------------------------------------
+	# end of user commands
+
+	async def _transact (self, cmd, data = b"", timeout = None):
+		"""
+		Sends one command and awaits its answer, routed back by command counter.
+
+		:param float timeout: maximum time to wait for the answer in seconds, answerTimeout if None.
+		:return: the data received (without command and CRC)
+		:raises: :class:`PGAError` on errors or timeout.
+		"""
+		if timeout is None:
+			timeout = self._gen._answerTimeout
+		cc, future = self._request (cmd, data)
+		try:
+			return await asyncio.wait_for (future, timeout)
+		except asyncio.TimeoutError:
+			self._gen._throw ("Timeout while waiting for '%s'." % cmd)
+		finally:
+			self._pending.pop(cc, None)
+
+
+	def _request (self, cmd, data = b""):
+		"""
+		Sends one command, registered as waiting for its answer.
+
+		:return: a tuple (command counter, future receiving the answer).
+		"""
+		gen = self._gen
+		cc = gen._nextCommandCounter()
+		future = self._loop.create_future()
+		self._pending[cc] = (cmd, future)
+		try:
+			gen._send (gen._encode (cmd, data, cc))
+		except:
+			del self._pending[cc]
+			raise
+		return (cc, future)
+
+
+	async def _probe (self, timeout = 0.5):
+		"""
+		Checks whether a running board answers, by reading its firmware version.
+
+		:return: the firmware version, or None if the board did not answer in time.
+		"""
+		gen = self._gen
+		cc, future = self._request (gen._CMD_PARAM_GET, struct.pack ("<I", Param.DEFAULTS[Param.FIRMWARE_VERSION].id))
+		try:
+			answer = await asyncio.wait_for (future, timeout)
+			return struct.unpack ("<II", answer)[1]
+		except (asyncio.TimeoutError, PGAError):
+			return None
+		finally:
+			self._pending.pop(cc, None)
+
+
+	async def _gather (self, calls, depth = 8):
+		"""
+		Awaits coroutine functions concurrently, at most depth of them at a time: the
+		command queue of the firmware is finite.
+
+		:return: their results in order, an exception in place of the result of a failed call.
+		"""
+		window = asyncio.Semaphore (depth)
+		async def bounded (call):
+			async with window:
+				return await call()
+		return await asyncio.gather(*[bounded(c) for c in calls], return_exceptions=True)
+
+
+	def _startReader (self):
+		"""
+		Starts watching the port: on POSIX the event loop calls back as soon as bytes
+		are available, otherwise (Windows) a task polls the port every millisecond.
+		"""
+		self._port.timeout = 0  # non-blocking reads
+		if os.name == "posix":
+			self._loop.add_reader (self._port.fileno(), self._onReadable)
+		else:
+			self._pollTask = self._loop.create_task (self._poll())
+
+
+	def _stopReader (self):
+		if self._loop is None:
+			return
+		if self._pollTask is not None:
+			self._pollTask.cancel()
+			self._pollTask = None
+		elif self._port.isOpen():
+			self._loop.remove_reader (self._port.fileno())
+		for _, future in self._pending.values():
+			if not future.done():
+				future.set_exception (PGAError("Port closed."))
+		self._pending.clear()
+
+
+	async def _poll (self):
+		while True:
+			if self._port.in_waiting:
+				self._onReadable()
+			else:
+				await asyncio.sleep (0.001)
+
+
+	def _onReadable (self):
+		"""Reads all the bytes available, and dispatches every complete frame."""
+		try:
+			chunk = self._port.read (max(1, self._port.in_waiting))
+		except Exception as ex:
+			self._gen._log(LogLevel.ERROR, "Can not read serial port: " + str(ex))
+			self._stopReader()
+			return
+		self._frames.feed (chunk)
+		while True:
+			frame = self._frames.nextFrame()
+			if frame is None:
+				return
+			self._dispatch (frame)
+
+
+	def _dispatch (self, frame):
+		"""Same routing as :meth:`sdk.pga.Generator._dispatch`, with futures and asyncio queues."""
+		gen = self._gen
+		gen._log(LogLevel.PACKET, "RECV: "+repr(frame))
+		try:
+			cmd, data, _ = gen._decode (frame)
+		except PGAError:
+			return  # already logged
+		if gen._shortPacket (cmd, data):
+			return
+
+		if cmd == gen._CMD_PULSE_MEASURE_ASYNC:
+			self._enqueue (self._pulseQueue, data)
+		elif cmd == gen._CMD_EVENT_ASYNC:
+			msg = gen._errorMessage((cmd, data))
+			gen._log(LogLevel.EVENT, msg)
+			errcode, _, errvalue = pga._ERROR_PAYLOAD.unpack_from (data)
+			self._enqueue (self._eventQueue, (cmd, errcode, errvalue, msg))
+			self._enqueue (self._pulseQueue, pga._AsyncEvent(msg))
+		elif cmd == gen._CMD_DEBUG:
+			gen._log(LogLevel.INFO, "Generator: tstamp=%d, mask=%d, len=%d, msg=" % pga._DEBUG_HEADER.unpack_from (data) + bytes(data[14:]).decode('charmap'))
+		elif cmd == gen._CMD_EXEC_STATUS_ASYNC or len(data) < 4:
+			gen._log(LogLevel.VERBOSE, "Ignoring '%s' async packet." % cmd)
+		else:
+			cc = struct.unpack_from ("<I", data)[0]
+			expected, future = self._pending.get(cc, (None, None))
+			if future is None or future.done():
+				if cmd == gen._CMD_ERROR:
+					msg = gen._errorMessage((cmd, data))
+					gen._log(LogLevel.ERROR, msg)
+					errcode, errvalue = struct.unpack_from ("<II", data, 4)
+					self._enqueue (self._eventQueue, (cmd, errcode, errvalue, msg))
+				else:
+					gen._log(LogLevel.VERBOSE, "Ignoring '%s' answer without pending command (cc=%d)." % (cmd, cc))
+			elif cmd == gen._CMD_ERROR:
+				msg = gen._errorMessage((cmd, data))
+				gen._log(LogLevel.ERROR, msg)
+				future.set_exception (PGAError(msg))
+			elif cmd != expected:
+				future.set_exception (PGAError("Unexpected command received (%s, expected: %s)" % (cmd, expected)))
+			else:
+				future.set_result (data)
+
+
+	def _enqueue (self, q, item):
+		"""Puts an item in a bounded queue, dropping the oldest one if full."""
+		if q.full():
+			q.get_nowait()
+			self._gen._log(LogLevel.VERBOSE, "Asynchronous queue full, oldest packet dropped.")
+		q.put_nowait (item)
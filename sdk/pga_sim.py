@@ -0,0 +1,576 @@
+# -*- coding: utf-8 -*-
+
+# This module requires Python 3.
+
+"""
+.. xxx module:: pga_sim
+   :platform: Linux (pty transport), any (in-process port)
+   :synopsis: Software stand-in for the BBBOp/Cube Generator board (PGA)
+
+Speaks the same ASCII hexa + CRC protocol as the board (see :mod:`sdk.pga`): parameters,
+sequences upload and execution, status and pulse measures, amplifier and output
+selection, asynchronous pulse results, events, debug messages and errors.
+It can be reached in two ways:
+
+- through a pseudo-terminal, like a real serial port (Linux only)::
+
+	sim = Simulator(pulseRate=20000)
+	device = sim.openPty()
+	gen.connect(device, warm=True)  # a pty has no RTS line, so no hardware reset
+
+- through an in-process serial port object, which also emulates the reset line::
+
+	sim = Simulator()
+	sim.attach(gen)                 # also works for FUS_GEN.igt_system
+	gen.autoConnect()
+
+:class:`sdk.pga_async.AsyncGenerator` needs a file descriptor to watch, so use the pty.
+It can also run on its own, as a pty for another process: ``python -m sdk.pga_sim``.
+"""
+import binascii
+import os
+import random
+import struct
+import threading
+import time
+
+import sdk.pga as pga
+from sdk.pga import Param, ExecFlag, Output
+
+
+_CMD_SIZE = 2
+_NO_EXEC = 0xFFFFFFFF  # execution index when nothing runs
+
+
+class Simulator(object):
+	"""
+	Simulated generator board. Commands are processed as soon as they are received,
+	executions run in a background thread which emits the asynchronous pulse results.
+	"""
+
+	FIRMWARE_VERSION = 0x02010000
+	"""Default firmware version, its first byte is the protocol version."""
+
+	# constant measures returned in the execution status
+	_TEMPERATURE_ADC = 2500
+	_CURRENT_ADC = 300
+	_VOLTAGE_ADC = 2000
+
+	def __init__ (self, firmwareVersion = FIRMWARE_VERSION, pulseRate = None, timeScale = 1.0,
+			crcErrorRate = 0.0, eventEvery = None, eventCode = 222, seed = 0):
+		"""
+		:param int firmwareVersion: value of the FIRMWARE_VERSION parameter, protocol 1 and 2 are supported.
+		:param float pulseRate: pulses per second during executions, None to follow the sequence timing.
+		:param float timeScale: factor applied to the sequence timing (if pulseRate is None), 0 to run as fast as possible.
+		:param float crcErrorRate: probability of sending a frame with a wrong CRC, in [0, 1].
+		:param int eventEvery: if set, a system event is sent after every eventEvery pulses.
+		:param int eventCode: code of the events sent because of eventEvery.
+		:param int seed: seed of the random generator (measure noise, CRC errors).
+		"""
+		self.firmwareVersion = firmwareVersion
+		self.protocolVersion = firmwareVersion >> 24
+		self.pulseRate = pulseRate
+		self.timeScale = timeScale
+		self.crcErrorRate = crcErrorRate
+		self.eventEvery = eventEvery
+		self.eventCode = eventCode
+		self._random = random.Random(seed)
+
+		self._lock = threading.RLock()      # board state
+		self._writeLock = threading.Lock()  # output, shared by the commands and the execution thread
+		self._write = None                  # transport output, bytes -> None
+		self._frames = pga._FrameBuffer()
+		self._execThread = None
+		self._execStop = threading.Event()
+		self._pty = None                    # (master, slave, thread) once openPty was called
+		self._startTime = time.time()
+		self._counters = {}
+		self.boot()
+
+	#------------------------------------------------------------------------
+	# board state
+
+	def boot (self):
+		"""Restarts the board: stops any execution, and restores the default state."""
+		self._stopExecution()
+		with self._lock:
+			self._params = dict((p.id, p.defaultValue) for p in Param.DEFAULTS.values())
+			self._params[Param.DEFAULTS[Param.FIRMWARE_VERSION].id] = self.firmwareVersion
+			self._editable = set(p.id for p in Param.DEFAULTS.values() if p.editable)
+			self._sequence = []
+			self._amplifier = False
+			self._output = Output.INTERNAL
+			self._halted = False
+			self._execIndex = _NO_EXEC
+			self._pulseIndex = 0
+			self._execID = 0
+			self._lastPulse = None
+			self._frames.clear()
+		self._counters = {"framesIn": 0, "framesOut": 0, "badFrames": 0, "pulses": 0, "crcErrors": 0, "events": 0}
+
+
+	def halt (self):
+		"""Holds the board in reset (reset pin active): nothing is processed until :meth:`boot`."""
+		self._stopExecution()
+		with self._lock:
+			self._halted = True
+
+
+	def stats (self):
+		"""
+		Returns the simulator counters: frames received and sent, received frames
+		rejected (bad CRC, bad characters), pulse results and events sent, CRC errors injected.
+
+		:return: a dict.
+		"""
+		return dict(self._counters)
+
+	#------------------------------------------------------------------------
+	# transports
+
+	def attach (self, generator, fastReset = True):
+		"""
+		Replaces the serial port of a :class:`sdk.pga.Generator` by an in-process port
+		connected to this simulator. The generator must not be connected.
+		:meth:`sdk.pga.Generator.autoConnect` then tries this port first.
+
+		:param generator: the :class:`sdk.pga.Generator` to attach.
+		:param bool fastReset: if True, the generator waits a few milliseconds only after a reset.
+		:return: the :class:`SimulatedPort`.
+		"""
+		port = SimulatedPort(self)
+		generator._setPort (port)
+		generator._lastPort = port.port
+		if fastReset:
+			generator._RESET_PULSE = 0.001
+			generator._RESET_TIME = 0.01
+		return port
+
+
+	def openPty (self):
+		"""
+		Creates a pseudo-terminal serving this simulator (Linux only).
+		It has no modem lines, so connect with ``warm=True``: the board is never reset.
+
+		:return: the device name of the terminal to open, e.g. "/dev/pts/3".
+		"""
+		import tty
+		master, slave = os.openpty()
+		tty.setraw (slave)
+		thread = threading.Thread(target=self._ptyLoop, args=(master,), name="pga-sim-pty")
+		thread.daemon = True
+		self._pty = (master, slave, thread)
+		self._write = lambda data: os.write (master, data)
+		thread.start()
+		return os.ttyname (slave)
+
+
+	def close (self):
+		"""Stops any execution, and closes the pseudo-terminal (if any)."""
+		self._stopExecution()
+		if self._pty is not None:
+			master, slave, thread = self._pty
+			self._pty = None
+			self._write = None
+			os.close (slave)
+			os.close (master)
+			thread.join (1.0)
+
+
+	def _ptyLoop (self, master):
+		while True:
+			try:
+				data = os.read (master, 4096)
+			except OSError:
+				return  # closed
+			if not data:
+				return
+			self.receive (data)
+
+
+	def receive (self, data):
+		"""Processes bytes sent by the host (called by the transports)."""
+		with self._lock:
+			if self._halted:
+				return
+			self._frames.feed (data)
+			while True:
+				frame = self._frames.nextFrame()
+				if frame is None:
+					break
+				self._counters["framesIn"] += 1
+				self._handleFrame (frame)
+
+	#------------------------------------------------------------------------
+	# injection
+
+	def injectEvent (self, code, value = 0, index = 0):
+		"""Sends a system event ("sy" packet)."""
+		self._counters["events"] += 1
+		self._send ("sy", struct.pack ("<III", code, index, value))
+
+
+	def injectError (self, code, value = 0, stop = True):
+		"""
+		Sends an asynchronous error ("ko" packet, command counter 0), e.g. a security threshold override.
+
+		:param bool stop: if True, the current execution (if any) is stopped, as the board does.
+		"""
+		if stop:
+			self._stopExecution()
+		self._counters["events"] += 1
+		self._send ("ko", struct.pack ("<III", 0, code, value))
+
+
+	def injectDebug (self, text, mask = 1):
+		"""Sends a debug message ("dg" packet)."""
+		text = text.encode ("charmap") + b"\0"
+		tstamp = int((time.time() - self._startTime) * 1e6)
+		self._send ("dg", pga._DEBUG_HEADER.pack (tstamp, mask, len(text)) + text)
+
+	#------------------------------------------------------------------------
+	# protocol
+
+	def _frame (self, cmd, payload, badCRC = False):
+		hdata = cmd.encode() + binascii.hexlify(payload).upper()
+		crc = pga._computeCRC (hdata)
+		if badCRC:
+			crc ^= 0x0001
+		return hdata + binascii.hexlify(pga._CRC_FIELD.pack(crc)).upper() + b"\r\n"
+
+
+	def _send (self, cmd, payload):
+		badCRC = self.crcErrorRate > 0 and self._random.random() < self.crcErrorRate
+		if badCRC:
+			self._counters["crcErrors"] += 1
+		frame = self._frame (cmd, payload, badCRC)
+		with self._writeLock:
+			if self._write is None:
+				return  # nobody listening
+			self._write (frame)
+			self._counters["framesOut"] += 1
+
+
+	def _answer (self, cmd, cc, payload = b""):
+		self._send (cmd, struct.pack ("<I", cc) + payload)
+
+
+	def _error (self, cc, code, value = 0):
+		self._send ("ko", struct.pack ("<III", cc, code, value))
+
+
+	def _handleFrame (self, frame):
+		end = len(frame) - 2
+		if frame[-3:] == b"\r\r\n":
+			end -= 1
+		if end < _CMD_SIZE + 8 + 4:
+			self._counters["badFrames"] += 1
+			self._error (0, 100, len(frame))
+			return
+		try:
+			raw = binascii.unhexlify (frame[_CMD_SIZE:end])
+		except (binascii.Error, ValueError):
+			self._counters["badFrames"] += 1
+			self._error (0, 101, pga._badHexIndex (frame, _CMD_SIZE, end))
+			return
+		cc = struct.unpack_from ("<I", raw)[0]
+		if pga._CRC_FIELD.unpack_from (raw, len(raw) - 2)[0] != pga._computeCRC (frame[:end-4]):
+			self._counters["badFrames"] += 1
+			self._error (cc, 102)
+			return
+		cmd = frame[:_CMD_SIZE].decode ("charmap")
+		handler = self._HANDLERS.get (cmd)
+		if handler is None:
+			self._error (cc, 110)
+			return
+		handler (self, cc, raw[4:-2])
+
+
+	def _executing (self):
+		return self._execThread is not None and self._execThread.is_alive()
+
+
+	def _paramGet (self, cc, data):
+		if len(data) != 4:
+			return self._error (cc, 111, len(data))
+		pid = struct.unpack ("<I", data)[0]
+		if pid not in self._params:
+			return self._error (cc, 124, pid)
+		self._answer ("gp", cc, struct.pack ("<I", self._params[pid]))
+
+
+	def _paramSet (self, cc, data):
+		if len(data) != 8:
+			return self._error (cc, 111, len(data))
+		pid, value = struct.unpack ("<II", data)
+		if pid not in self._params:
+			return self._error (cc, 124, pid)
+		if pid not in self._editable:
+			return self._error (cc, 112, 0)
+		if self._executing():
+			return self._error (cc, 123)
+		self._params[pid] = value
+		self._answer ("sp", cc)
+
+
+	def _sequenceSend (self, cc, data):
+		if len(data) < 4:
+			return self._error (cc, 111, len(data))
+		count = struct.unpack_from ("<I", data)[0]
+		if len(data) != 4 + 16 * count:
+			return self._error (cc, 111, len(data))
+		if count > self._params[Param.DEFAULTS[Param.PULSE_COUNT_MAX].id]:
+			return self._error (cc, 112, 0)
+		if self._executing():
+			return self._error (cc, 123)
+		# each pulse: amplitude, frequency, duration, delay
+		self._sequence = [struct.unpack_from ("<IIII", data, 4 + 16 * i) for i in range(count)]
+		self._answer ("ws", cc)
+
+
+	def _sequenceExecute (self, cc, data):
+		if self.protocolVersion < 2:
+			if len(data) != 12:
+				return self._error (cc, 111, len(data))
+			execs, delay, flags = struct.unpack ("<III", data)
+			execID = 0
+		else:
+			if len(data) != 14:
+				return self._error (cc, 111, len(data))
+			execs, delay, flags, execID = struct.unpack ("<IIIH", data)
+		if self._executing():
+			return self._error (cc, 123)
+		if not self._sequence:
+			return self._error (cc, 120)
+		if execs == 0:
+			return self._error (cc, 112, 0)
+		self._answer ("xs", cc)
+		self._execStop.clear()
+		self._execIndex, self._pulseIndex, self._execID = 0, 0, execID
+		self._execThread = threading.Thread(target=self._run,
+			args=(list(self._sequence), execs, delay, flags, execID), name="pga-sim-exec")
+		self._execThread.daemon = True
+		self._execThread.start()
+
+
+	def _sequenceStop (self, cc, data):
+		self._stopExecution()
+		self._answer ("st", cc)
+
+
+	def _execStatusRead (self, cc, data):
+		self._answer ("rs", cc, self._statusPayload())
+
+
+	def _pulseMeasureRead (self, cc, data):
+		payload = self._lastPulse
+		if payload is None:
+			payload = self._pulsePayload (_NO_EXEC, 0, 0, 0, 0, 0)
+		self._answer ("mp", cc, payload)
+
+
+	def _amplifierPower (self, cc, data):
+		if len(data) == 4:
+			self._amplifier = struct.unpack ("<I", data)[0] != 0
+			return self._answer ("ap", cc)
+		self._answer ("ap", cc, struct.pack ("<I", 1 if self._amplifier else 0))
+
+
+	def _amplifierOutput (self, cc, data):
+		if len(data) == 4:
+			output = struct.unpack ("<I", data)[0]
+			if output not in (Output.INTERNAL, Output.EXTERNAL):
+				return self._error (cc, 112, 0)
+			if self._executing():
+				return self._error (cc, 123)
+			self._output = output
+			return self._answer ("od", cc)
+		self._answer ("od", cc, struct.pack ("<I", self._output))
+
+
+	_HANDLERS = {
+		"gp": _paramGet,
+		"sp": _paramSet,
+		"ws": _sequenceSend,
+		"xs": _sequenceExecute,
+		"st": _sequenceStop,
+		"rs": _execStatusRead,
+		"mp": _pulseMeasureRead,
+		"ap": _amplifierPower,
+		"od": _amplifierOutput,
+	}
+
+
+	def _statusPayload (self):
+		status = 0 if self._amplifier else (1 << 1)  # "Amplifier power supply disabled"
+		if self.protocolVersion < 2:
+			return struct.pack ("<IIIIII", self._execIndex, self._pulseIndex, status,
+				self._TEMPERATURE_ADC, self._CURRENT_ADC, self._VOLTAGE_ADC)
+		return struct.pack ("<IHHIIII", self._execIndex, self._pulseIndex, self._execID, status,
+			self._TEMPERATURE_ADC, self._CURRENT_ADC, self._VOLTAGE_ADC)
+
+
+	def _pulsePayload (self, execIndex, pulseIndex, execID, duration, fwd, rev):
+		if self.protocolVersion < 2:
+			return pga._PULSE_RESULT_V1.pack (execIndex, pulseIndex, duration, fwd, rev)
+		return pga._PULSE_RESULT_V2.pack (execIndex, pulseIndex, execID, duration, fwd, rev)
+
+	#------------------------------------------------------------------------
+	# execution
+
+	def _run (self, sequence, execs, delay, flags, execID):
+		"""Execution thread: emits the pulses at the requested pace, until done or stopped."""
+		# TRIM_RESULTS_1000 sets both the _10 and _100 bits: compare the whole field
+		trim = {
+			ExecFlag.TRIM_RESULTS_10: 10,
+			ExecFlag.TRIM_RESULTS_100: 100,
+			ExecFlag.TRIM_RESULTS_1000: 1000,
+		}.get(flags & ExecFlag.TRIM_RESULTS_1000, 1)
+		sendResults = (flags & ExecFlag.ASYNC_PULSE_RESULT) != 0
+		deadline = time.perf_counter()
+		for e in range(execs):
+			for i, (ampl, freq, dura, dela) in enumerate(sequence):
+				if self.pulseRate is not None:
+					period = 1.0 / self.pulseRate if self.pulseRate > 0 else 0.0
+				else:
+					period = (dura + dela) * 1e-6 * self.timeScale
+				deadline += period
+				remaining = deadline - time.perf_counter()
+				if remaining > 0.0005 and self._execStop.wait (remaining):
+					return
+				if self._execStop.is_set():
+					return
+				fwd = min(0xFFFF, ampl * 3 + self._random.randint(0, 8)) if self._amplifier else 0
+				payload = self._pulsePayload (e, i, execID, dura, fwd, fwd // 25)
+				# not under _lock: _stopExecution waits for this thread while holding it
+				self._execIndex, self._pulseIndex = e, i
+				self._lastPulse = payload
+				self._counters["pulses"] += 1
+				if sendResults and (e + 1) % trim == 0:
+					self._send ("pm", payload)
+				if self.eventEvery and self._counters["pulses"] % self.eventEvery == 0:
+					self.injectEvent (self.eventCode, 0, i)
+			if self.pulseRate is None:
+				deadline += delay * 1e-6 * self.timeScale
+		self._execIndex = _NO_EXEC
+		if flags & ExecFlag.ASYNC_EXECUTION_RESULT:
+			self._send ("es", self._statusPayload())
+
+
+	def _stopExecution (self):
+		thread = self._execThread
+		if thread is not None:
+			self._execStop.set()
+			if thread is not threading.current_thread():
+				thread.join()
+			self._execThread = None
+		self._execIndex = _NO_EXEC
+
+
+class SimulatedPort(object):
+	"""
+	In-process stand-in for a serial.Serial connected to a :class:`Simulator`.
+	Implements what :class:`sdk.pga.Generator` uses: settings, open/close, read/write,
+	in_waiting, flushInput and the RTS line (which resets the simulated board).
+	"""
+
+	def __init__ (self, simulator, name = "pga-sim"):
+		self.port = name
+		self.baudrate = 460800
+		self.bytesize = 8
+		self.parity = "N"
+		self.stopbits = 1
+		self.xonxoff = False
+		self.rtscts = False
+		self.timeout = 0.1
+		self._sim = simulator
+		self._open = False
+		self._rts = False
+		self._buffer = bytearray()
+		self._ready = threading.Condition()
+		simulator._write = self._feed
+
+	def _feed (self, data):
+		with self._ready:
+			self._buffer += data
+			self._ready.notify_all()
+
+	def open (self):
+		self._open = True
+
+	def close (self):
+		self._open = False
+
+	def isOpen (self):
+		return self._open
+
+	@property
+	def is_open (self):
+		return self._open
+
+	@property
+	def in_waiting (self):
+		return len(self._buffer)
+
+	def read (self, size = 1):
+		with self._ready:
+			if not self._buffer and self.timeout != 0:
+				self._ready.wait (self.timeout)
+			data = bytes(self._buffer[:size])
+			del self._buffer[:size]
+		return data
+
+	def write (self, data):
+		if not self._open:
+			raise IOError("Port not open")
+		self._sim.receive (bytes(data))
+		return len(data)
+
+	def flushInput (self):
+		with self._ready:
+			del self._buffer[:]
+
+	reset_input_buffer = flushInput
+
+	def flushOutput (self):
+		pass
+
+	reset_output_buffer = flushOutput
+
+	def setDTR (self, level = True):
+		pass
+
+	def setRTS (self, level = True):
+		"""The reset pin of the board: active (held in reset) when RTS is set."""
+		if level and not self._rts:
+			self._sim.halt()
+		elif not level and self._rts:
+			self._sim.boot()
+		self._rts = level
+
+
+def main ():
+	import argparse
+	parser = argparse.ArgumentParser(description="Simulated PGA generator on a pseudo-terminal.")
+	parser.add_argument("--rate", type=float, default=None, help="pulses per second (default: sequence timing)")
+	parser.add_argument("--time-scale", type=float, default=1.0, help="factor applied to the sequence timing, 0 for no wait")
+	parser.add_argument("--crc-errors", type=float, default=0.0, help="probability of a wrong CRC per frame sent")
+	parser.add_argument("--event-every", type=int, default=None, help="sends a system event every N pulses")
+	parser.add_argument("--protocol", type=int, default=2, choices=(1, 2), help="protocol version")
+	args = parser.parse_args()
+
+	sim = Simulator(firmwareVersion=(args.protocol << 24) | (Simulator.FIRMWARE_VERSION & 0xFFFFFF),
+		pulseRate=args.rate, timeScale=args.time_scale, crcErrorRate=args.crc_errors, eventEvery=args.event_every)
+	print("Simulated generator on %s (connect with warm=True), Ctrl-C to stop." % sim.openPty())
+	try:
+		while True:
+			time.sleep (1)
+	except KeyboardInterrupt:
+		pass
+	finally:
+		sim.close()
+		print(sim.stats())
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,271 @@
+# -*- coding: utf-8 -*-
+
+"""
+.. xxx module:: serial_capture
+   :platform: Windows, Linux
+   :synopsis: Recording and replay of serial port traffic
+
+A :class:`CapturePort` wraps an open serial port and appends every chunk of bytes read
+or written to a capture file, with a monotonic timestamp and its direction.
+A :class:`ReplayPort` memory-maps such a file and serves the received bytes again,
+as fast as possible or at the recorded pace, to the same parsing code as the real port::
+
+	gen.startCapture("session.cap")            # sdk.pga.Generator
+	board = OpenBCIBoard(port, capture="eeg.cap")
+
+	gen._setPort(ReplayPort("session.cap"))
+	board = OpenBCIBoard(serial_port=ReplayPort("eeg.cap", speed=1.0))
+
+File format: an 8 bytes header (:data:`MAGIC`), then one record per chunk:
+timestamp (float64, seconds of time.monotonic()), direction (uint8, :data:`RECEIVED` or
+:data:`SENT`), length (uint32), all little endian, followed by the bytes of the chunk.
+Files are only appended to, a new session continues an existing capture.
+"""
+import mmap
+import os
+import struct
+import threading
+import time
+
+
+MAGIC = b"SERCAP01"
+"""Header of capture files."""
+
+RECEIVED = 0
+"""Direction of the bytes read from the device."""
+
+SENT = 1
+"""Direction of the bytes written to the device."""
+
+_RECORD = struct.Struct("<dBI")
+
+
+class CapturePort(object):
+	"""
+	Serial port wrapper recording all the traffic into a capture file.
+	Every other attribute and method is the one of the wrapped port,
+	so it can replace it anywhere (settings, open/close, modem lines...).
+	"""
+
+	def __init__ (self, port, path):
+		"""
+		:param port: the serial port to wrap (e.g. a serial.Serial, open or not).
+		:param str path: the capture file, created if needed, appended to otherwise.
+		"""
+		object.__setattr__(self, "_wrapped", port)
+		object.__setattr__(self, "_lock", threading.Lock())
+		f = open (path, "ab")
+		if f.tell() == 0:
+			f.write (MAGIC)
+		object.__setattr__(self, "_file", f)
+
+	@property
+	def wrapped (self):
+		"""The serial port being recorded."""
+		return self._wrapped
+
+	def __getattr__ (self, name):
+		return getattr(self._wrapped, name)
+
+	def __setattr__ (self, name, value):
+		setattr(self._wrapped, name, value)
+
+	def _record (self, direction, data):
+		with self._lock:
+			if self._file is None:
+				return
+			self._file.write (_RECORD.pack (time.monotonic(), direction, len(data)))
+			self._file.write (data)
+
+	def read (self, size = 1):
+		data = self._wrapped.read (size)
+		if data:
+			self._record (RECEIVED, data)
+		return data
+
+	def write (self, data):
+		n = self._wrapped.write (data)
+		self._record (SENT, bytes(data))
+		return n
+
+	def inWaiting (self):
+		return self._wrapped.in_waiting
+
+	def close (self):
+		"""Closes the port, the capture goes on if it is opened again."""
+		self._wrapped.close()
+		with self._lock:
+			if self._file is not None:
+				self._file.flush()
+
+	def flush (self):
+		"""Flushes the port output, and the capture file."""
+		self._wrapped.flush()
+		with self._lock:
+			if self._file is not None:
+				self._file.flush()
+
+	def stopCapture (self):
+		"""Closes the capture file, the port is still usable (through :attr:`wrapped`)."""
+		with self._lock:
+			if self._file is not None:
+				self._file.close()
+				object.__setattr__(self, "_file", None)
+
+
+def readCapture (path, direction = None):
+	"""
+	Iterates over the records of a capture file.
+
+	:param str path: the capture file.
+	:param int direction: :data:`RECEIVED` or :data:`SENT` to only get those, None for all.
+	:return: an iterator of tuples (timestamp, direction, data), data being bytes.
+	"""
+	with open (path, "rb") as f:
+		if os.fstat (f.fileno()).st_size <= len(MAGIC):
+			return
+		mm = mmap.mmap (f.fileno(), 0, access=mmap.ACCESS_READ)
+		try:
+			for t, d, start, end in _records (mm):
+				if direction is None or d == direction:
+					yield (t, d, mm[start:end])
+		finally:
+			mm.close()
+
+
+def _records (mm):
+	"""Yields (timestamp, direction, start, end) for every record of a mapped capture."""
+	if mm[:len(MAGIC)] != MAGIC:
+		raise IOError("Not a capture file.")
+	pos = len(MAGIC)
+	size = len(mm)
+	while pos + _RECORD.size <= size:
+		t, d, n = _RECORD.unpack_from (mm, pos)
+		pos += _RECORD.size
+		if pos + n > size:
+			return  # truncated by a crash while recording
+		yield (t, d, pos, pos + n)
+		pos += n
+
+
+class ReplayPort(object):
+	"""
+	Serial-like port serving the bytes received in a capture file (the bytes written
+	by the host are discarded). The file is memory-mapped, chunks are not copied
+	until they are read. Once all the bytes were read, reading raises EOFError.
+	"""
+
+	def __init__ (self, path, speed = None, name = None):
+		"""
+		:param str path: the capture file.
+		:param float speed: None to serve the bytes as fast as possible, 1.0 for the recorded pace
+			(each chunk becomes available at its recorded time), 2.0 twice as fast...
+		:param str name: the port name to report, the file name by default.
+		"""
+		self.port = name or path
+		self.baudrate = 0
+		self.bytesize = 8
+		self.parity = "N"
+		self.stopbits = 1
+		self.xonxoff = False
+		self.rtscts = False
+		self.timeout = 0.1
+		self.speed = speed
+		self.bytesWritten = 0
+		self._file = open (path, "rb")
+		self._mm = mmap.mmap (self._file.fileno(), 0, access=mmap.ACCESS_READ)
+		self._view = memoryview(self._mm)
+		self._chunks = [(t, start, end) for t, d, start, end in _records (self._mm) if d == RECEIVED]
+		self._open = True
+		self.rewind()
+
+	def rewind (self):
+		"""Starts the replay again, from the first chunk."""
+		self._index = 0
+		self._pos = self._chunks[0][1] if self._chunks else 0
+		self._started = time.monotonic()
+
+	def _due (self, index):
+		"""Returns the number of seconds until the chunk is available (<= 0 if it already is)."""
+		if not self.speed:
+			return 0.0
+		return (self._chunks[index][0] - self._chunks[0][0]) / self.speed - (time.monotonic() - self._started)
+
+	def _current (self):
+		"""Moves to the next chunk if the current one was read, returns False at the end."""
+		while self._index < len(self._chunks) and self._pos >= self._chunks[self._index][2]:
+			self._index += 1
+			if self._index < len(self._chunks):
+				self._pos = self._chunks[self._index][1]
+		return self._index < len(self._chunks)
+
+	@property
+	def in_waiting (self):
+		if not self._current() or self._due (self._index) > 0:
+			return 0
+		return self._chunks[self._index][2] - self._pos
+
+	def inWaiting (self):
+		return self.in_waiting
+
+	def read (self, size = 1):
+		out = b""
+		while len(out) < size:
+			if not self._current():
+				if out:
+					break
+				raise EOFError("End of the capture %s." % self.port)
+			wait = self._due (self._index)
+			if wait > 0:
+				if out or self.timeout == 0:
+					break
+				if self.timeout is not None and wait > self.timeout:
+					time.sleep (self.timeout)
+					break
+				time.sleep (wait)
+			end = min(self._chunks[self._index][2], self._pos + size - len(out))
+			out += self._view[self._pos:end]
+			self._pos = end
+		return out
+
+	def write (self, data):
+		self.bytesWritten += len(data)
+		return len(data)
+
+	def open (self):
+		self._open = True
+
+	def close (self):
+		self._open = False
+
+	def isOpen (self):
+		return self._open
+
+	@property
+	def is_open (self):
+		return self._open
+
+	def flush (self):
+		pass
+
+	def flushInput (self):
+		pass
+
+	reset_input_buffer = flushInput
+
+	def flushOutput (self):
+		pass
+
+	reset_output_buffer = flushOutput
+
+	def setRTS (self, level = True):
+		pass
+
+	def setDTR (self, level = True):
+		pass
+
+	def release (self):
+		"""Unmaps the capture file."""
+		self._view.release()
+		self._mm.close()
+		self._file.close()
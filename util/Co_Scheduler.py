@@ -0,0 +1,256 @@
+"""Overlaps the motor moves of a trajectory with the delays between pulses
+
+Each pulse of a trajectory is followed by a relative move (MoveX/Y/Z). The move is queued
+to the stage as soon as the pulse result arrives (the pulse is over), without waiting for
+the motion: it runs during the delay before the next pulse, while the generator keeps
+executing on its own. The generator does not wait for the stage, so wherever the motion
+model predicts that a move takes longer than the delay after its pulse, the program is split:
+the next pulse starts a new segment, executed once the moves are finished (M400).
+Only the executions holding such a move are split, the other executions of a looped
+segment stay loops. Elsewhere the segments run untouched, as compiled by Seq_Compiler.
+
+TimelineReport compares the achieved timeline (pulse result arrival times) with the
+requested one (durations and delays of the program).
+"""
+import math
+import time
+
+import sdk.pga as FUS
+from util.FUS_Exec import ChunkedExecutor, chunk_program
+
+
+def constant_speed_estimate(speed=10.0, overhead=0.02):
+    """Returns a rough move time estimate, when no Motion_Model is available
+
+    Parameters
+    ----------
+    speed : float
+        Feed rate in mm/s, applied to the longest axis
+    overhead : float
+        Fixed time per move in seconds (command, acceleration)
+    """
+    def estimate(coords):
+        dist = max(abs(c) for c in coords)
+        return overhead + dist / speed if dist > 0 else 0.0
+    return estimate
+
+
+class TimelineReport(object):
+    """Achieved vs requested timeline of a co-scheduled run
+
+    Times are in seconds, from the end of the first pulse.
+
+    Attributes
+    ----------
+    requested : list of float
+        Requested end time of each pulse received
+    achieved : list of float
+        Arrival time of each pulse result
+    stalls : list of float
+        Time spent waiting for the stage before each split segment
+    late_moves : int
+        Number of moves predicted to be longer than the delay after their pulse
+    """
+    def __init__(self):
+        self.requested = []
+        self.achieved = []
+        self.stalls = []
+        self.late_moves = 0
+
+    def slip(self):
+        """Delay of the last pulse compared to the requested timeline"""
+        if not self.achieved:
+            return 0.0
+        return self.achieved[-1] - self.requested[len(self.achieved) - 1]
+
+    def max_slip(self):
+        """Largest delay of a pulse compared to the requested timeline"""
+        return max([a - r for a, r in zip(self.achieved, self.requested)] or [0.0])
+
+    def __str__(self):
+        n = len(self.achieved)
+        if n == 0:
+            return 'no pulse'
+        return ('%d pulses in %.3f s (requested %.3f s): slip %.1f ms at the end, max %.1f ms; '
+                '%d moves longer than their delay, %d stalls for %.1f ms') % (
+            n, self.achieved[-1], self.requested[n - 1], 1e3 * self.slip(), 1e3 * self.max_slip(),
+            self.late_moves, len(self.stalls), 1e3 * sum(self.stalls))
+
+
+class CoScheduler(object):
+    """Runs a trajectory with its moves overlapped with the pulse delays
+
+    Parameters
+    ----------
+    generator : FUS.Generator
+        A connected generator
+    motor : MotorXYZ.MotorsXYZ
+        A connected stage, None to run without moves
+    moves : list of tuple
+        Relative move (x, y, z) after each pulse, cycled over the whole program
+    estimate : callable, optional
+        Predicted duration in seconds of a relative move, e.g. Motion_Model.MotionModel.move_time,
+        constant_speed_estimate() by default
+    margin : float
+        Extra time in seconds a move must leave before the next pulse
+    on_result : callable, optional
+        Called with (pulse index, FUS.PulseResult) for every pulse result
+    max_pulses : int, optional
+        Size of the generator sequence buffer (Param.PULSE_COUNT_MAX), default value by default
+    """
+    def __init__(self, generator, motor, moves, estimate=None, margin=0.005, on_result=None,
+                 max_pulses=None):
+        if max_pulses is None:
+            max_pulses = FUS.Param.DEFAULTS[FUS.Param.PULSE_COUNT_MAX].defaultValue
+        self.generator = generator
+        self.motor = motor
+        self.moves = moves
+        self.estimate = estimate or constant_speed_estimate()
+        self.margin = margin
+        self.on_result = on_result
+        self.max_pulses = max_pulses
+
+    def _move(self, index):
+        move = self.moves[index % len(self.moves)] if self.moves else (0, 0, 0)
+        return move if any(move) else None
+
+    def _fits(self, index, gap):
+        """True if the move after pulse index ends before the next pulse, gap (us) later"""
+        move = self._move(index)
+        return move is None or self.estimate(move) + self.margin <= gap * 1e-6
+
+    def plan(self, segments):
+        """Splits the segments where a move can not fit in the delay after its pulse
+
+        An execution holding such a move is split after it, each piece being at most
+        max_pulses long. The executions around it stay loops. The moves are checked once
+        per phase of the move list, not once per pulse of the program.
+
+        Returns
+        -------
+        tuple
+            (segments, waits, late_moves): the new segments, for each one whether
+            the moves must be finished before it starts, and the number of late moves
+        """
+        out = []
+        waits = []
+        late = 0
+        index = 0
+        wait = False  # whether the move before the next segment is late
+
+        def add(chunks):
+            for k, chunk in enumerate(chunks):
+                out.append(chunk)
+                waits.append(wait and k == 0)
+
+        cycle = len(self.moves) or 1
+        for seg in segments:
+            # an execution followed by another one: the delay between them after its last pulse
+            last = seg.pulses[-1]
+            extended = seg.pulses[:-1] + [FUS.Pulse(last.duration, last.delay + seg.delay,
+                                                    last.amplitude, last.frequency)]
+            n = len(seg.pulses)
+            cache = {}  # (phase in the move list, final) -> fits of an execution
+
+            def exec_fits(start, final):
+                key = (start % cycle, final)
+                if key not in cache:
+                    pulses = seg.pulses if final else extended
+                    cache[key] = [self._fits(start + i, p.delay) for i, p in enumerate(pulses)]
+                return cache[key]
+
+            run = 0  # executions not added yet, all their moves fitting
+            first = 0
+            # the executions come back to the same moves every period executions
+            period = cycle // math.gcd(n, cycle)
+            if seg.execs > 1 and all(all(exec_fits(index + c * n, False)) for c in range(period)):
+                # every execution but the final one fits: one loop
+                run = first = seg.execs - 1
+                index += run * n
+            for e in range(first, seg.execs):
+                final = e == seg.execs - 1
+                pulses = seg.pulses if final else extended
+                fits = exec_fits(index, final)
+                index += n
+                if all(fits[:-1]):
+                    run += 1
+                    if fits[-1] and not final:
+                        continue
+                if run:
+                    # the executions so far, as one loop
+                    if final and all(fits[:-1]):
+                        add(chunk_program(seg.pulses, run, seg.delay, self.max_pulses))
+                    else:
+                        add(chunk_program(extended, run, 0, self.max_pulses))
+                    wait = False
+                if not all(fits[:-1]):
+                    start = 0
+                    for i, ok in enumerate(fits[:-1]):
+                        if not ok:
+                            late += 1
+                            add(chunk_program(pulses[start:i + 1], 1, 0, self.max_pulses))
+                            wait = True
+                            start = i + 1
+                    add(chunk_program(pulses[start:], 1, 0, self.max_pulses))
+                run = 0
+                wait = not fits[-1]
+                late += wait
+        if wait:
+            late -= 1  # the move after the last pulse does not delay any pulse
+        return out, waits, late
+
+    def run(self, segments, should_stop=None):
+        """Executes the segments, queuing the moves after each pulse
+
+        Parameters
+        ----------
+        segments : list of FUS_Exec.Segment
+        should_stop : callable, optional
+            Polled before each result, the execution is stopped when it returns True
+
+        Returns
+        -------
+        tuple
+            (FUS_Exec.ChunkReport, TimelineReport)
+        """
+        segments, waits, late = self.plan(segments)
+        timeline = TimelineReport()
+        timeline.late_moves = late
+
+        use_motor = self.motor is not None and self.motor.connected
+        first_end = [None]
+        last_delay = [0]  # requested delay after the previous pulse in microseconds
+
+        def before_segment(k, seg):
+            if waits[k] and use_motor:
+                start = time.perf_counter()
+                self.motor.waitMoves()
+                timeline.stalls.append(time.perf_counter() - start)
+
+        def on_result(k, i, result):
+            index = len(timeline.achieved)
+            now = time.perf_counter()
+            if first_end[0] is None:
+                first_end[0] = now
+            timeline.achieved.append(now - first_end[0])
+            # requested end of this pulse: the previous end, plus its delay, plus this duration
+            seg = segments[k]
+            p = seg.pulses[i % len(seg.pulses)]
+            if index == 0:
+                timeline.requested.append(0.0)
+            else:
+                timeline.requested.append(timeline.requested[-1] + (last_delay[0] + p.duration) * 1e-6)
+            between = i % len(seg.pulses) == len(seg.pulses) - 1 and i // len(seg.pulses) < seg.execs - 1
+            last_delay[0] = p.delay + (seg.delay if between else 0)
+            move = self._move(index)
+            if use_motor and move is not None:
+                self.motor.queueMoveRel(move)
+                self.motor.collectOks()
+            if self.on_result is not None:
+                self.on_result(index, result)
+
+        executor = ChunkedExecutor(self.generator, on_result, before_segment=before_segment)
+        report = executor.run(segments, should_stop)
+        if use_motor:
+            self.motor.waitMoves()
+        return report, timeline
@@ -0,0 +1,392 @@
+"""Execution of pulse programs longer than the generator's sequence buffer
+
+The generator holds at most ``Param.PULSE_COUNT_MAX`` pulses (20 by default). A longer
+program is split into device-sized segments that are uploaded and executed one after
+the other: the next segment is packed while the current one runs, and uploaded once the
+delay after the last pulse of the current one is over.
+
+The generator connection is owned by an ExecWorker, a long-lived thread running the
+commands of the GUI in order and handing back messages and pulse results through a queue.
+"""
+import collections
+import queue
+import threading
+import time
+import traceback
+
+import sdk.pga as FUS
+
+# "This command is not possible during an execution."
+BUSY_ERROR = 123
+
+
+class Segment(object):
+    """One upload: a sequence that fits in the generator buffer, and how to execute it
+
+    Parameters
+    ----------
+    pulses : list of FUS.Pulse
+        The sequence, at most PULSE_COUNT_MAX pulses
+    execs : int
+        Number of executions of the sequence
+    delay : int
+        Delay between executions in microseconds
+    """
+    def __init__(self, pulses, execs=1, delay=0):
+        self.pulses = pulses
+        self.execs = execs
+        self.delay = delay
+
+    def num_results(self):
+        """Number of pulse results sent by the generator for this segment"""
+        return len(self.pulses) * self.execs
+
+    def duration(self):
+        """Expected execution time in seconds"""
+        period = sum(p.duration + p.delay for p in self.pulses)
+        return (period * self.execs + self.delay * (self.execs - 1)) * 1e-6
+
+    def result_timeout(self, margin=1.0):
+        """Longest expected wait between two pulse results, in seconds, plus a margin"""
+        longest = max(p.duration + p.delay for p in self.pulses) + self.delay
+        return longest * 1e-6 + margin
+
+
+def pulse_from_json(pulse):
+    """Converts one pulse of a sequence file into a FUS.Pulse
+
+    Accepts the keys written by the sequence editor ("Frequency") and the older ones ("Freq").
+    Duration and Delay are in milliseconds, Amplitude in percent, Frequency in MHz.
+    """
+    freq = pulse["Frequency"] if "Frequency" in pulse else pulse["Freq"]
+    return FUS.Pulse(
+        dura = int(pulse["Duration"]*1000.0), #Duration in microseconds
+        dela = int(pulse["Delay"]*1000.0), #Delay in microseconds
+        ampl = int(pulse["Amplitude"]/100.0 * 1023), #Amplitude in [0,1023]
+        freq = int(freq*1.0e6) #US Frequency in Hz
+    )
+
+
+def program_from_json(seq_data):
+    """Reads a sequence file content
+
+    Returns
+    -------
+    tuple
+        (pulses, execs, delay): the list of FUS.Pulse, the number of executions
+        and the delay between executions in microseconds
+    """
+    pulses = [pulse_from_json(p) for p in seq_data["Sequence"]]
+    execs = seq_data["ExecCount"] if "ExecCount" in seq_data else seq_data["ExecutionCount"]
+    return pulses, int(execs), int(seq_data["SequenceDelay"]*1000.0)
+
+
+def chunk_program(pulses, execs, delay, max_pulses):
+    """Splits a program into segments of at most max_pulses pulses
+
+    A program that fits is a single segment. Otherwise each execution is split in chunks
+    executed once, and the delay between executions is added to the delay of the last
+    pulse of each execution but the final one.
+
+    Parameters
+    ----------
+    pulses : list of FUS.Pulse
+        One execution of the program
+    execs : int
+        Number of executions
+    delay : int
+        Delay between executions in microseconds
+    max_pulses : int
+        Size of the generator sequence buffer (Param.PULSE_COUNT_MAX)
+
+    Returns
+    -------
+    list of Segment
+    """
+    if len(pulses) <= max_pulses:
+        return [Segment(pulses, execs, delay)]
+
+    def split(seq):
+        return [Segment(seq[i:i + max_pulses]) for i in range(0, len(seq), max_pulses)]
+
+    last = pulses[-1]
+    extended = pulses[:-1] + [FUS.Pulse(last.duration, last.delay + delay, last.amplitude, last.frequency)]
+    return split(extended) * (execs - 1) + split(pulses)
+
+
+class ChunkReport(object):
+    """Outcome of a ChunkedExecutor run
+
+    Attributes
+    ----------
+    segments : int
+        Number of segments executed (started)
+    uploads : int
+        Number of sequence uploads
+    skipped : int
+        Number of uploads skipped because the generator already held the sequence
+    results : int
+        Number of pulse results received
+    dead_times : list of float
+        For each segment but the first, seconds between the expected end of the
+        previous segment (its last result, plus the delay after its last pulse) and
+        the acknowledgement of this execution
+    elapsed : float
+        Total run time in seconds
+    stopped : bool
+        True if the run was stopped before the end
+    """
+    def __init__(self):
+        self.segments = 0
+        self.uploads = 0
+        self.skipped = 0
+        self.results = 0
+        self.dead_times = []
+        self.elapsed = 0.0
+        self.stopped = False
+
+    def __str__(self):
+        msg = '%d segments, %d uploads (%d skipped), %d results in %.3f s' % (
+            self.segments, self.uploads, self.skipped, self.results, self.elapsed)
+        if self.dead_times:
+            msg += ', dead time between segments: mean %.2f ms, max %.2f ms' % (
+                1e3 * sum(self.dead_times) / len(self.dead_times), 1e3 * max(self.dead_times))
+        if self.stopped:
+            msg += ' (stopped)'
+        return msg
+
+
+class ChunkedExecutor(object):
+    """Streams a list of segments to the generator
+
+    Parameters
+    ----------
+    generator : FUS.Generator
+        A connected generator
+    on_result : callable, optional
+        Called with (segment index, result index within the segment, FUS.PulseResult)
+        for every pulse result
+    busy_retry : float
+        Seconds between two upload attempts while the generator still executes
+    busy_timeout : float
+        Seconds to keep retrying an upload after the expected end of the previous
+        execution, before giving up
+    before_segment : callable, optional
+        Called with (segment index, Segment) before each segment is started
+    """
+    def __init__(self, generator, on_result=None, busy_retry=0.002, busy_timeout=0.5,
+                 before_segment=None):
+        self.generator = generator
+        self.on_result = on_result
+        self.before_segment = before_segment
+        self.busy_retry = busy_retry
+        self.busy_timeout = busy_timeout
+
+    def upload(self, packed, ready_at=None):
+        """Uploads a packed sequence unless the generator already holds it, retrying while
+        the generator is still executing
+
+        Parameters
+        ----------
+        packed : bytes
+            The sequence, as packed by FUS.packSequence
+        ready_at : float, optional
+            time.perf_counter() at which the previous execution should be over, now by default
+
+        Returns
+        -------
+        bool
+            True if the sequence was uploaded
+        """
+        now = time.perf_counter()
+        if ready_at is None:
+            ready_at = now
+        elif ready_at > now:
+            time.sleep(ready_at - now)
+        deadline = ready_at + self.busy_timeout
+        while True:
+            try:
+                return self.generator.updateSequence(packed)
+            except FUS.PGAError as err:
+                if err.code != BUSY_ERROR or time.perf_counter() > deadline:
+                    raise
+            time.sleep(self.busy_retry)
+
+    def run(self, segments, should_stop=None):
+        """Executes all the segments in order, with pulse results sent asynchronously
+
+        Parameters
+        ----------
+        segments : list of Segment
+        should_stop : callable, optional
+            Polled before each result, the execution is stopped when it returns True
+
+        Returns
+        -------
+        ChunkReport
+        """
+        report = ChunkReport()
+        start = time.perf_counter()
+        if should_stop is None:
+            should_stop = lambda: False
+        try:
+            self._run(segments, should_stop, report)
+        except FUS.PGAError as err:
+            # Generator.abort() preempts the wait for the next result
+            if err.code != FUS.ERROR_ABORTED:
+                raise
+            report.stopped = True
+        report.elapsed = time.perf_counter() - start
+        return report
+
+    def _run(self, segments, should_stop, report):
+        flags = FUS.ExecFlag.ASYNC_PULSE_RESULT
+        packed_next = FUS.packSequence(segments[0].pulses) if segments else None
+        last_result = None
+        ready_at = None  # expected end of the previous execution
+        for k, seg in enumerate(segments):
+            if last_result is not None:
+                # the execution runs until the delay after its last pulse is over: the
+                # generator refuses the upload until then
+                ready_at = last_result + segments[k - 1].pulses[-1].delay * 1e-6
+                while time.perf_counter() < ready_at - 0.05 and not should_stop():
+                    time.sleep(0.05)
+            if should_stop():
+                report.stopped = True
+                return
+            if self.upload(packed_next, ready_at):
+                report.uploads += 1
+            else:
+                report.skipped += 1
+            if self.before_segment is not None:
+                self.before_segment(k, seg)
+            self.generator.executeSequence(seg.execs, seg.delay, flags)
+            report.segments += 1
+            if ready_at is not None:
+                report.dead_times.append(time.perf_counter() - ready_at)
+
+            # prepare the next upload while this segment runs
+            packed_next = FUS.packSequence(segments[k + 1].pulses) if k + 1 < len(segments) else None
+
+            timeout = seg.result_timeout()
+            for i in range(seg.num_results()):
+                # also checked right after the execution starts, in case an abort came just before
+                if should_stop():
+                    self.generator.stopSequence()
+                    report.stopped = True
+                    return
+                result = self.generator.readAsyncPulse(timeout)
+                report.results += 1
+                if self.on_result is not None:
+                    self.on_result(k, i, result)
+            last_result = time.perf_counter()
+
+
+class ExecWorker(threading.Thread):
+    """Long-lived thread owning the generator connection
+
+    Commands are callables run one after the other in the worker thread. What they
+    produce (messages, pulse results, errors) is posted as (kind, value) events, which
+    the GUI thread collects with drain(), e.g. from a QTimer.
+
+    Pulse results are coalesced while the GUI thread does not collect them: beyond
+    max_results waiting results, new ones are only counted, and drain() returns one
+    ('dropped', count) event in their place.
+
+    Parameters
+    ----------
+    name : str
+        Name of the thread
+    max_results : int
+        Maximum number of 'result' events waiting for drain()
+    """
+    def __init__(self, name='fus-worker', max_results=1000):
+        super().__init__(name=name, daemon=True)
+        self._commands = queue.Queue()
+        self._events = collections.deque()
+        self._events_lock = threading.Lock()
+        self._results = 0  # 'result' events waiting
+        self._dropped = 0  # 'result' events not queued since the last drain()
+        self.max_results = max_results
+        self.busy = False
+
+    def submit(self, func, *args, **kwargs):
+        """Queues func(*args, **kwargs) to run in the worker thread"""
+        self._commands.put((func, args, kwargs))
+
+    def pending(self):
+        """Number of queued commands, the running one excluded"""
+        return self._commands.qsize()
+
+    def clear(self):
+        """Drops the queued commands, the running one excluded
+
+        Returns
+        -------
+        int
+            Number of commands dropped
+        """
+        dropped = 0
+        stop = False
+        while True:
+            try:
+                command = self._commands.get_nowait()
+            except queue.Empty:
+                break
+            if command is None:
+                stop = True
+            else:
+                dropped += 1
+        if stop:
+            self._commands.put(None)
+        return dropped
+
+    def post(self, kind, value=None):
+        """Posts an event for the GUI thread, from any thread"""
+        with self._events_lock:
+            if kind == 'result':
+                if self._results >= self.max_results:
+                    self._dropped += 1
+                    return
+                self._results += 1
+            self._events.append((kind, value))
+
+    def drain(self, limit=None):
+        """Returns the posted events, oldest first
+
+        Parameters
+        ----------
+        limit : int, optional
+            Maximum number of events to return, all of them by default
+        """
+        events = []
+        with self._events_lock:
+            while self._events and (limit is None or len(events) < limit):
+                event = self._events.popleft()
+                if event[0] == 'result':
+                    self._results -= 1
+                events.append(event)
+            if self._dropped and (limit is None or len(events) < limit):
+                events.append(('dropped', self._dropped))
+                self._dropped = 0
+        return events
+
+    def shutdown(self, timeout=None):
+        """Stops the worker once the queued commands are done"""
+        self._commands.put(None)
+        self.join(timeout)
+
+    def run(self):
+        while True:
+            command = self._commands.get()
+            if command is None:
+                return
+            func, args, kwargs = command
+            self.busy = True
+            try:
+                func(*args, **kwargs)
+            except Exception as err:
+                self.post('error', err)
+                traceback.print_exc()
+            finally:
+                self.busy = False
@@ -1,9 +1,13 @@
 import threading
+import time
 import warnings
 import util.io as io
 import traceback
 import sdk.pga as FUS
-import multiprocessing
+import util.FUS_Exec as FUS_Exec
+import util.Seq_Compiler as Seq_Compiler
+import util.Co_Scheduler as Co_Scheduler
+import util.Motion_Model as Motion_Model
 import os
 
 
@@ -25,6 +29,10 @@ class FUS_GEN():
         """Initializes connection the IGT FUS Generator and sets up data structures
         for setting up trajectories
 
+        The generator is driven by a persistent worker thread (FUS_Exec.ExecWorker): the methods
+        called from the GUI queue their work and return, and poll() hands the messages and pulse
+        results over to all_msgs, from the GUI thread.
+
         Parameters
         ----------
         host : string
@@ -34,59 +42,131 @@ class FUS_GEN():
         timeout_ms: int
             Number of ms to wait before timing out the connection
         """
-        self.igt_system = FUS.Generator()#loglevel=FUS.LogLevel.ALL
+        # Threaded: abort() can stop the generator while the worker waits for pulse results
+        self.igt_system = FUS.Generator(threaded=True)#loglevel=FUS.LogLevel.ALL
         self.igt_system.loadConfig("sdk/generator.json")
 
         self.motor = motor
+        self.motion_model = Motion_Model.MotionModel.from_file()
 
         self.all_msgs = all_msgs
         
-        self.run_thread = None
+        self.worker = FUS_Exec.ExecWorker()
+        self.worker.start()
+        self.segments = None
+        self.program_key = None
         self.num_execs = None
         self.host=host
 
         self.running = False
         self.connected = False
+        # called from the GUI thread with True when a sequence starts, False once it is over
+        self.sequence_callbacks = []
+
+    def _sequence_changed(self, running):
+        for callback in self.sequence_callbacks:
+            callback(running)
+
+    def _msg(self, msg):
+        """Queues a message for all_msgs, from any thread"""
+        self.worker.post('msg', msg)
+
+    def poll(self, limit=None):
+        """Hands the messages and pulse results of the worker over to all_msgs. Call from the GUI thread.
+
+        Parameters
+        ----------
+        limit : int, optional
+            Maximum number of events to process, all of them by default
+        """
+        msgs = []
+        for kind, value in self.worker.drain(limit):
+            if kind == 'result':
+                msgs.append('FUS RESULT: ' + str(value))
+            elif kind == 'dropped':
+                msgs.append('%d pulse results not shown (too many to display)' % value)
+            elif kind == 'running':
+                self._sequence_changed(value)
+            elif kind == 'error':
+                msgs.append('ERROR: ' + str(value))
+            else:
+                msgs.append(value)
+        if msgs:
+            self.all_msgs.appendMsgs(msgs)
 
     def connect(self):
+        self.worker.submit(self._connect)
+
+    def _connect(self):
         try:
             if self.igt_system.autoConnect():
-                self.all_msgs.appendMsg("Connected to IGT System!")
+                self._msg("Connected to IGT System!")
                 self.igt_system.enableAmplifier(True)
                 self.igt_system.selectOutput(FUS.Output.EXTERNAL)
                 self.connected = True
             else:
-                self.all_msgs.appendMsg('Could not connect to IGT System. Check if system is plugged in?')
+                self._msg('Could not connect to IGT System. Check if system is plugged in?')
         except Exception as err:
             print('ERROR: ' + str(err))
             io.line_print(traceback.format_exc())
-            self.all_msgs.appendMsg('Could not connect to IGT System. Check if system is plugged in?')
+            self._msg('Could not connect to IGT System. Check if system is plugged in?')
 
     def send_traj(self,seq_data):
+        trajectory, num_execs, seq_delay = FUS_Exec.program_from_json(seq_data)
+        if not trajectory or num_execs < 1:
+            self.all_msgs.appendMsg('ERROR: The sequence has no pulse to execute, nothing was sent.')
+            return
+
         if self.motor is None or not self.motor.connected:
             self.all_msgs.appendMsg('No motor system connected. Movement will be disabled.')
+
+        motor_traj = [Motion_Model.move_from_json(pulse) for pulse in seq_data["Sequence"]]
+
+        #Check the moves against the motion model before anything is sent
+        for i, move_time, delay in self.motion_model.check_sequence(seq_data):
+            self.all_msgs.appendMsg('WARNING: move after pulse %d takes %.0f ms, longer than its %.0f ms delay: '
+                                    'the next pulse will wait for it' % (i, move_time * 1e3, delay * 1e3))
+        self.all_msgs.appendMsg('Estimated sequence time: %.1f s' % self.motion_model.sequence_time(seq_data))
+
+        #Compile and upload on the worker, after the commands already queued (the limits are read from the generator)
+        self.worker.submit(self._compile_traj, trajectory, num_execs, seq_delay, motor_traj)
+
+    def _compile_traj(self, trajectory, num_execs, seq_delay, motor_traj):
+        # The same protocol sent again: keep the compiled segments, the first one is probably installed already
+        key = (tuple((p.duration, p.delay, p.amplitude, p.frequency) for p in trajectory), num_execs, seq_delay,
+               self.connected)
+        if key != self.program_key or self.segments is None:
+            self._compile_program(trajectory, num_execs, seq_delay)
+            self.program_key = key
+        self.motor_traj = motor_traj
+
+        # Install the first segment now, so that run() starts right away
+        if self.connected:
+            if self.igt_system.updateSequence(self.segments[0].pulses):
+                self._msg("Sequence successfully sent (fingerprint %08X)." % self.igt_system.sequenceFingerprint())
+            else:
+                self._msg("Sequence already installed on the generator, upload skipped.")
         else:
-            self.use_motor = True
-
-        self.trajectory = []
-        self.motor_traj = []
-        for pulse in seq_data["Sequence"]:
-            self.trajectory.append(FUS.Pulse(
-                dura = int(pulse["Duration"]*1000.0), #Duration in microseconds
-                dela = int(pulse["Delay"]*1000.0), #Delay in microseconds
-                ampl = int(pulse["Amplitude"]/100.0 * 1023), #Amplitude in [0,1023]
-                freq = int(pulse["Freq"]*1.0e6) #US Frequency in Hz
-            ))
-            self.motor_traj.append((pulse["MoveX"], pulse["MoveY"], pulse["MoveZ"]))
-        self.num_execs = seq_data["ExecutionCount"]
-        self.seq_delay = int(seq_data["SequenceDelay"]*1000.0)
+            self._msg("Sequence compiled, it will be sent once connected.")
 
+    def _compile_program(self, trajectory, num_execs, seq_delay):
+        self.trajectory = trajectory
+        self.num_execs = num_execs
+        self.seq_delay = seq_delay
         self.num_pulses = self.num_execs * len(self.trajectory)
 
-        #Schedule the FUS Firing
-        self.run_thread = multiprocessing.Process(target = self.execute_traj)
-
-        self.all_msgs.appendMsg("Sequence successfully sent.")
+        # The generator buffer holds PULSE_COUNT_MAX pulses: repeated patterns are folded into
+        # execution loops, the rest is streamed in chunks
+        if self.connected:
+            max_pulses = self.igt_system.readParameter(FUS.Param.PULSE_COUNT_MAX)
+            max_delay = self.igt_system.readParameter(FUS.Param.EXECUTION_DELAY_MAX)
+        else:
+            max_pulses = FUS.Param.DEFAULTS[FUS.Param.PULSE_COUNT_MAX].defaultValue
+            max_delay = FUS.Param.DEFAULTS[FUS.Param.EXECUTION_DELAY_MAX].defaultValue
+        program = Seq_Compiler.compile_program(self.trajectory, self.num_execs, self.seq_delay,
+                                               max_pulses, max_delay)
+        self.segments = program.segments
+        self._msg('Sequence compiled: ' + str(program))
 
     def run(self):
         """Starts the FUS execution queue
@@ -99,21 +179,30 @@ class FUS_GEN():
             return
 
         # Start the execution
-        self.run_thread.start()
-
         self.running = True
+        self._sequence_changed(True)
+        self.worker.submit(self.execute_traj)
 
     def close(self):
         """Disconnects the IGT System
         """
+        self.running = False
+        self.worker.submit(self._close)
+
+    def _close(self):
         if self.connected:
             self.igt_system.enableAmplifier(False)
             self.igt_system.disconnect()
             self.connected = False
-            self.all_msgs.appendMsg("Generator shutdown successfully.")
+            self._msg("Generator shutdown successfully.")
         else:
-            self.all_msgs.appendMsg("Generator is already shutdown!")
+            self._msg("Generator is already shutdown!")
 
+    def shutdown(self, timeout=None):
+        """Stops the experiment if any, and the worker once its queued commands are done
+        """
+        self.running = False
+        self.worker.shutdown(timeout)
 
     def stop(self):
         """Stops the experiment
@@ -122,14 +211,59 @@ class FUS_GEN():
             warnings.warn('<FUS_GEN> Experiment is already stopped')
             return
 
+        self.abort()
+
+    def abort(self, halt_motor=True):
+        """Stops the generator and the motors as fast as possible. Can be called from any thread,
+        it does not wait for the worker: the stop command goes ahead of its pending commands.
+
+        Parameters
+        ----------
+        halt_motor : bool
+            Also quickstop the motors (M410)
+
+        Returns
+        -------
+        float
+            Time from the call to the generator acknowledgement in seconds, None if not acknowledged
+        """
+        start = time.perf_counter()
         self.running = False
-        self.igt_system.stopSequence()
-        self.run_thread.terminate()
-        self.run_thread.join()
-        
-        self.run_thread = None
+        latency = None
+        if self.connected:
+            try:
+                latency = self.igt_system.abort()
+            except FUS.PGAError as err:
+                self._msg('ERROR: Abort failed: ' + str(err))
+        motor_time = None
+        if halt_motor and self.motor is not None and self.motor.connected:
+            motor_time = self.motor.halt()
+            # accept moves again once the sequence is over, see _resume_motor
+            self.worker.submit(self._resume_motor)
+        msg = 'ABORT: '
+        if latency is None:
+            msg += 'generator stop not acknowledged' if self.connected else 'generator not connected'
+        else:
+            msg += 'generator stopped in %.1f ms' % (latency * 1e3)
+        if motor_time is not None:
+            msg += ', motor halt sent in %.1f ms' % (motor_time * 1e3)
+        msg += ' (total %.1f ms)' % ((time.perf_counter() - start) * 1e3)
+        self._msg(msg)
+        return latency
 
-        all_msgs.appendMsg('Sequence aborted at ' + io.get_time_string())
+    def _resume_motor(self):
+        """Accepts stage moves again after abort(), and reads the position back (the moves
+        were cut short). Runs in the worker thread, after the stopped sequence.
+        """
+        if self.motor is None or not self.motor.halted.is_set():
+            return
+        self.motor.resume()
+        if self.motor.connected:
+            pos = self.motor.getPos()
+            if pos and all(p >= 0 for p in pos):
+                self._msg('Stage stopped at %s, moves accepted again.' % pos)
+            else:
+                self._msg('Stage position unknown after the abort, set the zero again before moving.')
 
     def add_finish(self,start_time):
         """Schedules when to stop the experiment (at the same time as the RPi)
@@ -148,34 +282,45 @@ class FUS_GEN():
             warnings.warn('<FUS_GEN> System is already connected',RuntimeWarning)
             return
         else:
-            if self.igt_system.autoConnect():
+            # The board usually still runs after a USB hiccup: skip the hardware reset if it answers
+            if self.igt_system.autoConnect(warm=True):
                 print("Connected to IGT System ", self.host)
+                self.connected = True
             else:
                 raise EnvironmentError('<FUS_GEN> Could not connect to IGT System')
 
     def execute_traj(self):
-        """Tells the IGT system to execute the current trajectory and then loads the next trajectory if necessary
-        into the Generator's buffers
-
-        Parameters
-        ----------
-        traj_id : int
-            Index of the trajectory to be executed
+        """Executes the current trajectory, uploading the next segment into the Generator's buffer
+        when needed. Runs in the worker thread.
         """
-        exec_flags = FUS.ExecFlag.ASYNC_PULSE_RESULT
-        self.igt_system.executeSequence(self.num_execs,self.seq_delay,exec_flags)
-        for i in range(self.num_pulses):
-            if not self.running:
-                break                
-            measure = self.igt_system.readAsyncPulse()
-
-            #Issue Move command if motor is connected
-            if self.motor and self.motor.connected:
-                self.motor.moveRel(self.motor_traj[i % len(self.motor_traj)])
+        if self.segments is None:
+            self.running = False
+            self.worker.post('running', False)
+            self._msg("ERROR: No sequence was sent!")
+            return
 
+        def on_result(index, measure):
             #Print Result of the FUS Shot
-            self.all_msgs.appendMsg('FUS RESULT: ' + str(measure))
+            self.worker.post('result', measure)
 
-        self.running = False
+        #Moves are queued after each pulse and run during its delay, see Co_Scheduler
+        motor = self.motor if self.motor and self.motor.connected else None
+        try:
+            # here rather than in run(): the stage lock may be held by a long motor command
+            if motor is not None:
+                motor.resume()
+            scheduler = Co_Scheduler.CoScheduler(self.igt_system, motor, self.motor_traj,
+                                                 estimate=self.motion_model.move_time, on_result=on_result,
+                                                 max_pulses=self.igt_system.readParameter(FUS.Param.PULSE_COUNT_MAX))
+            report, timeline = scheduler.run(self.segments, should_stop=lambda: not self.running)
+        finally:
+            self.running = False
+            self.worker.post('running', False)
+        if len(self.segments) > 1 or report.segments > 1:
+            self._msg('Chunked execution: ' + str(report))
+        self._msg('Timeline: ' + str(timeline))
 
-        all_msgs.appendMsg('Sequence finished at ' + io.get_time_string())
\ No newline at end of file
+        if report.stopped:
+            self._msg('Sequence aborted at ' + io.get_time_string())
+        else:
+            self._msg('Sequence finished at ' + io.get_time_string())
@@ -0,0 +1,210 @@
+"""Predicts the duration of stage moves from the motion profile in sdk/mechanics.json
+
+The profile gives, for each axis:
+
+- stepsMM: motor steps per millimeter,
+- rangeMM: travel range of each axis in millimeters,
+- accelerationSteps: interval in microseconds before each step of the acceleration ramp,
+  the last one being the cruise interval. Deceleration uses the same ramp backwards,
+- pulseDuration: width of the step pulses in microseconds (part of each interval).
+
+Axes are assumed to move at the same time, a move lasts as long as its longest axis.
+The raw prediction is then corrected by calibrate(), fitted on measured moves
+(see MotorsXYZ.test_move): predicted = scale * raw + overhead.
+"""
+import json
+
+MECHANICS_FILE = 'sdk/mechanics.json'
+
+
+class MotionModel(object):
+    """Move duration model of the XYZ stage
+
+    Parameters
+    ----------
+    steps_mm : float
+        Motor steps per millimeter
+    range_mm : list of float
+        Travel range of the X, Y and Z axes in millimeters
+    ramp : list of int
+        Step intervals of the acceleration ramp in microseconds
+    pulse_duration : int
+        Width of the step pulses in microseconds
+    scale : float
+        Calibration factor applied to the raw prediction
+    overhead : float
+        Calibration time added to every move in seconds (command, serial round trip)
+    """
+    def __init__(self, steps_mm, range_mm, ramp, pulse_duration=0, scale=1.0, overhead=0.0):
+        self.steps_mm = steps_mm
+        self.range_mm = list(range_mm)
+        self.ramp = list(ramp)
+        self.pulse_duration = pulse_duration
+        self.scale = scale
+        self.overhead = overhead
+        # ramp_sums[n]: time of the first n steps of the ramp in microseconds
+        self.ramp_sums = [0]
+        for interval in self.ramp:
+            self.ramp_sums.append(self.ramp_sums[-1] + interval)
+
+    @classmethod
+    def from_file(cls, fname=MECHANICS_FILE):
+        """Loads the profile (and the calibration, if saved) from a mechanics JSON file"""
+        with open(fname, 'r') as f:
+            mech = json.load(f)
+        return cls(mech['stepsMM'], mech['rangeMM'], mech['accelerationSteps'], mech.get('pulseDuration', 0),
+                   mech.get('timeScale', 1.0), mech.get('moveOverhead', 0.0))
+
+    def save_calibration(self, fname=MECHANICS_FILE):
+        """Writes the calibration into a mechanics JSON file, next to the profile"""
+        with open(fname, 'r') as f:
+            mech = json.load(f)
+        mech['timeScale'] = self.scale
+        mech['moveOverhead'] = self.overhead
+        with open(fname, 'w') as f:
+            json.dump(mech, f, indent='\t')
+
+    def steps(self, dist):
+        """Number of motor steps of a distance in millimeters"""
+        return int(round(abs(dist) * self.steps_mm))
+
+    def axis_time(self, steps):
+        """Uncalibrated time in seconds of a move of one axis, without the fixed overhead"""
+        n = len(self.ramp)
+        if steps <= 0 or n == 0:
+            return 0.0
+        if steps <= 2 * n:
+            # the cruise speed is not reached: accelerate half of the way, then decelerate
+            us = self.ramp_sums[(steps + 1) // 2] + self.ramp_sums[steps // 2]
+        else:
+            us = 2 * self.ramp_sums[n] + (steps - 2 * n) * self.ramp[-1]
+        return us * 1e-6
+
+    def raw_time(self, coords):
+        """Uncalibrated time in seconds of a relative move"""
+        return max(self.axis_time(self.steps(c)) for c in coords)
+
+    def move_time(self, coords):
+        """Predicted time in seconds of a relative move (x, y, z) in millimeters, 0 for no move"""
+        raw = self.raw_time(coords)
+        if raw == 0.0:
+            return 0.0
+        return self.scale * raw + self.overhead
+
+    def move_time_abs(self, start, target):
+        """Predicted time in seconds of a move between two absolute positions"""
+        return self.move_time([t - s for s, t in zip(start, target)])
+
+    def path_time(self, moves):
+        """Predicted time in seconds of a list of relative moves, one after the other"""
+        return sum(self.move_time(m) for m in moves)
+
+    def in_range(self, position):
+        """True if an absolute position is within the travel range"""
+        return all(0.0 <= p <= r for p, r in zip(position, self.range_mm))
+
+    def clamp(self, position):
+        """Returns an absolute position clamped to the travel range"""
+        return [min(max(p, 0.0), r) for p, r in zip(position, self.range_mm)]
+
+    def calibrate(self, samples):
+        """Fits the calibration (scale and overhead) on measured moves, by least squares
+
+        If all the samples have the same raw time, only the overhead is fitted.
+
+        Parameters
+        ----------
+        samples : list of tuple
+            (coords, seconds): relative moves and their measured durations
+
+        Returns
+        -------
+        float
+            Largest error of the calibrated model on the samples in seconds
+        """
+        xs = [self.raw_time(c) for c, _ in samples]
+        ys = [t for _, t in samples]
+        n = float(len(samples))
+        mx = sum(xs) / n
+        my = sum(ys) / n
+        var = sum((x - mx) ** 2 for x in xs)
+        if var > 1e-12:
+            self.scale = sum((x - mx) * (y - my) for x, y in zip(xs, ys)) / var
+        self.overhead = my - self.scale * mx
+        return max(abs(self.scale * x + self.overhead - y) for x, y in zip(xs, ys))
+
+    def calibrate_test_moves(self, results):
+        """Fits the calibration on MotorsXYZ.test_move results
+
+        Parameters
+        ----------
+        results : list of tuple
+            (dist, times): the distance given to test_move and the per-axis average move times it returned
+        """
+        samples = []
+        for dist, times in results:
+            for axis, t in enumerate(times):
+                coords = [0.0, 0.0, 0.0]
+                coords[axis] = dist
+                samples.append((coords, t))
+        return self.calibrate(samples)
+
+    def check_sequence(self, seq_data, margin=0.005):
+        """Finds the moves of a sequence that take longer than the delay after their pulse
+
+        Same rule as Co_Scheduler.CoScheduler.plan: a move is late if it does not end margin
+        seconds before the next pulse. The move after the last pulse also has the delay
+        between executions to run in, and does not delay any pulse if there is one execution.
+
+        Parameters
+        ----------
+        seq_data : dict
+            Sequence file content (MotorX/Y/Z or MoveX/Y/Z in millimeters, Delay in milliseconds)
+        margin : float
+            Extra time in seconds a move must leave before the next pulse (CoScheduler margin)
+
+        Returns
+        -------
+        list of tuple
+            (pulse index, predicted move time, delay) in seconds, for each late move
+        """
+        sequence = seq_data['Sequence']
+        execs = _exec_count(seq_data)
+        late = []
+        for i, pulse in enumerate(sequence):
+            t = self.move_time(move_from_json(pulse))
+            delay = pulse['Delay'] * 1e-3
+            if i == len(sequence) - 1:
+                if execs <= 1:
+                    break
+                delay += seq_data['SequenceDelay'] * 1e-3
+            if t + margin > delay:
+                late.append((i, t, delay))
+        return late
+
+    def sequence_time(self, seq_data):
+        """Predicted duration in seconds of a sequence file, each delay being extended by a late move"""
+        sequence = seq_data['Sequence']
+        if not sequence:
+            return 0.0
+        execs = _exec_count(seq_data)
+        times = [self.move_time(move_from_json(pulse)) for pulse in sequence]
+        # every pulse but the last one, with its delay
+        period = sum(pulse['Duration'] * 1e-3 + max(pulse['Delay'] * 1e-3, t)
+                     for pulse, t in zip(sequence[:-1], times[:-1]))
+        last = sequence[-1]
+        period += last['Duration'] * 1e-3
+        # the move after the last pulse also runs during the delay between executions
+        gap = max(last['Delay'] * 1e-3 + seq_data['SequenceDelay'] * 1e-3, times[-1])
+        return period * execs + gap * (execs - 1) + max(last['Delay'] * 1e-3, times[-1])
+
+
+def _exec_count(seq_data):
+    return int(seq_data['ExecCount'] if 'ExecCount' in seq_data else seq_data['ExecutionCount'])
+
+
+def move_from_json(pulse):
+    """Relative move after a pulse of a sequence file (MotorX/Y/Z, or MoveX/Y/Z)"""
+    if 'MotorX' in pulse:
+        return (pulse['MotorX'], pulse['MotorY'], pulse['MotorZ'])
+    return (pulse['MoveX'], pulse['MoveY'], pulse['MoveZ'])
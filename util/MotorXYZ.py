@@ -1,5 +1,9 @@
+import collections
+import concurrent.futures
+import functools
 import logging
 import re
+import threading
 import time
 
 import serial
@@ -7,6 +11,8 @@ import serial.tools.list_ports
 
 import numpy as np
 
+import util.Motion_Model as Motion_Model
+
 logger = logging.getLogger('AE')
 logger.setLevel(logging.DEBUG)
 handler_debug = logging.StreamHandler()
@@ -29,29 +35,251 @@ logger.addHandler(handler_debug)
 # 				pass
 # 		return available
 
+class GcodeStreamer(threading.Thread):
+	"""
+	Keeps several G-code commands in flight, so that the planner buffer of the firmware
+	never runs dry between moves.
+
+	Commands are queued by send() and written by this thread as long as fewer than window
+	commands (and rx_size bytes) wait for their answer: one 'ok' (or '!!') per command,
+	in order. Each command gets a Future, its result is the list of lines answered,
+	the last one being the 'ok' or '!!' line.
+	"""
+
+	def __init__(self, com, window=4, rx_size=127, poll=0.05):
+		"""
+		:param com: the open serial port of the stage, read by this thread only from now on.
+		:param int window: maximum number of commands waiting for their answer (planner buffer size).
+		:param int rx_size: maximum number of bytes waiting in the firmware receive buffer.
+		:param float poll: read timeout of the port in seconds, how fast stop() returns.
+		"""
+		super().__init__(name='gcode-streamer', daemon=True)
+		self.com = com
+		self.com.timeout = poll
+		self.window = window
+		self.rx_size = rx_size
+		self._queue = collections.deque() # (data, future) not written yet
+		self._inflight = collections.deque() # (future, number of bytes, lines received)
+		self._inflight_bytes = 0
+		self._discard = 0 # answers still expected for cancelled commands
+		self._lock = threading.Lock() # both deques, the in-flight state and port writes
+		self._wake = threading.Event() # set by send()
+		self._last = None
+		self._running = True
+
+	def send(self, cmd):
+		"""
+		Queues a command.
+
+		:param str cmd: the G-code line, with or without its line ending.
+		:return: a concurrent.futures.Future, done when the command is answered.
+		"""
+		future = concurrent.futures.Future()
+		with self._lock:
+			self._queue.append(((cmd.rstrip() + '\r\n').encode(), future))
+			self._last = future
+		self._wake.set()
+		return future
+
+	def drain(self, timeout=None):
+		"""
+		Waits until all the queued commands are answered.
+
+		:return: True if they are, False on timeout.
+		"""
+		last = self._last
+		if last is None:
+			return True
+		try:
+			last.result(timeout)
+			return True
+		except concurrent.futures.TimeoutError:
+			return False
+
+	def pending(self):
+		"""Number of commands not answered yet, queued or in flight."""
+		with self._lock:
+			return len(self._queue) + len(self._inflight)
+
+	def write_now(self, data, answered=False):
+		"""
+		Writes bytes ahead of the queued commands (e.g. M410, handled at once by the firmware).
+
+		:param bool answered: True if the firmware answers the command (M410, not M112):
+			its answer is then discarded.
+		"""
+		with self._lock:
+			self.com.write(data)
+			self.com.flush()
+			if answered:
+				self._discard += 1
+
+	def cancel(self):
+		"""Fails all the queued and in-flight commands: their futures get ['!!']."""
+		with self._lock:
+			while self._queue:
+				_, future = self._queue.popleft()
+				future.set_result(['!!'])
+			while self._inflight:
+				future, _, _ = self._inflight.popleft()
+				future.set_result(['!!'])
+				self._discard += 1 # the firmware will still answer it
+			self._inflight_bytes = 0
+
+	def stop(self):
+		"""Stops the thread, the commands not answered yet are cancelled."""
+		self._running = False
+		self.join()
+		self.cancel()
+
+	def _fill(self):
+		"""Writes queued commands while the window and the receive buffer allow."""
+		with self._lock:
+			while self._queue and len(self._inflight) < self.window:
+				data, future = self._queue[0]
+				if self._inflight and self._inflight_bytes + len(data) > self.rx_size:
+					return # wait for room in the receive buffer
+				self._queue.popleft()
+				self.com.write(data)
+				self._inflight.append((future, len(data), []))
+				self._inflight_bytes += len(data)
+
+	def _answer(self, line):
+		"""Handles one line read from the port."""
+		with self._lock:
+			done = line[:2] in ('ok', '!!')
+			if self._discard > 0:
+				# answer of a cancelled command
+				self._discard -= done
+				return
+			if not self._inflight:
+				return
+			future, size, lines = self._inflight[0]
+			lines.append(line)
+			if done:
+				self._inflight.popleft()
+				self._inflight_bytes -= size
+				future.set_result(lines)
+
+	def run(self):
+		while self._running:
+			self._fill()
+			if not self._inflight and self._discard == 0:
+				# idle: wait for the next command
+				self._wake.wait(self.com.timeout)
+				self._wake.clear()
+				continue
+			line = self.com.readline()
+			if line:
+				self._answer(str(line.rstrip(), 'ascii', 'replace'))
+
+class PositionTracker:
+	"""
+	Dead-reckoned position of the stage: the commanded moves are integrated, clamped to
+	the travel range like the firmware does (soft endstops), and the position is only read
+	back (M114) when needed: after an error, when unknown, or every sync_interval seconds.
+	"""
+
+	def __init__(self, range_mm, sync_interval=None):
+		"""
+		:param range_mm: travel range of the X, Y and Z axes in millimeters.
+		:param float sync_interval: seconds after which the position is read back again, None for never.
+		"""
+		self.range_mm = list(range_mm)
+		self.sync_interval = sync_interval
+		self.position = None # None until homed or read back
+		self.synced = 0.0 # time.time() of the last read back
+
+	def known(self):
+		return self.position is not None
+
+	def set(self, position):
+		"""Sets the position read back from the firmware."""
+		self.position = [float(p) for p in position]
+		self.synced = time.time()
+
+	def invalidate(self):
+		"""Forgets the position, e.g. after a '!!' answer or a halt."""
+		self.position = None
+
+	def clamp(self, position):
+		return [min(max(p, 0.0), r) for p, r in zip(position, self.range_mm)]
+
+	def target(self, coords):
+		"""Clamped absolute target of a relative move, None if the position is unknown."""
+		if self.position is None:
+			return None
+		return self.clamp([p + c for p, c in zip(self.position, coords)])
+
+	def move(self, target):
+		"""Records a move to an absolute target, as returned by target()."""
+		if self.position is not None:
+			self.position = list(target)
+
+	def needs_sync(self):
+		if self.position is None:
+			return True
+		return self.sync_interval is not None and time.time() - self.synced > self.sync_interval
+
+def _locked(method):
+	"""Runs a MotorsXYZ command under its lock, see MotorsXYZ.lock."""
+	@functools.wraps(method)
+	def wrapper(self, *args, **kwargs):
+		with self.lock:
+			return method(self, *args, **kwargs)
+	return wrapper
+
 class MotorsXYZ:
 	"""
 	class to communicate with the MotorsXYZ at baudrate speed
+
+	The stage is shared by the GUI commands (MotorService worker) and the sequences
+	(FUS worker): the commands are serialized by lock, but for halt() which can be
+	called at any time.
 	"""
 
-	def __init__(self, all_msgs, com_port=None, baudrate=115200, timeout=10):
+	def __init__(self, all_msgs, com_port=None, baudrate=115200, timeout=10, range_mm=None, sync_interval=None):
 		self.all_msgs = all_msgs
 
 		self.com_port = com_port
 		self.timeout = timeout
 		self.baudrate = baudrate
-		self.currentPos = [-1.0,-1.0,-1.0]
+		if range_mm is None:
+			range_mm = Motion_Model.MotionModel.from_file().range_mm
+		self.tracker = PositionTracker(range_mm, sync_interval)
 
 		#0 pattern: "X:([-+]?[0-9]*\.[0-9]*),Y:([-+]?[0-9]*\.[0-9]*),Z:([-+]?[0-9]*\.[0-9]*)"
 		# https://regex101.com/#python
 		self.pattern = "X:([-+]?[0-9]*\.[0-9]*),Y:([-+]?[0-9]*\.[0-9]*),Z:([-+]?[0-9]*\.[0-9]*)"
 		self.M114_re = re.compile(self.pattern)
 
+		self.halted = threading.Event() # set by halt(), makes the waiting commands return at once
+		self.pending_oks = 0 # commands sent by queueMoveRel() or waitMoves() and not answered yet
+		self.stream = None # GcodeStreamer owning the port once connected
+		self.moves = [] # futures of the commands sent by queueMoveRel() or waitMoves()
+		self.lock = threading.RLock() # held by the thread running a command, see _locked()
+
 		self.connected = False
 
+	@property
+	def currentPos(self):
+		"""Tracked position, [-1,-1,-1] if unknown."""
+		if self.tracker.position is None:
+			return [-1.0,-1.0,-1.0]
+		return list(self.tracker.position)
+
+	@currentPos.setter
+	def currentPos(self, position):
+		if position is None or any(p < 0 for p in position):
+			self.tracker.invalidate()
+		else:
+			self.tracker.set(position)
+
 	def find_motor_port(self):
 		motor_port_number = -1
 		for port in serial.tools.list_ports.comports():
+			if self.halted.is_set():
+				break # cancelled, see halt()
 			com = serial.Serial(port.device, 115200, timeout=5)
 			line = str(com.readline().rstrip(),'ascii')
 
@@ -62,6 +290,7 @@ class MotorsXYZ:
 			com.close()
 		return motor_port_number
 
+	@_locked
 	def connect(self):
 		if self.connected:
 			self.all_msgs.appendMsg('Already connected to motor system!')
@@ -77,18 +306,22 @@ class MotorsXYZ:
 		
 
 		self.open_com()
+		self.stream = GcodeStreamer(self.com)
+		self.stream.start()
 		self.connected = True
 		
 		self.all_msgs.appendMsg('Connected to motor system successfully!')
 		self.currentPos = [-1,-1,-1]
 		return [-1,-1,-1]
 
+	@_locked
 	def set_zero(self):
 		ok = self.send_wait("G28 X Y Z\r\n")
 		if ok != 'ok':
 			self.all_msgs.appendMsg('Error in Zeroing. Will close connection')
 			self.close_com()
 			return False
+		self.tracker.set([0.0,0.0,0.0])
 		return True
 
 	def open_com(self):
@@ -101,6 +334,8 @@ class MotorsXYZ:
 		start_time=time.time()
 		finished=False
 		while ( not finished ):
+			if self.halted.is_set():
+				return '!!'
 			line=str(self.com.readline().rstrip(),'ascii')
 			if(line!=''):
 				line=line[:2]
@@ -111,19 +346,196 @@ class MotorsXYZ:
 		for line in self.ans:
 			self.all_msgs.appendMsg(line)
 
-	def send_wait(self,cmd):
+	def send_wait(self,cmd,timeout=5):
+		if self.stream is not None:
+			future = self.stream.send(cmd)
+			try:
+				return future.result(timeout)[-1][:2]
+			except concurrent.futures.TimeoutError:
+				return ''
 		self.nb=self.com.write(cmd.encode())
-		ans=self.wait_for_ok()
+		ans=self.wait_for_ok(timeout)
 		return ans
 
+	@_locked
+	def sendProgram(self, cmds):
+		"""
+		Streams G-code commands, keeping the planner buffer of the firmware full.
+
+		:param cmds: iterable of G-code lines.
+		:return: the list of futures of the commands, see GcodeStreamer.send().
+		"""
+		return [self.stream.send(cmd) for cmd in cmds]
+
+	@_locked
+	def drain(self, timeout=None, motion=False):
+		"""
+		Waits until all the streamed commands are answered.
+
+		:param bool motion: True to also wait until the moves are finished (M400).
+		:return: True if they are, False on timeout.
+		"""
+		if motion:
+			return self.waitMoves(5 if timeout is None else timeout)
+		return self.stream.drain(timeout)
+
+	@_locked
+	def queueMoveRel(self,coords):
+		"""
+		Sends a relative move without waiting: the firmware answers 'ok' once the move is
+		planned, and runs it while other commands are sent. Read the answers with collectOks().
+
+		:return: False if halted, True otherwise.
+		"""
+		if self.halted.is_set():
+			return False
+		coords, target = self._clampMove(coords)
+		cmd = "G1 X{:.2f} Y{:.2f} Z{:.2f}\r\n".format(coords[0],coords[1],coords[2])
+		if self.stream is not None:
+			self.moves.append(self.stream.send(cmd))
+			self.pending_oks = len(self.moves)
+		else:
+			self.com.write(cmd.encode())
+			self.pending_oks += 1
+		self.tracker.move(target)
+		return True
+
+	@_locked
+	def queueDwell(self, seconds):
+		"""
+		Queues a pause of the stage (G4) after the queued moves, without waiting.
+		The answer is read by collectOks() like the one of a move.
+
+		:return: False if halted, True otherwise.
+		"""
+		if self.halted.is_set():
+			return False
+		cmd = "G4 P{:d}\r\n".format(int(round(seconds * 1000)))
+		if self.stream is not None:
+			self.moves.append(self.stream.send(cmd))
+			self.pending_oks = len(self.moves)
+		else:
+			self.com.write(cmd.encode())
+			self.pending_oks += 1
+		return True
+
+	def _clampMove(self, coords):
+		"""
+		Clamps a relative move to the travel range, when the position is known.
+
+		:return: (coords, target): the move to send and its absolute target (None if unknown).
+		"""
+		target = self.tracker.target(coords)
+		if target is None:
+			return list(coords), None
+		return [t - p for t, p in zip(target, self.tracker.position)], target
+
+	@_locked
+	def collectOks(self, timeout=0):
+		"""
+		Reads the answers of the queued commands, until all of them are answered or the timeout expires.
+
+		:param float timeout: seconds to wait, 0 to only read what was already received.
+		:return: the number of commands still waiting for their answer.
+		"""
+		deadline = time.time() + timeout
+		if self.stream is not None:
+			while self.moves and not self.halted.is_set():
+				try:
+					lines = self.moves[0].result(max(0, deadline - time.time()))
+				except concurrent.futures.TimeoutError:
+					break
+				if lines[-1][:2] == '!!':
+					self.all_msgs.appendMsg('Hit motor edge!')
+					self.tracker.invalidate()
+				self.moves.pop(0)
+			self.pending_oks = len(self.moves)
+			return self.pending_oks
+		while self.pending_oks > 0 and not self.halted.is_set():
+			if self.com.in_waiting == 0 and time.time() >= deadline:
+				break
+			line = str(self.com.readline().rstrip(),'ascii')[:2]
+			if line == 'ok':
+				self.pending_oks -= 1
+			elif line == '!!':
+				self.pending_oks -= 1
+				self.all_msgs.appendMsg('Hit motor edge!')
+				self.tracker.invalidate()
+		return self.pending_oks
+
+	@_locked
+	def waitMoves(self, timeout=5):
+		"""
+		Waits until all the queued moves are finished (M400).
+
+		:return: True if they are, False on timeout or halt.
+		"""
+		if self.stream is not None:
+			self.moves.append(self.stream.send("M400"))
+		else:
+			self.com.write(b"M400\r\n")
+		self.pending_oks += 1
+		return self.collectOks(timeout) == 0
+
+	def halt(self, emergency=False):
+		"""
+		Stops all motion at once, from any thread. M410 (quickstop) and M112 (emergency stop)
+		are handled by the firmware as soon as they are received, ahead of the queued moves.
+		The commands waiting for an answer return '!!', moves are refused until resume().
+
+		:param bool emergency: True to send M112, which also kills the firmware until it is reset.
+		:return: the time taken to write the command, in seconds.
+		"""
+		start = time.perf_counter()
+		self.halted.set()
+		self.tracker.invalidate() # the moves were cut short
+		if self.connected:
+			cmd = b"M112\r\n" if emergency else b"M410\r\n"
+			if self.stream is not None:
+				# M112 kills the firmware, nothing answers it
+				self.stream.write_now(cmd, answered=not emergency)
+				self.stream.cancel()
+			else:
+				self.com.write(cmd)
+				self.com.flush()
+		return time.perf_counter() - start
+
+	@_locked
+	def resume(self):
+		"""Accepts moves again after halt()."""
+		self.halted.clear()
+		self.pending_oks = 0
+		self.moves = []
+		if self.connected and self.stream is None:
+			self.com.reset_input_buffer()
+
+	@_locked
 	def close_com(self):
 		if not self.connected:
 			self.all_msgs.appendMsg('Not connected to motor system!')
 			return
+		if self.stream is not None:
+			self.stream.stop()
+			self.stream = None
 		self.com.close()
 		self.connected = False
 
+	@_locked
 	def getPos(self):
+		if self.stream is not None:
+			try:
+				lines = self.stream.send("M114").result(self.timeout)
+			except concurrent.futures.TimeoutError:
+				return self.currentPos
+			for line in lines:
+				match_M114 = self.M114_re.search(line)
+				if match_M114:
+					self.currentPos = [float(x) for x in match_M114.groups()]
+			if lines[-1][:2] == '!!':
+				self.all_msgs.appendMsg("error: " + lines[-1][2:].strip())
+				self.currentPos = [-1.0,-1.0,-1.0]
+				return None
+			return self.currentPos
 		ok=self.send_cmd("M114\r\n")
 		finished = False
 		tries = 5
@@ -149,22 +561,34 @@ class MotorsXYZ:
 			tries -= 1
 		return self.currentPos
 
+	@_locked
 	def moveRel(self,coords):
+		if self.halted.is_set():
+			return None
+		coords, target = self._clampMove(coords)
 		#Construct move command from the motor system
 		cmd = "G1 X{:.2f} Y{:.2f} Z{:.2f}\r\n".format(coords[0],coords[1],coords[2])
 		ok = self.send_wait(cmd)
 		if ok != 'ok':
 			self.all_msgs.appendMsg('Hit motor edge!')
+			self.tracker.invalidate()
+		else:
+			self.tracker.move(target)
 
-		self.currentPos = self.getPos()
-		
+		# the position is only read back when the tracked one can not be trusted
+		if self.tracker.needs_sync():
+			return self.getPos()
 		return self.currentPos
 
+	@_locked
 	def moveAbs(self,coords):
-		if any(np.array(self.currentPos) < 0):
+		if not self.tracker.known():
+			self.getPos()
+		if not self.tracker.known():
 			self.all_msgs.appendMsg('Cannot move without initializing zero')
 			return
-		move_coords = np.array(coords) - np.array(self.currentPos)
+		target = self.tracker.clamp(coords)
+		move_coords = [t - p for t, p in zip(target, self.tracker.position)]
 		return self.moveRel(move_coords)
 
 	def test_move(self,dist):
@@ -175,12 +599,17 @@ class MotorsXYZ:
 			move_one[axis] = dist
 			move_two[axis] = -dist
 
+			# moveRel returns once the move is planned: each move is timed until it is finished (M400)
+			self.waitMoves()
 			start = time.time()
 			for i in range(25):
 				self.moveRel(move_one)
+				self.waitMoves()
 				self.moveRel(move_two)
+				self.waitMoves()
 
 			tot_times[axis] = (time.time() - start)/50
 
 		print('Times: ' + str(tot_times))
+		return tot_times
 				
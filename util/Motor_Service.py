@@ -0,0 +1,199 @@
+"""Runs the stage commands of the GUI on a worker thread
+
+MotorsXYZ blocks until the firmware answers: a homing (G28) or a failed move can take
+seconds, and looking for the stage port waits on every serial port. MotorService queues
+these commands on a FUS_Exec.ExecWorker, so the Qt slots return at once. Its poll() method,
+called from the GUI thread by a QTimer, hands the messages over to all_msgs and emits the
+position and state changes as Qt signals.
+
+Jog clicks are coalesced: while a jog move runs, the next clicks add up per axis and are
+sent as one move once the stage is ready, so a burst of clicks costs at most two moves.
+"""
+import threading
+
+from PyQt5.QtCore import QObject, pyqtSignal
+
+from util.FUS_Exec import ExecWorker
+
+
+class PostedMessages(object):
+    """Stands for all_msgs in the worker thread: the messages are posted to the worker
+    and appended to all_msgs by MotorService.poll()
+    """
+    def __init__(self, worker):
+        self.worker = worker
+
+    def appendMsg(self, msg):
+        self.worker.post('msg', msg)
+
+
+class MotorService(QObject):
+    """Non-blocking front end of a MotorsXYZ
+
+    Parameters
+    ----------
+    all_msgs : HomeView.Message_List
+        Where the messages are shown
+    motor : MotorXYZ.MotorsXYZ
+        The stage. Its commands run on the worker thread, a sequence (FUS_GEN) may run
+        others on its own worker: MotorsXYZ serializes them with its lock
+    """
+    positionChanged = pyqtSignal(list)
+    connectedChanged = pyqtSignal(bool)
+    busyChanged = pyqtSignal(bool)
+
+    def __init__(self, all_msgs, motor, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.all_msgs = all_msgs
+        self.motor = motor
+        self.worker = ExecWorker(name='motor-worker')
+        # the motor messages are sent from the worker thread
+        self.motor.all_msgs = PostedMessages(self.worker)
+        self.worker.start()
+        self.connected = motor.connected
+        self.busy = False
+        self._jog_lock = threading.Lock()
+        self._jog = [0.0, 0.0, 0.0]  # jog deltas not sent yet
+        self._jog_queued = False  # whether a _jog_move is queued
+        self._jog_moving = False  # whether a _jog_move runs
+
+    def _submit(self, func, *args):
+        self.worker.submit(func, *args)
+
+    def _post_position(self, pos):
+        # None or False when the command failed
+        if pos:
+            self.worker.post('position', list(pos))
+
+    def connect(self):
+        """Looks for the stage if needed, and connects to it"""
+        self._submit(self._connect)
+
+    def _connect(self):
+        self._post_position(self.motor.connect())
+        self.worker.post('connected', self.motor.connected)
+
+    def close(self):
+        """Disconnects the stage"""
+        self._submit(self._close)
+
+    def _close(self):
+        self.motor.close_com()
+        self.worker.post('connected', self.motor.connected)
+
+    def set_zero(self):
+        """Homes the stage (G28)"""
+        self._submit(self._set_zero)
+
+    def _set_zero(self):
+        if self.motor.set_zero():
+            self._post_position(self.motor.getPos())
+        self.worker.post('connected', self.motor.connected)
+
+    def move_rel(self, coords):
+        """Moves the stage by (x, y, z) millimeters"""
+        self._submit(self._move, self.motor.moveRel, list(coords))
+
+    def move_abs(self, coords):
+        """Moves the stage to (x, y, z) millimeters"""
+        self._submit(self._move, self.motor.moveAbs, list(coords))
+
+    def _move(self, move, coords):
+        self._post_position(move(coords))
+
+    def jog(self, axis, delta):
+        """Moves one axis by delta millimeters, merged with the jogs not sent yet
+
+        Returns
+        -------
+        list of float
+            The jog deltas not sent yet, this one included
+        """
+        with self._jog_lock:
+            self._jog[axis] += delta
+            if not self._jog_queued:
+                self._jog_queued = True
+                self._submit(self._jog_move)
+            return list(self._jog)
+
+    def jog_pending(self):
+        """True while jogs are queued or moving"""
+        with self._jog_lock:
+            return self._jog_queued or self._jog_moving or any(self._jog)
+
+    def _jog_move(self):
+        with self._jog_lock:
+            coords = self._jog
+            self._jog = [0.0, 0.0, 0.0]
+            self._jog_queued = False
+            self._jog_moving = True
+        pos = None
+        try:
+            if any(coords):
+                pos = self.motor.moveRel(coords)
+        finally:
+            with self._jog_lock:
+                self._jog_moving = False
+        # posted once the jog is over, for MotorView to show it
+        self._post_position(pos)
+
+    def get_pos(self):
+        """Reads the position back from the stage (M114)"""
+        self._submit(self._get_pos)
+
+    def _get_pos(self):
+        self._post_position(self.motor.getPos())
+
+    def cancel(self):
+        """Drops the queued commands and stops the running one. Can be called from any thread.
+
+        Returns
+        -------
+        int
+            Number of commands dropped
+        """
+        dropped = self.worker.clear()
+        with self._jog_lock:
+            self._jog = [0.0, 0.0, 0.0]
+            self._jog_queued = False
+        if self.worker.busy:
+            self.motor.halt()
+        # accept moves again once the running command has returned
+        self._submit(self._resume)
+        return dropped
+
+    def _resume(self):
+        self.motor.resume()
+        if self.motor.connected:
+            self._post_position(self.motor.getPos())
+
+    def poll(self, limit=None):
+        """Hands the worker events over to all_msgs and the signals. Call from the GUI thread.
+
+        Parameters
+        ----------
+        limit : int, optional
+            Maximum number of events to process, all of them by default
+        """
+        msgs = []
+        for kind, value in self.worker.drain(limit):
+            if kind == 'position':
+                self.positionChanged.emit(value)
+            elif kind == 'connected':
+                if value != self.connected:
+                    self.connected = value
+                    self.connectedChanged.emit(value)
+            elif kind == 'error':
+                msgs.append('ERROR: ' + str(value))
+            else:
+                msgs.append(value)
+        if msgs:
+            self.all_msgs.appendMsgs(msgs)
+        busy = self.worker.busy or self.worker.pending() > 0
+        if busy != self.busy:
+            self.busy = busy
+            self.busyChanged.emit(busy)
+
+    def shutdown(self, timeout=None):
+        """Stops the worker once the queued commands are done"""
+        self.worker.shutdown(timeout)
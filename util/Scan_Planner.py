@@ -0,0 +1,220 @@
+"""Plans and runs raster scans of the stage over a grid of focal positions
+
+A scan visits every point of a regular grid inside a bounding box, clamped to the travel
+range of sdk/mechanics.json, and stays at each point for a dwell time (G4), or runs a
+callback there (e.g. a sonication sequence) once the stage has stopped.
+
+The points are generated lazily, one at a time, so the plan of a large map is never
+held in memory. Two visiting orders are available:
+
+- serpentine: rows along X alternate direction, so do the Y rows of successive Z layers,
+  every move is one grid step,
+- nearest: greedy nearest neighbour from the first corner. It keeps one byte per point
+  to remember the visited ones, and its search gets slower at the end of large grids.
+
+The predicted scan time (MotionModel.move_time of each move, plus the dwell) is known
+before the scan starts, see ScanPlan.predicted_time.
+"""
+import math
+import time
+
+import util.Motion_Model as Motion_Model
+
+
+def _axis_count(lo, hi, step):
+    """Number of grid points from lo to hi (included if on the grid)"""
+    if step <= 0 or hi <= lo:
+        return 1
+    return int(math.floor((hi - lo) / step + 1e-9)) + 1
+
+
+class ScanPlan(object):
+    """Grid of points inside a bounding box, and the order in which to visit them
+
+    Parameters
+    ----------
+    box_min : list of float
+        Lower corner (x, y, z) of the bounding box in millimeters
+    box_max : list of float
+        Upper corner (x, y, z) of the bounding box in millimeters
+    step : float or list of float
+        Grid step in millimeters, for all the axes or per axis (0 for a single plane)
+    dwell : float
+        Seconds spent at each point, e.g. MotionModel.sequence_time of the sequence run there
+    order : str
+        'serpentine' or 'nearest'
+    model : Motion_Model.MotionModel, optional
+        Motion model giving the travel range and the move times, loaded from
+        sdk/mechanics.json by default
+    """
+    ORDERS = ('serpentine', 'nearest')
+
+    def __init__(self, box_min, box_max, step, dwell=0.0, order='serpentine', model=None):
+        if order not in self.ORDERS:
+            raise ValueError('Unknown scan order: ' + str(order))
+        self.model = model if model is not None else Motion_Model.MotionModel.from_file()
+        if not hasattr(step, '__len__'):
+            step = [step] * 3
+        self.step = [float(s) for s in step]
+        self.lo = self.model.clamp([min(a, b) for a, b in zip(box_min, box_max)])
+        self.hi = self.model.clamp([max(a, b) for a, b in zip(box_min, box_max)])
+        self.counts = [_axis_count(l, h, s) for l, h, s in zip(self.lo, self.hi, self.step)]
+        self.dwell = dwell
+        self.order = order
+
+    def __len__(self):
+        return self.counts[0] * self.counts[1] * self.counts[2]
+
+    def position(self, index):
+        """Position in millimeters of the grid point of indices (i, j, k)"""
+        return [round(l + i * s, 2) for l, i, s in zip(self.lo, index, self.step)]
+
+    def indices(self):
+        """Generates the grid indices (i, j, k) of the points, in visiting order"""
+        if self.order == 'serpentine':
+            return self._serpentine()
+        return self._nearest()
+
+    def points(self):
+        """Generates the positions of the points in millimeters, in visiting order"""
+        for index in self.indices():
+            yield self.position(index)
+
+    def _serpentine(self):
+        nx, ny, nz = self.counts
+        row = 0
+        for k in range(nz):
+            js = range(ny) if k % 2 == 0 else range(ny - 1, -1, -1)
+            for j in js:
+                is_ = range(nx) if row % 2 == 0 else range(nx - 1, -1, -1)
+                for i in is_:
+                    yield (i, j, k)
+                row += 1
+
+    def _nearest(self):
+        nx, ny, nz = self.counts
+        visited = bytearray(len(self))
+        # smallest distance between two points a ring of indices away
+        min_step = min([s for s, n in zip(self.step, self.counts) if n > 1] or [1.0])
+        current = (0, 0, 0)
+        for _ in range(len(self)):
+            yield current
+            i, j, k = current
+            visited[(k * ny + j) * nx + i] = 1
+            best = None
+            best_dist = None
+            r = 1
+            while r <= max(self.counts):
+                if best is not None and r * min_step >= best_dist:
+                    break  # no point of this ring or beyond can be closer
+                for dk in range(-r, r + 1):
+                    kk = k + dk
+                    if not 0 <= kk < nz:
+                        continue
+                    for dj in range(-r, r + 1):
+                        jj = j + dj
+                        if not 0 <= jj < ny:
+                            continue
+                        # only the shell of the cube of half-side r
+                        full = abs(dk) == r or abs(dj) == r
+                        for di in (range(-r, r + 1) if full else (-r, r)):
+                            ii = i + di
+                            if not 0 <= ii < nx or visited[(kk * ny + jj) * nx + ii]:
+                                continue
+                            dist = math.sqrt((di * self.step[0]) ** 2 + (dj * self.step[1]) ** 2
+                                             + (dk * self.step[2]) ** 2)
+                            if best is None or dist < best_dist:
+                                best = (ii, jj, kk)
+                                best_dist = dist
+                r += 1
+            if best is None:
+                return
+            current = best
+
+    def moves(self, start):
+        """Generates the relative moves (x, y, z) visiting the points from a start position"""
+        prev = [round(p, 2) for p in start]
+        for point in self.points():
+            yield [round(t - p, 2) for t, p in zip(point, prev)]
+            prev = point
+
+    def predicted_time(self, start):
+        """Predicted duration of the scan in seconds from a start position, moves and dwells"""
+        total = 0.0
+        times = {}  # a grid scan only has a few different moves
+        for move in self.moves(start):
+            key = tuple(move)
+            if key not in times:
+                times[key] = self.model.move_time(move)
+            total += times[key] + self.dwell
+        return total
+
+    def travel(self, start):
+        """Length of the path of the scan in millimeters from a start position"""
+        return sum(math.sqrt(sum(c * c for c in move)) for move in self.moves(start))
+
+    def __str__(self):
+        return '%d points (%d x %d x %d), %s order' % (
+            len(self), self.counts[0], self.counts[1], self.counts[2], self.order)
+
+
+def run_scan(motor, plan, at_point=None, should_stop=None, max_pending=16):
+    """Moves the stage through a scan plan
+
+    Without at_point, the moves and dwells are streamed to the stage as one G-code program,
+    with at most max_pending commands not answered yet. With at_point, the stage stops at
+    each point and at_point is called there, then the scan goes on.
+
+    Parameters
+    ----------
+    motor : MotorXYZ.MotorsXYZ
+        A connected stage, with a known position (zeroed)
+    plan : ScanPlan
+    at_point : callable, optional
+        Called with (point index, position) once the stage is at a point, instead of the dwell
+    should_stop : callable, optional
+        Polled before each point, the scan is stopped when it returns True
+    max_pending : int
+        Maximum number of streamed commands not answered yet
+
+    Returns
+    -------
+    tuple
+        (points reached or streamed, elapsed seconds, whether the scan was stopped)
+    """
+    if not motor.tracker.known():
+        motor.all_msgs.appendMsg('Cannot scan without initializing zero')
+        return 0, 0.0, True
+    if should_stop is None:
+        should_stop = lambda: False
+    start = motor.currentPos
+    motor.all_msgs.appendMsg('Scan: %s, %.1f mm of travel, predicted time %.1f s' % (
+        plan, plan.travel(start), plan.predicted_time(start)))
+
+    # longest wait for the commands not answered yet
+    timeout = 5.0 + max_pending * (plan.dwell + plan.model.move_time(plan.step))
+    begin = time.perf_counter()
+    done = 0
+    stopped = False
+    for index, move in enumerate(plan.moves(start)):
+        if should_stop() or not motor.queueMoveRel(move):
+            stopped = True
+            break
+        if at_point is not None:
+            if not motor.waitMoves():
+                stopped = True
+                break
+            at_point(index, motor.currentPos)
+        else:
+            if plan.dwell > 0:
+                motor.queueDwell(plan.dwell)
+            # keep the answers of the stage flowing, without holding the whole program
+            while motor.collectOks() > max_pending and not motor.halted.is_set():
+                motor.collectOks(0.05)
+        done += 1
+    if not stopped and at_point is None:
+        stopped = not motor.waitMoves(timeout)
+    elapsed = time.perf_counter() - begin
+    motor.all_msgs.appendMsg('Scan: %d of %d points in %.1f s%s' % (
+        done, len(plan), elapsed, ' (stopped)' if stopped else ''))
+    return done, elapsed, stopped
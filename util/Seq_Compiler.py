@@ -0,0 +1,168 @@
+"""Compiles pulse programs into as few generator uploads as possible
+
+A program (one execution of a pulse list, repeated with a delay between executions) is
+expanded into its pulse timeline, in which the delay between executions is part of the
+delay of the last pulse of each execution. Periodic runs of that timeline are folded
+into one short sequence executed several times: a block repeated k times is uploaded
+once and run with ``execs = k``. If the last copy of the block only differs by a shorter
+delay after its last pulse, it is folded too, the difference becoming the delay between
+executions (``SequenceDelay``). Everything else is uploaded in chunks of
+``Param.PULSE_COUNT_MAX`` pulses, see FUS_Exec.chunk_program.
+
+The folded program has the same timeline as the original one, except for the dead time
+of each additional upload (see FUS_Exec.ChunkReport).
+"""
+import sdk.pga as FUS
+from util.FUS_Exec import Segment
+
+
+class CompiledProgram(object):
+    """Result of compile_program
+
+    Attributes
+    ----------
+    segments : list of FUS_Exec.Segment
+        The uploads, in execution order
+    num_pulses : int
+        Number of pulses fired by the program
+    """
+    def __init__(self, segments, num_pulses):
+        self.segments = segments
+        self.num_pulses = num_pulses
+
+    def uploads(self):
+        """Number of sequence uploads needed"""
+        return len(self.segments)
+
+    def slots(self):
+        """Number of pulses uploaded to the generator"""
+        return sum(len(seg.pulses) for seg in self.segments)
+
+    def ratio(self):
+        """Compression ratio: pulses fired per pulse uploaded"""
+        slots = self.slots()
+        return float(self.num_pulses) / slots if slots else 1.0
+
+    def __str__(self):
+        return '%d pulses in %d uploads (%d pulses uploaded, compression ratio %.1f)' % (
+            self.num_pulses, self.uploads(), self.slots(), self.ratio())
+
+
+def _key(pulse):
+    return (pulse.duration, pulse.delay, pulse.amplitude, pulse.frequency)
+
+
+def expand_program(pulses, execs, delay):
+    """Returns the pulse timeline of a program, with the delay between executions
+    added to the last pulse of every execution but the final one
+    """
+    if execs <= 1 or not pulses:
+        return list(pulses)
+    last = pulses[-1]
+    extended = pulses[:-1] + [FUS.Pulse(last.duration, last.delay + delay, last.amplitude, last.frequency)]
+    return extended * (execs - 1) + list(pulses)
+
+
+def _find_loop(keys, start, max_pulses, max_delay):
+    """Finds the periodic run starting at start covering the most pulses
+
+    Returns
+    -------
+    tuple
+        (period, copies, tail): the block length, the number of identical copies,
+        and the last pulse delay of an extra copy (None if there is none).
+        copies is 0 if no block repeats.
+    """
+    n = len(keys)
+    best = (0, 0, None)
+    best_cover = 0
+    for period in range(1, min(max_pulses, (n - start) // 2) + 1):
+        # length of the run in which every pulse equals the one a period before
+        pos = start + period
+        while pos < n and keys[pos] == keys[pos - period]:
+            pos += 1
+        copies = (pos - start) // period
+        tail = None
+        # an extra copy whose last pulse is only followed by a shorter delay
+        end = start + (copies + 1) * period
+        if end <= n and pos == end - 1:
+            dura, dela, ampl, freq = keys[pos]
+            ref = keys[pos - period]
+            if (dura, ampl, freq) == (ref[0], ref[2], ref[3]) and dela < ref[1] and ref[1] - dela <= max_delay:
+                tail = dela
+        cover = (copies + (tail is not None)) * period
+        if copies + (tail is not None) >= 2 and cover > best_cover:
+            best = (period, copies, tail)
+            best_cover = cover
+    return best
+
+
+def compile_program(pulses, execs=1, delay=0, max_pulses=20, max_delay=None):
+    """Folds the periodic runs of a program into looped segments
+
+    Parameters
+    ----------
+    pulses : list of FUS.Pulse
+        One execution of the program
+    execs : int
+        Number of executions
+    delay : int
+        Delay between executions in microseconds
+    max_pulses : int
+        Size of the generator sequence buffer (Param.PULSE_COUNT_MAX)
+    max_delay : int, optional
+        Longest delay between executions (Param.EXECUTION_DELAY_MAX), default value by default
+
+    Returns
+    -------
+    CompiledProgram
+    """
+    if max_delay is None:
+        max_delay = FUS.Param.DEFAULTS[FUS.Param.EXECUTION_DELAY_MAX].defaultValue
+    if len(pulses) <= max_pulses:
+        # already one upload: only fold the execution itself, if its repetitions can be merged
+        folded = _fold(list(pulses), max_pulses, max_delay)
+        if execs <= 1:
+            return CompiledProgram(folded, len(pulses))
+        if delay == 0 and len(folded) == 1 and folded[0].delay == 0:
+            seg = folded[0]
+            return CompiledProgram([Segment(seg.pulses, seg.execs * execs)], len(pulses) * execs)
+        return CompiledProgram([Segment(pulses, execs, delay)], len(pulses) * execs)
+    timeline = expand_program(pulses, execs, delay)
+    return CompiledProgram(_fold(timeline, max_pulses, max_delay), len(timeline))
+
+
+def _fold(timeline, max_pulses, max_delay):
+    """Splits a pulse timeline into looped segments and chunks"""
+    keys = [_key(p) for p in timeline]
+    n = len(timeline)
+
+    segments = []
+    literal = []
+
+    def flush():
+        for i in range(0, len(literal), max_pulses):
+            segments.append(Segment(literal[i:i + max_pulses]))
+        del literal[:]
+
+    pos = 0
+    while pos < n:
+        period, copies, tail = _find_loop(keys, pos, max_pulses, max_delay)
+        runs = copies + (tail is not None)
+        cover = runs * period
+        # a short repetition is cheaper as part of a chunk than as an upload of its own
+        if runs >= 2 and (cover > max_pulses or (pos == 0 and cover == n)):
+            flush()
+            block = timeline[pos:pos + period]
+            loop_delay = 0
+            if tail is not None:
+                last = block[-1]
+                loop_delay = last.delay - tail
+                block = block[:-1] + [FUS.Pulse(last.duration, tail, last.amplitude, last.frequency)]
+            segments.append(Segment(block, runs, loop_delay))
+            pos += cover
+        else:
+            literal.append(timeline[pos])
+            pos += 1
+    flush()
+    return segments
@@ -110,6 +110,10 @@ class Message_List(QObject):
         self._msgs.append(Message(new_msg))
         self.msgsChanged.emit()
 
+    def appendMsgs(self, new_msgs):
+        self._msgs.extend(Message(msg) for msg in new_msgs)
+        self.msgsChanged.emit()
+
 class HomeView:
     def __init__(self,engine,mainWindow,all_msgs,gen,stackView):
         self.engine = engine
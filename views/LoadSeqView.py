@@ -115,6 +115,9 @@ class LoadSeqView:
         self.run_button = self.mainWindow.findChild(QObject, "executeButton")
         self.run_button.clicked.connect(self.gen.run)
 
+        self.stop_button = self.mainWindow.findChild(QObject, "stopButton")
+        self.stop_button.clicked.connect(self.gen.abort)
+
         # Connect the Sequence TextFields
         self.fname_field = self.mainWindow.findChild(QObject, "fileName")
         self.fname_field.setProperty("text", self.fname)
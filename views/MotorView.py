@@ -10,11 +10,21 @@ import os
 import shutil
 
 class MotorView:
-    def __init__(self, engine, mainWindow, all_msgs, motor):
+    def __init__(self, engine, mainWindow, all_msgs, motor_service, gen=None):
         self.engine = engine
         self.mainWindow = mainWindow
         self.all_msgs = all_msgs
-        self.motor = motor
+        #The motor commands run on the worker thread of the service, the slots never wait for the stage
+        self.motor_service = motor_service
+        self.motor = motor_service.motor
+        self.motor_service.connectedChanged.connect(self.update_connected)
+        self.motor_service.positionChanged.connect(self.update_position)
+        #The stage is moved by the sequences too: no manual move while one runs
+        self.sequence_running = False
+        if gen is not None:
+            gen.sequence_callbacks.append(self.update_sequence_running)
+        self.view = None
+        self.target = None #Position shown while jogging, None if unknown
         self.loaded = False
 
     def load(self):
@@ -24,6 +34,7 @@ class MotorView:
 
         #Load Buttons
         self.back_button = self.mainWindow.findChild(QObject, "backButton")
+        self.back_button.clicked.connect(self.unload)
         self.back_button.clicked.connect(self.view.pop)
 
         self.connect_motor_button = self.mainWindow.findChild(QObject, "connectMotorButton")
@@ -33,6 +44,9 @@ class MotorView:
             QObject, "setZeroButton")
         self.set_zero_button.clicked.connect(self.set_zero)
 
+        self.stop_motor_button = self.mainWindow.findChild(QObject, "stopMotorButton")
+        self.stop_motor_button.clicked.connect(self.motor_service.cancel)
+
         self.goto_button = self.mainWindow.findChild(QObject, "goToButton")
         self.goto_button.clicked.connect(self.move_abs)
 
@@ -67,37 +81,51 @@ class MotorView:
 
         #Indicator lights
         self.motor_light = self.mainWindow.findChild(QObject,"motorIndicator")
-        if self.motor.connected:
-            self.motor_light.setProperty("color","green")
-            self.enable_buttons()
-        else:
-            self.motor_light.setProperty("color", "red")
-            self.disable_buttons()
+        self.update_connected(self.motor_service.connected)
+
+    def unload(self):
+        #The page is destroyed by the stack view, stop updating it
+        self.view = None
 
     def connect(self):
-        res = self.motor.connect()
-        if self.motor.connected:
+        self.connect_motor_button.setProperty("enabled", False)
+        self.motor_service.connect()
+
+    def update_connected(self, connected):
+        if self.view is None:
+            return
+        self.connect_motor_button.setProperty("enabled", True)
+        if connected:
             self.motor_light.setProperty("color", "green")
-            self.enable_buttons()
-            self.update_position(res)
+            if self.sequence_running:
+                self.disable_buttons()
+            else:
+                self.enable_buttons()
         else:
             self.motor_light.setProperty("color","red")
             self.disable_buttons()
 
+    def update_sequence_running(self, running):
+        self.sequence_running = running
+        self.update_connected(self.motor_service.connected)
 
-    def update_position(self,pos_return=None):
-        if pos_return is None:
-            current_pos = self.motor.getPos()
-        else:
-            current_pos = pos_return
+    def update_position(self,current_pos):
+        if self.motor_service.jog_pending():
+            #Keep showing the jog target until the stage catches up
+            return
+        self.target = list(current_pos) if all(p >= 0 for p in current_pos) else None
+        self.show_position(current_pos)
+
+    def show_position(self,current_pos):
+        if self.view is None:
+            return
         self.xpos_text.setProperty("text",str(current_pos[0]))
         self.ypos_text.setProperty("text",str(current_pos[1]))
         self.zpos_text.setProperty("text",str(current_pos[2]))
 
     
     def set_zero(self):
-        self.motor.set_zero()
-        self.update_position()
+        self.motor_service.set_zero()
 
     def move_abs(self):
         new_coord = [0,0,0]
@@ -105,27 +133,26 @@ class MotorView:
         new_coord[1] = float(self.yfield.property("text"))
         new_coord[2] = float(self.zfield.property("text"))
 
-        res = self.motor.moveAbs(new_coord)
-        self.update_position(res)
+        self.motor_service.move_abs(new_coord)
         #interval = float(self.inc_field.property("text"))
         #self.motor.test_move(interval)
 
     
     def move_inc(self,direction):
         interval = float(self.inc_field.property("text"))
-        new_coord = [0,0,0]
-        new_coord[direction] = interval
-
-        res = self.motor.moveRel(new_coord)
-        self.update_position(res)
+        self.jog(direction, interval)
         
     def move_dec(self,direction):
         interval = float(self.inc_field.property("text"))
-        new_coord = [0, 0, 0]
-        new_coord[direction] = -interval
-
-        res = self.motor.moveRel(new_coord)
-        self.update_position(res)
+        self.jog(direction, -interval)
+
+    def jog(self,direction,delta):
+        #Clicks made during a move are merged into the next one
+        self.motor_service.jog(direction, delta)
+        if self.target is not None:
+            self.target[direction] += delta
+            self.target = self.motor.tracker.clamp(self.target)
+            self.show_position(self.target)
 
     def enable_buttons(self):
         self.set_zero_button.setProperty("enabled", True)